@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the commit latency of ProcessStockpiles' commit backends on a large stockpile repository.
+
+A template stockpile of `--files` configs with `--history` commits is built once, then for each run of each backend
+a fresh copy has `--changed` configs rewritten and is committed through `ProcessStockpiles.task_completed()`,
+exactly as at the end of a stockpile run.  Run from the repository root, i.e.:
+
+    python benchmarks/commit_backends.py --files 100000 --changed 500 --runs 3
+"""
+
+from argparse import ArgumentParser, Namespace
+import contextlib
+import io
+import json
+import pathlib
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+
+from git import Actor, Repo
+from nornir.core.inventory import Host
+from nornir.core.task import MultiResult, Result, Task
+
+
+# Run from a checkout, rather than needing Stockpiler installed
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from benchmarks.fake_fleet import generate_config  # noqa: E402
+from stockpiler.processors.process_stockpiles import ProcessStockpiles  # noqa: E402
+from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config  # noqa: E402
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults  # noqa: E402
+
+
+BACKENDS = ["index", "fast-import"]
+
+
+def host_names(count: int) -> List[str]:
+    return [f"rtr{i:06d}" for i in range(count)]
+
+
+def rewrite_configs(stockpile_directory: pathlib.Path, names: List[str], size: int, revision: str) -> None:
+    for name in names:
+        config = generate_config(hostname=name, size=size)
+        (stockpile_directory / f"{name}.txt").write_text(f"! Revision {revision}\n{config}")
+
+
+def build_template(stockpile_directory: pathlib.Path, args: Namespace) -> None:
+    """
+    Build a stockpile repository with history, and an index up to date with its work tree (as committing through
+    the index would leave it)
+    :param stockpile_directory:
+    :param args:
+    :return:
+    """
+
+    names = host_names(count=args.files)
+    chooser = random.Random(0)
+    author = Actor(name="Stockpiler", email="stockpiler@localhost.local")
+    repo = Repo.init(path=str(stockpile_directory))
+
+    rewrite_configs(stockpile_directory=stockpile_directory, names=names, size=args.config_size, revision="0")
+    ProcessStockpiles.git_fast_import_commit(
+        repo=repo, paths=[f"{name}.txt" for name in names], message="Initial stockpile", author=author
+    )
+    for revision in range(1, args.history + 1):
+        changed = chooser.sample(names, k=min(args.changed, len(names)))
+        rewrite_configs(
+            stockpile_directory=stockpile_directory, names=changed, size=args.config_size, revision=str(revision)
+        )
+        ProcessStockpiles.git_fast_import_commit(
+            repo=repo, paths=[f"{name}.txt" for name in changed], message=f"Stockpile {revision}", author=author
+        )
+
+    subprocess.run(["git", "read-tree", "HEAD"], cwd=str(stockpile_directory), check=True)
+    subprocess.run(["git", "update-index", "-q", "--refresh"], cwd=str(stockpile_directory), check=True)
+    subprocess.run(["git", "gc", "--quiet"], cwd=str(stockpile_directory), check=True)
+
+
+def commit_time(template: pathlib.Path, backend: str, args: Namespace, run: int) -> float:
+    """
+    Copy our template, rewrite some configs, and time committing them with a backend
+    :param template:
+    :param backend:
+    :param args:
+    :param run:
+    :return: Seconds
+    """
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        stockpile_directory = pathlib.Path(temp_dir) / "stockpile"
+        shutil.copytree(str(template), str(stockpile_directory), symlinks=True)
+        changed = random.Random(run).sample(host_names(count=args.files), k=min(args.changed, args.files))
+        rewrite_configs(
+            stockpile_directory=stockpile_directory, names=changed, size=args.config_size, revision=f"r{run}"
+        )
+
+        processor = ProcessStockpiles(commit_backend=backend)
+        task = Task(task=stockpile_device_config, stockpile_directory=stockpile_directory, proxies=None)
+        with contextlib.redirect_stdout(io.StringIO()):
+            processor.task_started(task)
+            for name in changed:
+                host = Host(name=name, hostname=name)
+                results = MultiResult(task.name)
+                stockpile_info = StockpileResults(name=f"{name}_backup", ip=name, hostname=name, backup_successful=True)
+                results.append(Result(host=host, result=stockpile_info))
+                processor.task_instance_completed(task, host, results)
+
+            start = time.perf_counter()
+            processor.task_completed(task, {})
+            elapsed = time.perf_counter() - start
+
+        if len(processor.changed_files) != len(changed):
+            raise ValueError(f"Expected {len(changed)} changed configs, found {len(processor.changed_files)}")
+        return elapsed
+
+
+def benchmark(args: Namespace) -> Dict[str, Dict[str, float]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        template = pathlib.Path(temp_dir) / "template"
+        start = time.perf_counter()
+        build_template(stockpile_directory=template, args=args)
+        print(f"Built a {args.files} config stockpile in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        for backend in BACKENDS:
+            times = [commit_time(template=template, backend=backend, args=args, run=run) for run in range(args.runs)]
+            results[backend] = {"median_seconds": statistics.median(times), "min_seconds": min(times)}
+    return results
+
+
+def arg_parsing() -> Namespace:
+    parser = ArgumentParser(description="Benchmark commit latency of each commit backend")
+    parser.add_argument("--files", type=int, default=20000, help="How many configs in the stockpile")
+    parser.add_argument("--changed", type=int, default=500, help="How many configs change in each commit")
+    parser.add_argument("--history", type=int, default=20, help="How many commits of history to build")
+    parser.add_argument("--config_size", type=int, default=4000, help="Approximate config size in bytes")
+    parser.add_argument("--runs", type=int, default=3, help="How many commits to time with each backend")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = arg_parsing()
+    results = benchmark(args=args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"Committing {args.changed} changed configs in a stockpile of {args.files} (median of {args.runs} runs):")
+    for backend, result in results.items():
+        print(f"  {backend:<12} {result['median_seconds']:.3f}s (min {result['min_seconds']:.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
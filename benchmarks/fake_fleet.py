@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+"""
+A simulated fleet of network devices for load testing Stockpiler, without pointing experiments at production gear.
+
+Every device is an in-process SSH server (on its own port) that answers `more system:running-config` and `write mem`
+with a Cisco-like prompt, fake ASAs also serve the ASDM style `/admin/exec/` HTTPS endpoint, and fake NX-OS devices
+serve NX-API (`/ins`, JSON-RPC with `cli_ascii`).  All devices run on
+one asyncio event loop in a background thread, with configurable response latency, config size, and failure rate.
+
+Requires the optional `async` dependencies (for asyncssh and aiohttp): `pip install stockpiler[async]`
+"""
+
+import asyncio
+import base64
+import datetime
+from logging import getLogger
+import random
+import ssl
+import tempfile
+import threading
+from typing import Dict, List, Optional
+from urllib.parse import unquote_plus
+
+
+import aiohttp.web
+import asyncssh
+
+
+logger = getLogger("stockpiler")
+
+USERNAME = "stockpiler"
+PASSWORD = "stockpiler"
+
+
+def generate_config(hostname: str, size: int) -> str:
+    """
+    Generate a Cisco-like running config of roughly the given size
+    :param hostname:
+    :param size: Approximate size in bytes
+    :return:
+    """
+
+    lines = [": Saved", "!", f"hostname {hostname}", "!"]
+    interface = 0
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.extend(
+            [
+                f"interface GigabitEthernet0/{interface}",
+                f" description {hostname} simulated interface {interface}",
+                f" ip address 10.{interface // 256 % 256}.{interface % 256}.1 255.255.255.0",
+                " no shutdown",
+                "!",
+            ]
+        )
+        interface += 1
+    lines.append("end")
+    return "\n".join(lines)
+
+
+class FakeDevice:
+    """
+    The behavior of one simulated device
+    """
+
+    def __init__(self, name: str, platform: str, config: str, latency: float, jitter: float, failing: bool) -> None:
+        """
+        Initialize our device
+        :param name: Hostname of the device, used in its prompt
+        :param platform: Netmiko platform, `cisco_ios`, `cisco_asa`, or `cisco_nxos`
+        :param config: The config to return for `more system:running-config`
+        :param latency: Seconds to wait before answering each command
+        :param jitter: Up to this many more seconds to wait, at random
+        :param failing: Reject our credentials, to simulate a broken device or AAA
+        """
+
+        self.name = name
+        self.platform = platform
+        self.config = config
+        self.latency = latency
+        self.jitter = jitter
+        self.failing = failing
+        self.ssh_port: Optional[int] = None
+        self.http_port: Optional[int] = None
+
+    async def respond(self, command: str) -> str:
+        """
+        Answer a command, after our simulated latency
+        :param command:
+        :return:
+        """
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if command in ("more system:running-config", "show running-config"):
+            return self.config
+        if command in ("write mem", "write memory", "copy running-config startup-config"):
+            return "Building configuration...\n[OK]"
+        return ""
+
+    async def handle_ssh(self, process: "asyncssh.SSHServerProcess") -> None:
+        """
+        Serve an interactive CLI session.  Like a real device, each command is echoed, answered, and followed by a new
+        prompt before the next is read (rather than echoing input as soon as it arrives).
+        :param process:
+        :return:
+        """
+
+        prompt = f"{self.name}#"
+        process.stdout.write(prompt)
+        try:
+            async for line in process.stdin:
+                command = line.strip()
+                output = await self.respond(command=command)
+                process.stdout.write(command + "\r\n")
+                if output:
+                    process.stdout.write(output.replace("\n", "\r\n") + "\r\n")
+                process.stdout.write(prompt)
+        except (asyncssh.BreakReceived, asyncssh.TerminalSizeChanged, asyncssh.ConnectionLost):
+            pass
+        process.exit(0)
+
+    async def handle_http(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        """
+        Serve the ASDM style `/admin/exec/<command>` endpoint
+        :param request:
+        :return:
+        """
+
+        expected = "Basic " + base64.b64encode(f"{USERNAME}:{PASSWORD}".encode()).decode()
+        if self.failing or request.headers.get("Authorization") != expected:
+            return aiohttp.web.Response(status=401, text="Unauthorized")
+        output = await self.respond(command=unquote_plus(request.match_info["command"]))
+        return aiohttp.web.Response(text=output)
+
+    async def handle_nxapi(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        """
+        Serve NX-API's JSON-RPC endpoint, answering `cli_ascii` calls with the text output of each command
+        :param request:
+        :return:
+        """
+
+        expected = "Basic " + base64.b64encode(f"{USERNAME}:{PASSWORD}".encode()).decode()
+        if self.failing or request.headers.get("Authorization") != expected:
+            return aiohttp.web.Response(status=401, text="Unauthorized")
+        payload = await request.json(content_type=None)
+        responses = []
+        for call in payload if isinstance(payload, list) else [payload]:
+            output = await self.respond(command=call["params"]["cmd"])
+            responses.append({"jsonrpc": "2.0", "result": {"msg": output}, "id": call["id"]})
+        # A single command's response isn't wrapped in a list, as on a real device
+        return aiohttp.web.json_response(
+            responses[0] if len(responses) == 1 else responses, content_type="application/json-rpc"
+        )
+
+
+class FakeFleet:
+    """
+    Start (and stop) a fleet of simulated devices, and describe them as a Nornir inventory.
+    """
+
+    def __init__(
+        self,
+        devices: int = 100,
+        asa_devices: int = 0,
+        nxos_devices: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        config_size: int = 20000,
+        failure_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        """
+        Initialize our fleet
+        :param devices: How many IOS-like devices to simulate
+        :param asa_devices: How many ASAs (with HTTPS management) to simulate
+        :param nxos_devices: How many NX-OS devices (with NX-API) to simulate
+        :param latency: Seconds each device waits before answering each command
+        :param jitter: Up to this many more seconds each device waits, at random
+        :param config_size: Approximate size of each device's config, in bytes
+        :param failure_rate: Fraction of devices (0-1) that reject our credentials
+        :param seed: Random seed, so the same devices fail on each run
+        """
+
+        chooser = random.Random(seed)
+        self.devices: List[FakeDevice] = []
+        for i in range(devices + asa_devices + nxos_devices):
+            if i >= devices + asa_devices:
+                name, platform = f"sim-nx{i:05d}", "cisco_nxos"
+            elif i >= devices:
+                name, platform = f"sim-fw{i:05d}", "cisco_asa"
+            else:
+                name, platform = f"sim-rtr{i:05d}", "cisco_ios"
+            self.devices.append(
+                FakeDevice(
+                    name=name,
+                    platform=platform,
+                    config=generate_config(hostname=name, size=config_size),
+                    latency=latency,
+                    jitter=jitter,
+                    failing=chooser.random() < failure_rate,
+                )
+            )
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.servers: list = []
+        self.runners: List[aiohttp.web.AppRunner] = []
+
+    def __enter__(self) -> "FakeFleet":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """
+        Start every device's servers on an event loop in a background thread, and wait until they're listening
+        :return:
+        """
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="fake-fleet", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        logger.info("Started a fake fleet of %s devices", len(self.devices))
+
+    async def _start(self) -> None:
+        host_key = asyncssh.generate_private_key("ssh-rsa")
+        ssl_context = self.ssl_context()
+
+        for device in self.devices:
+            server = await asyncssh.create_server(
+                lambda d=device: FakeSSHServer(device=d),
+                "127.0.0.1",
+                0,
+                server_host_keys=[host_key],
+                process_factory=device.handle_ssh,
+                line_editor=False,
+                backlog=1024,
+            )
+            device.ssh_port = server.sockets[0].getsockname()[1]
+            self.servers.append(server)
+
+            if device.platform in ("cisco_asa", "cisco_nxos"):
+                app = aiohttp.web.Application()
+                if device.platform == "cisco_asa":
+                    app.router.add_get("/admin/exec/{command}", device.handle_http)
+                else:
+                    app.router.add_post("/ins", device.handle_nxapi)
+                runner = aiohttp.web.AppRunner(app, access_log=None)
+                await runner.setup()
+                site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0, ssl_context=ssl_context, backlog=1024)
+                await site.start()
+                device.http_port = site._server.sockets[0].getsockname()[1]
+                self.runners.append(runner)
+
+    def stop(self) -> None:
+        """
+        Stop every device's servers and the event loop
+        :return:
+        """
+
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    async def _stop(self) -> None:
+        for server in self.servers:
+            server.close()
+        for runner in self.runners:
+            await runner.cleanup()
+        # Drop any sessions left open by clients that never disconnected
+        sessions = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for session in sessions:
+            session.cancel()
+        await asyncio.gather(*sessions, return_exceptions=True)
+
+    @staticmethod
+    def ssl_context() -> ssl.SSLContext:
+        """
+        A TLS context with a throwaway self-signed certificate, for the fake devices' HTTPS endpoints
+        :return:
+        """
+
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.x509.oid import NameOID
+
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "stockpiler-fake-fleet")])
+        now = datetime.datetime.utcnow()
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256())
+        )
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        with tempfile.NamedTemporaryFile() as cert_file, tempfile.NamedTemporaryFile() as key_file:
+            cert_file.write(certificate.public_bytes(serialization.Encoding.PEM))
+            key_file.write(
+                key.private_bytes(
+                    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+                )
+            )
+            cert_file.flush()
+            key_file.flush()
+            context.load_cert_chain(certfile=cert_file.name, keyfile=key_file.name)
+        return context
+
+    def inventory_hosts(self) -> Dict[str, dict]:
+        """
+        Our devices as a Nornir SimpleInventory hosts Dict
+        :return:
+        """
+
+        hosts = {}
+        for device in self.devices:
+            hosts[device.name] = {
+                "hostname": "127.0.0.1",
+                "port": device.ssh_port,
+                "platform": device.platform,
+                "username": USERNAME,
+                "password": PASSWORD,
+            }
+            if device.platform == "cisco_asa":
+                hosts[device.name]["data"] = {"http_management": True, "http_mgmt_port": device.http_port}
+            elif device.platform == "cisco_nxos":
+                hosts[device.name]["data"] = {"stockpile_api_port": device.http_port}
+        return hosts
+
+
+class FakeSSHServer(asyncssh.SSHServer):
+    """
+    Password authentication against our fake credentials, rejected by failing devices
+    """
+
+    def __init__(self, device: FakeDevice) -> None:
+        self.device = device
+
+    def begin_auth(self, username: str) -> bool:
+        return True
+
+    def password_auth_supported(self) -> bool:
+        return True
+
+    def validate_password(self, username: str, password: str) -> bool:
+        return not self.device.failing and (username, password) == (USERNAME, PASSWORD)
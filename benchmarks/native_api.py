@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark collecting NX-OS configs through NX-API against screen scraping them over SSH.
+
+A simulated fleet of `--devices` NX-OS devices (see benchmarks/fake_fleet.py) is stockpiled with each collection
+mode in turn, through `stockpile_device_config` and `ProcessStockpiles` exactly as `stockpiler --collection` would
+(see benchmarks/throughput.py), and the devices/second and per host times of each are reported side by side.  Run
+from the repository root, i.e.:
+
+    python benchmarks/native_api.py --devices 200 --latency 0.05 --config_size 200000 --num_workers 50
+
+Requires the optional `async` dependencies: `pip install stockpiler[async]`
+"""
+
+from argparse import ArgumentParser, Namespace
+import json
+import pathlib
+import sys
+from typing import Dict
+
+
+# Run from a checkout, rather than needing Stockpiler installed
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from benchmarks.throughput import benchmark  # noqa: E402
+
+
+COLLECTIONS = ["ssh", "api"]
+
+
+def compare(args: Namespace) -> Dict[str, Dict[str, float]]:
+    """
+    Stockpile a fresh fleet with each collection mode
+    :param args:
+    :return: A Dict of collection mode to its throughput results
+    """
+
+    results = {}
+    for collection in COLLECTIONS:
+        run_args = Namespace(
+            devices=0,
+            asa_devices=0,
+            nxos_devices=args.devices,
+            latency=args.latency,
+            jitter=args.jitter,
+            config_size=args.config_size,
+            failure_rate=0.0,
+            seed=args.seed,
+            num_workers=args.num_workers,
+            engine="nornir",
+            fast_cli=args.fast_cli,
+            collection=collection,
+        )
+        results[collection] = benchmark(args=run_args)
+    return results
+
+
+def arg_parsing() -> Namespace:
+    parser = ArgumentParser(description="Benchmark NX-API config collection against SSH")
+    parser.add_argument("--devices", type=int, default=100, help="How many NX-OS devices to simulate")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each device takes to answer a command")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more seconds, at random")
+    parser.add_argument("--config_size", type=int, default=20000, help="Approximate config size in bytes")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--num_workers", type=int, default=20, help="Nornir workers")
+    parser.add_argument("--fast_cli", action="store_true", help="Enable Netmiko's fast_cli mode for the SSH runs")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = arg_parsing()
+    results = compare(args=args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"\n{args.devices} NX-OS devices, {args.config_size} byte configs, {args.latency}s latency")
+    print(f"  {'collection':<12}{'devices/s':>12}{'p50 host':>12}{'p99 host':>12}{'failed':>8}")
+    for collection, result in results.items():
+        print(
+            f"  {collection:<12}{result['devices_per_second']:>12.1f}{result['p50_host_seconds']:>11.3f}s"
+            f"{result['p99_host_seconds']:>11.3f}s{result['failed']:>8}"
+        )
+    speedup = results["api"]["devices_per_second"] / max(results["ssh"]["devices_per_second"], 1e-9)
+    print(f"  NX-API is {speedup:.2f}x the throughput of SSH")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the start up (import) cost of Stockpiler's main entry points.
+
+Each measurement runs in a fresh interpreter, so nothing is already imported, and the median of several runs is
+reported.  Run from the repository root, i.e.:
+
+    python benchmarks/startup_time.py --runs 10
+"""
+
+from argparse import ArgumentParser, Namespace
+import json
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+
+# Modules imported by each entry point, and whole commands to time from process start to exit
+ENTRY_POINTS = [
+    "stockpiler.__main__",
+    "stockpiler.tasks.stockpile.stockpile_base",
+    "stockpiler.tasks.stockpile.stockpile_cisco",
+    "stockpiler.processors.process_stockpiles",
+    "nornir",
+]
+COMMANDS = {
+    "stockpiler --help": [sys.executable, "-m", "stockpiler", "--help"],
+}
+
+
+def import_time(module: str) -> float:
+    """
+    Import a module in a fresh interpreter and return its cumulative import time, as reported by `-X importtime`
+    :param module:
+    :return: Seconds
+    """
+
+    completed = subprocess.run(
+        [sys.executable, "-W", "ignore", "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        check=True,
+        universal_newlines=True,
+    )
+    # The last line reported is the module we asked for: `import time: self [us] | cumulative | imported package`
+    for line in reversed(completed.stderr.splitlines()):
+        if line.startswith("import time:") and line.rsplit("|", maxsplit=1)[-1].strip() == module:
+            return int(line.split("|")[1]) / 1_000_000
+    raise ValueError(f"Unable to find the import time of {module}")
+
+
+def command_time(command: List[str]) -> float:
+    """
+    Run a command and return how long it took to exit
+    :param command:
+    :return: Seconds
+    """
+
+    started = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - started
+
+
+def benchmark(runs: int) -> Dict[str, float]:
+    """
+    Measure every entry point and command
+    :param runs: How many times to measure each, reporting the median
+    :return: A Dict of entry point/command to its median time in seconds
+    """
+
+    results = {}
+    for module in ENTRY_POINTS:
+        results[f"import {module}"] = statistics.median(import_time(module=module) for _ in range(runs))
+    for name, command in COMMANDS.items():
+        results[name] = statistics.median(command_time(command=command) for _ in range(runs))
+    return results
+
+
+def arg_parsing() -> Namespace:
+    argparser = ArgumentParser(description="Benchmark Stockpiler start up time")
+    argparser.add_argument("--runs", type=int, default=5, help="Measurements of each entry point, default 5")
+    argparser.add_argument("--json", action="store_true", help="Output results as JSON, i.e. to track over time")
+    return argparser.parse_args()
+
+
+def main() -> None:
+    args = arg_parsing()
+    results = benchmark(runs=args.runs)
+    if args.json:
+        print(json.dumps({name: round(seconds * 1000, 1) for (name, seconds) in results.items()}, indent=2))
+        return
+    width = max(len(name) for name in results)
+    for name, seconds in results.items():
+        print(f"{name:<{width}}  {seconds * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
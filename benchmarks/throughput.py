@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark end to end stockpile throughput against a simulated fleet (see benchmarks/fake_fleet.py).
+
+The fleet runs in this process, and each device is stockpiled through `stockpile_device_config` and
+`ProcessStockpiles` exactly as `stockpiler` would, into a throwaway Git repository.  Reported are devices/second,
+median (p50) and p99 per host time, peak RSS of the whole process (fleet included, its own footprint is reported
+alongside), and the time taken by the final Git commit.  Run from the repository root, i.e.:
+
+    python benchmarks/throughput.py --devices 500 --asa_devices 50 --latency 0.05 --num_workers 100
+
+Requires the optional `async` dependencies: `pip install stockpiler[async]`
+"""
+
+from argparse import ArgumentParser, Namespace
+import json
+import os
+import pathlib
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+
+from nornir.core.inventory import Host
+from nornir.core.processor import Processor
+from nornir.core.task import AggregatedResult, MultiResult, Task
+import yaml
+
+
+# Run from a checkout, rather than needing Stockpiler installed
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from benchmarks.fake_fleet import FakeFleet  # noqa: E402
+from stockpiler.processors.process_stockpiles import ProcessStockpiles  # noqa: E402
+from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config  # noqa: E402
+
+
+class HostTimer(Processor):
+    """
+    Time each host's stockpile task, from dispatch to completion
+    """
+
+    def __init__(self) -> None:
+        self.started: Dict[str, float] = {}
+        self.elapsed: Dict[str, float] = {}
+        self.failed = 0
+
+    def task_started(self, task: Task) -> None:
+        pass
+
+    def task_completed(self, task: Task, result: AggregatedResult) -> None:
+        pass
+
+    def task_instance_started(self, task: Task, host: Host) -> None:
+        self.started[host.name] = time.perf_counter()
+
+    def task_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
+        self.elapsed[host.name] = time.perf_counter() - self.started[host.name]
+        self.failed += bool(result.failed)
+
+    def subtask_instance_started(self, task: Task, host: Host) -> None:
+        pass
+
+    def subtask_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
+        pass
+
+
+class TimedProcessStockpiles(ProcessStockpiles):
+    """
+    ProcessStockpiles, timing the end of the run (closing the report and the Git commit)
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.commit_time = 0.0
+
+    def task_completed(self, task: Task, result: AggregatedResult) -> None:
+        start = time.perf_counter()
+        super().task_completed(task, result)
+        self.commit_time = time.perf_counter() - start
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    The nearest rank percentile of some values
+    :param values:
+    :param percent: 0-100
+    :return:
+    """
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def raise_file_limit() -> None:
+    # Every device listens on its own socket, and every connection to one takes a descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def benchmark(args: Namespace) -> Dict[str, float]:
+    """
+    Start a fleet, stockpile every device in it, and measure how that went
+    :param args:
+    :return:
+    """
+
+    from nornir import InitNornir
+
+    raise_file_limit()
+    fleet = FakeFleet(
+        devices=args.devices,
+        asa_devices=args.asa_devices,
+        nxos_devices=args.nxos_devices,
+        latency=args.latency,
+        jitter=args.jitter,
+        config_size=args.config_size,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    with fleet, tempfile.TemporaryDirectory() as temp_dir:
+        fleet_rss = peak_rss_mb()
+        inventory_directory = pathlib.Path(temp_dir) / "inventory"
+        stockpile_directory = pathlib.Path(temp_dir) / "stockpile"
+        inventory_directory.mkdir()
+        stockpile_directory.mkdir()
+        (inventory_directory / "hosts.yml").write_text(yaml.safe_dump(fleet.inventory_hosts()))
+        defaults = {
+            "connection_options": {"netmiko": {"extras": {"fast_cli": args.fast_cli}}},
+            "data": {"stockpile_collection": args.collection},
+        }
+        (inventory_directory / "defaults.yml").write_text(yaml.safe_dump(defaults))
+
+        norns = InitNornir(
+            core={"num_workers": args.num_workers},
+            inventory={
+                "plugin": "nornir.plugins.inventory.simple.SimpleInventory",
+                "options": {
+                    "host_file": str(inventory_directory / "hosts.yml"),
+                    "group_file": "",
+                    "defaults_file": str(inventory_directory / "defaults.yml"),
+                },
+            },
+            logging={"enabled": False},
+            # Skip the packaged SSH config, which pins every host to port 22
+            ssh={"config_file": os.devnull},
+        )
+
+        timer = HostTimer()
+        processor = TimedProcessStockpiles()
+        start = time.perf_counter()
+        if args.engine == "async":
+            from stockpiler.runners.async_runner import AsyncStockpileRunner
+
+            AsyncStockpileRunner(norns=norns, processors=[timer, processor], max_in_flight=args.num_workers).run(
+                stockpile_directory=stockpile_directory
+            )
+        else:
+            norns.with_processors([timer, processor]).run(
+                task=stockpile_device_config, stockpile_directory=stockpile_directory, proxies=None
+            )
+        elapsed = time.perf_counter() - start
+        norns.close_connections()
+
+    host_times = list(timer.elapsed.values())
+    return {
+        "devices": len(fleet.devices),
+        "failed": timer.failed,
+        "elapsed_seconds": elapsed,
+        "devices_per_second": len(fleet.devices) / elapsed,
+        "p50_host_seconds": percentile(host_times, 50),
+        "p99_host_seconds": percentile(host_times, 99),
+        "mean_host_seconds": statistics.mean(host_times) if host_times else 0.0,
+        "commit_seconds": processor.commit_time,
+        "fleet_rss_mb": fleet_rss,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def arg_parsing() -> Namespace:
+    parser = ArgumentParser(description="Benchmark stockpile throughput against a simulated fleet")
+    parser.add_argument("--devices", type=int, default=100, help="How many IOS-like devices to simulate")
+    parser.add_argument("--asa_devices", type=int, default=0, help="How many HTTPS managed ASAs to simulate")
+    parser.add_argument("--nxos_devices", type=int, default=0, help="How many NX-OS devices (with NX-API) to simulate")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each device takes to answer a command")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more seconds, at random")
+    parser.add_argument("--config_size", type=int, default=20000, help="Approximate config size in bytes")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Fraction (0-1) of devices rejecting auth")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for which devices fail")
+    parser.add_argument("--num_workers", type=int, default=20, help="Nornir workers (or async in flight limit)")
+    parser.add_argument("--engine", choices=["nornir", "async"], default="nornir", help="Collection engine")
+    parser.add_argument("--fast_cli", action="store_true", help="Enable Netmiko's fast_cli mode")
+    parser.add_argument(
+        "--collection", choices=["ssh", "api"], default="ssh", help="Collect NX-OS configs over SSH or NX-API"
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = arg_parsing()
+    results = benchmark(args=args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"\n{results['devices']} devices ({results['failed']} failed) in {results['elapsed_seconds']:.2f}s")
+    print(f"  {results['devices_per_second']:.1f} devices/second")
+    print(f"  Per host: p50 {results['p50_host_seconds']:.3f}s, p99 {results['p99_host_seconds']:.3f}s")
+    print(f"  Git commit: {results['commit_seconds']:.3f}s")
+    print(f"  Peak RSS: {results['peak_rss_mb']:.0f}MB (of which the fleet {results['fleet_rss_mb']:.0f}MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,7 @@ Requires Python 3.7 or higher.
 
 """
 
-from argparse import ArgumentParser, Namespace
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
 import base64
 import binascii
 import getpass
@@ -18,20 +18,17 @@ from logging import getLogger
 import os
 import pathlib
 import sys
-from typing import Optional, Tuple
+from typing import Optional, Tuple, TYPE_CHECKING
 
 
-from nornir import InitNornir
-from nornir.core import Nornir
-from nornir.core.inventory import ConnectionOptions
-from nornir.plugins.processors.print_result import PrintResult
-from nornir.plugins.tasks.networking import netmiko_send_command, netmiko_send_config
-from yaml import safe_load
-from yaml.constructor import ConstructorError
+# Nornir (and everything it registers, i.e. NAPALM) and our collection engines are imported as each is needed, so
+# `--help`, argument errors, and single device runs don't pay to import every engine and platform.
+if TYPE_CHECKING:  # pragma: no cover
+    from nornir.core import Nornir
 
-
-from stockpiler.processors.process_stockpiles import ProcessStockpiles
-from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+    from stockpiler.history import HistoryIndex
+    from stockpiler.processors.process_stockpiles import ProcessStockpiles
+    from stockpiler.runners.save_config import DeferredSaveConfig
 
 
 logger = getLogger("stockpiler")
@@ -45,6 +42,11 @@ def main() -> None:
     # Parse Arguments
     args = arg_parsing()
 
+    # Our backup history is answered from the stockpile alone, without inventory or credentials
+    if args.action == "history":
+        history(args=args)
+        sys.exit()
+
     # Begin Nornir setup
     norns = nornir_initialize(args=args)
 
@@ -54,25 +56,353 @@ def main() -> None:
 
     # Run our desired task
     if args.command:
+        from nornir.plugins.processors.print_result import PrintResult
+        from nornir.plugins.tasks.networking import netmiko_send_command
+
         command_targets = filtered_norns.with_processors(processors=[PrintResult()])
         command_targets.run(task=netmiko_send_command, command_string=args.command)
 
     elif args.config:
+        from nornir.plugins.processors.print_result import PrintResult
+        from nornir.plugins.tasks.networking import netmiko_send_config
+
         config_targets = filtered_norns.with_processors(processors=[PrintResult()])
         config_targets.run(task=netmiko_send_config, config_commands=args.config.split(";"))
     else:
         # Default task will be to backup devices (if none provided)
-        proxies = None
-        if args.proxy:
-            proxies = {"https": f"socks5://{args.proxy}", "http": f"socks5://{args.proxy}"}
-        stockpile_directory = pathlib.Path(args.output or "/opt/stockpiler/")
+        stockpile(args=args, norns=filtered_norns)
+
+    sys.exit()
+
+
+def stockpile(args: Namespace, norns: "Nornir") -> None:
+    """
+    Stockpile the configurations of our (filtered) inventory, once or as a daemon, with the engine chosen in args.
+    :param args: The populated Namespace object returned by argparser.parse_args()
+    :param norns: An instantiated (and likely filtered) Nornir object, with credentials already set
+    :return:
+    """
+
+    proxies = configure_proxies(args=args)
+    stockpile_directory = pathlib.Path(args.output or "/opt/stockpiler/")
+    metrics_directory = pathlib.Path(args.metrics_dir) if args.metrics_dir else None
+    apply_stockpile_options(args=args, norns=norns)
+    deferred_save = prepare_engine(args=args, norns=norns, proxies=proxies)
+
+    if args.action == "serve":
+        from stockpiler.runners.daemon import StockpileDaemon
+
+        daemon = StockpileDaemon(
+            norns=norns,
+            stockpile_directory=stockpile_directory,
+            proxies=proxies,
+            interval=args.interval,
+            pool_size=args.connection_pool_size,
+            preflight=args.preflight,
+            preflight_workers=args.preflight_workers,
+            metrics_directory=metrics_directory,
+            commit_backend=args.commit_backend,
+            deferred_save=deferred_save,
+        )
+        daemon.serve()
+        sys.exit()
+
+    norns, resumed, unreachable = select_devices(
+        args=args, norns=norns, stockpile_directory=stockpile_directory, proxies=proxies
+    )
+
+    from stockpiler.processors.process_stockpiles import ProcessStockpiles
+
+    # Executing stockpile of device configurations:
+    processor = ProcessStockpiles(
+        unreachable=unreachable,
+        metrics_directory=metrics_directory,
+        commit_backend=args.commit_backend,
+        resumed=resumed,
+        deferred_save=deferred_save,
+    )
+    dispatch_stockpile(
+        args=args, norns=norns, stockpile_directory=stockpile_directory, proxies=proxies, processor=processor
+    )
+
+
+def configure_proxies(args: Namespace) -> Optional[dict]:
+    """
+    Set up our pool of SOCKS proxies, if we were given any
+    :param args: The populated Namespace object returned by argparser.parse_args()
+    :return: The proxies Dict of the first proxy (what engines taking a single proxy, i.e. async, use), or None
+    """
+
+    if not args.proxy:
+        return None
+
+    from stockpiler.tasks.stockpile.proxy_pool import Proxies, ProxyEndpoint
+
+    # Hosts lease a proxy from the pool, the first is what engines taking a single proxy (i.e. async) use
+    Proxies.configure(
+        endpoints=[ProxyEndpoint.parse(value) for value in args.proxy],
+        strategy=args.proxy_strategy,
+        ssh=args.proxy_ssh,
+    )
+    return Proxies.endpoints[0].proxies
+
+
+def apply_stockpile_options(args: Namespace, norns: "Nornir") -> None:
+    """
+    Apply our stockpile options to every device, as inventory defaults (so devices, and their groups, can still set
+    their own), and set the run's deadline
+    :param args: The populated Namespace object returned by argparser.parse_args()
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :return:
+    """
+
+    if args.skip_unchanged:
+        norns.inventory.defaults.data["stockpile_skip_unchanged"] = True
+    if args.save_config:
+        norns.inventory.defaults.data["stockpile_save_config"] = args.save_config
+    if args.layout:
+        norns.inventory.defaults.data["stockpile_layout"] = args.layout
+    if args.collection:
+        norns.inventory.defaults.data["stockpile_collection"] = args.collection
+    if args.transfer:
+        norns.inventory.defaults.data["stockpile_transfer"] = args.transfer
+    if args.transfer_protocol:
+        norns.inventory.defaults.data["stockpile_transfer_protocol"] = args.transfer_protocol
+    if args.adaptive_cadence:
+        norns.inventory.defaults.data.setdefault("stockpile_cadence", "adaptive")
+    if args.deadline is not None:
+        from stockpiler.runners.scheduling import set_deadline
+
+        # The budget counts from the start of the run, pre-flight sweep included
+        set_deadline(norns=norns, budget=args.deadline)
+
+
+def prepare_engine(args: Namespace, norns: "Nornir", proxies: Optional[dict]) -> Optional["DeferredSaveConfig"]:
+    """
+    Import the stockpile tasks our engine will run, and set up our deferred save config phase if it runs one
+    :param args: The populated Namespace object returned by argparser.parse_args()
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: Our deferred save config phase (see stockpiler.runners.save_config), or None
+    """
+
+    from stockpiler.tasks.stockpile.stockpile_base import StockpileMap
+
+    # Import the stockpile tasks for just the platforms we're backing up, before any workers start
+    if not args.coordinator and args.engine == "nornir":
+        StockpileMap.preload(platforms=(h.platform for h in norns.inventory.hosts.values()))
+
+    # Configs left to be saved after the backups are saved from here, so not by the coordinator (or async engine)
+    if args.coordinator or args.worker or args.engine != "nornir":
+        return None
+
+    from stockpiler.runners.save_config import DeferredSaveConfig
+
+    return DeferredSaveConfig(norns=norns, workers=args.save_config_workers, proxies=proxies)
+
+
+def select_devices(
+    args: Namespace, norns: "Nornir", stockpile_directory: pathlib.Path, proxies: Optional[dict]
+) -> Tuple["Nornir", dict, list]:
+    """
+    Narrow our inventory down to the devices this run backs up, and the order to dispatch them in
+    :param args: The populated Namespace object returned by argparser.parse_args()
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: A Tuple of the Nornir object to dispatch, the checkpoint journal entries of devices carried over from an
+        interrupted run, and StockpileResults of the devices our pre-flight sweep found unreachable
+    """
+
+    # Carry over the devices an interrupted run already backed up (its journal is kept where we commit)
+    resumed = {}
+    if args.resume and not args.worker:
+        from stockpiler.checkpoint import resume_checkpoint
+
+        norns, resumed = resume_checkpoint(norns=norns, stockpile_directory=stockpile_directory, window=args.resume)
+
+    # Back up only the devices due under their cadence policy (our history is kept where we commit, not on workers)
+    if not args.force_all and not args.worker:
+        from stockpiler.runners.cadence import select_due
+
+        norns = select_due(norns=norns, stockpile_directory=stockpile_directory)
+
+    # The coordinator dispatches nothing itself, and workers only sweep their shard once it's assigned (see
+    # stockpiler.runners.distributed), reachability is only meaningful from where the backups run
+    unreachable = []
+    if args.preflight and not args.coordinator and not args.worker:
+        from stockpiler.runners.reachability import reachability_sweep
+
+        # Check reachability of the whole fleet up front, so only reachable hosts take up a worker
+        norns, unreachable = reachability_sweep(norns=norns, proxies=proxies, max_in_flight=args.preflight_workers)
+
+    # Dispatch the devices expected to take longest first, so they aren't left holding up the end of the run
+    if not args.coordinator and not args.worker:
+        norns = schedule_longest_first(norns=norns, stockpile_directory=stockpile_directory)
+
+    return norns, resumed, unreachable
+
+
+def schedule_longest_first(norns: "Nornir", stockpile_directory: pathlib.Path) -> "Nornir":
+    """
+    Order our inventory by how long each device took in previous runs, longest first (see
+    stockpiler.runners.scheduling), if our stockpile has a history index to tell us
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :return:
+    """
+
+    import sqlite3
 
-        stockpile_targets = filtered_norns.with_processors(processors=[ProcessStockpiles()])
+    from stockpiler.history import HistoryIndex
+    from stockpiler.runners.scheduling import longest_first
 
-        # Executing stockpile of device configurations:
+    try:
+        index = HistoryIndex(stockpile_directory=stockpile_directory, create=False)
+        durations = index.expected_durations()
+        index.close()
+    except (OSError, sqlite3.Error) as e:
+        logger.info("Dispatching devices in inventory order, without their durations from previous runs: %s", e)
+        durations = {}
+    return longest_first(norns=norns, durations=durations)
+
+
+def dispatch_stockpile(
+    args: Namespace,
+    norns: "Nornir",
+    stockpile_directory: pathlib.Path,
+    proxies: Optional[dict],
+    processor: "ProcessStockpiles",
+) -> None:
+    """
+    Hand our stockpile to the collection engine chosen in args
+    :param args: The populated Namespace object returned by argparser.parse_args()
+    :param norns: An instantiated (and likely filtered) Nornir object, with credentials already set
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :param processor: Our ProcessStockpiles processor, to report and commit the results
+    :return:
+    """
+
+    from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+
+    if args.worker:
+        from stockpiler.runners.distributed import DistributedWorker, parse_address
+
+        worker = DistributedWorker(
+            norns=norns,
+            address=parse_address(args.worker),
+            authkey=gather_authkey(),
+            shard=args.shard,
+            preflight=args.preflight,
+            preflight_workers=args.preflight_workers,
+        )
+        worker.run(proxies=proxies)
+    elif args.coordinator:
+        from stockpiler.runners.distributed import DistributedCoordinator, parse_address
+
+        coordinator = DistributedCoordinator(
+            norns=norns,
+            address=parse_address(args.coordinator),
+            authkey=gather_authkey(),
+            processors=[processor],
+            shards=args.shards,
+            shard_by=args.shard_by,
+        )
+        coordinator.run(stockpile_directory=stockpile_directory, proxies=proxies)
+    elif args.engine == "async":
+        from stockpiler.runners.async_runner import AsyncStockpileRunner
+
+        runner = AsyncStockpileRunner(
+            norns=norns,
+            processors=[processor],
+            max_in_flight=args.async_workers,
+        )
+        runner.run(stockpile_directory=stockpile_directory, proxies=proxies)
+    elif args.processes > 1:
+        from stockpiler.runners.multiprocess import MultiProcessStockpileRunner
+
+        runner = MultiProcessStockpileRunner(
+            norns=norns,
+            processors=[processor],
+            processes=args.processes,
+        )
+        runner.run(stockpile_directory=stockpile_directory, proxies=proxies)
+    else:
+        stockpile_targets = norns.with_processors(processors=[processor])
         stockpile_targets.run(task=stockpile_device_config, proxies=proxies, stockpile_directory=stockpile_directory)
 
-    sys.exit()
+
+def history(args: Namespace) -> None:
+    """
+    Answer questions about our stockpile's backup history from its history index (see stockpiler.history): the
+    devices whose config changed since a point in time, and the latest state and recent backups of given devices,
+    or without either, the latest state of every device.
+    :param args: The populated Namespace object returned by argparser.parse_args()
+    :return:
+    """
+
+    from stockpiler.history import HistoryIndex, parse_since
+
+    stockpile_directory = pathlib.Path(args.output or "/opt/stockpiler/")
+    try:
+        index = HistoryIndex(stockpile_directory=stockpile_directory, create=False)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.changed_since:
+        try:
+            since = parse_since(args.changed_since)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        changed = index.changed_since(since=since)
+        print(f"{len(changed)} device(s) changed since {since.isoformat()}:")
+        for host_name, last_changed in changed:
+            print(f"  - {host_name}: {last_changed}")
+
+    for host_name in args.device or []:
+        print_device_history(index=index, host_name=host_name, limit=args.limit, changed_only=args.changed_only)
+
+    if not args.changed_since and not args.device:
+        for host_name, last_successful_backup in sorted(index.last_successful_backups().items()):
+            print(f"  - {host_name}: last successful backup {last_successful_backup}")
+    index.close()
+
+
+def print_device_history(index: "HistoryIndex", host_name: str, limit: int, changed_only: bool) -> None:
+    """
+    Print the latest state of a device from our history index, and its most recent backups
+    :param index: Our stockpile's HistoryIndex
+    :param host_name: The inventory name of the device
+    :param limit: How many recent backups to print
+    :param changed_only: Only print backups where its config changed
+    :return:
+    """
+
+    device = index.device(host=host_name)
+    if device is None:
+        print(f"{host_name}: no backups recorded")
+        return
+    print(
+        f"{host_name}: last attempt {device['last_attempt']}, last successful backup"
+        f" {device['last_successful_backup']}, last changed {device['last_changed']}"
+    )
+    from stockpiler.history import API_NAMES
+
+    for backup in index.device_history(host=host_name, limit=limit, changed_only=changed_only):
+        outcome = "Successful" if backup["backup_successful"] else "Failed"
+        if backup["skip_reason"]:
+            outcome += f" (skipped, {backup['skip_reason']})"
+        if backup["api_used"]:
+            connection = API_NAMES.get(backup["api_used"], backup["api_used"])
+        else:
+            connection = "HTTP" if backup["http_used"] else "SSH" if backup["ssh_used"] else "not connected"
+        print(
+            f"  - {backup['completed']}: {outcome}{', changed' if backup['changed'] else ''}, {connection}"
+            f", {backup['size'] or 0} bytes, blob {backup['blob']}, commit {backup['commit_sha']}"
+        )
 
 
 def arg_parsing() -> Namespace:
@@ -82,6 +412,14 @@ def arg_parsing() -> Namespace:
     """
 
     argparser = ArgumentParser(description="Stockpile Network Device Backups")
+    argparser.add_argument(
+        "action",
+        nargs="?",
+        choices=["backup", "serve", "history"],
+        default="backup",
+        help="`backup` once (the default), `serve` as a daemon running backups on a schedule, or look up the"
+        " `history` of our backups",
+    )
     argparser.add_argument(
         "-i", "--inventory", type=str, help="Provide a specific inventory file, default '/etc/stockpiler/hosts.yaml'"
     )
@@ -94,7 +432,23 @@ def arg_parsing() -> Namespace:
     argparser.add_argument(
         "-o", "--output", type=str, help="Provide an output directory for our stockpile, default '/opt/stockpiler'"
     )
-    argparser.add_argument("-p", "--proxy", type=str, help="'host:port' for a Socks Proxy to use for connectivity.")
+    argparser.add_argument(
+        "-p",
+        "--proxy",
+        type=str,
+        action="append",
+        help="'host:port' of a SOCKS5 proxy to use for HTTPS management (and with --proxy_ssh, SSH), optionally with"
+        " the site it serves as 'host:port@site'.  Repeat it for each proxy, each device leases a healthy one.",
+    )
+    argparser.add_argument(
+        "--proxy_strategy",
+        choices=["least_connections", "site"],
+        default="least_connections",
+        help="Lease each device the proxy with the fewest devices using it (the default), or prefer those of its site",
+    )
+    argparser.add_argument(
+        "--proxy_ssh", action="store_true", help="Send SSH sessions through our proxies too (requires --proxy)"
+    )
     argparser.add_argument(
         "--credential_prompt",
         action="store_true",
@@ -113,7 +467,22 @@ def arg_parsing() -> Namespace:
         action="store_true",
         help="Utilize the Credential information in the configured Nornir Inventory.",
     )
-    argparser.add_argument("-a", "--addresses", type=str, nargs="+", help="1 (or more) IP Address, space separated.")
+    add_engine_arguments(argparser=argparser)
+    add_backup_arguments(argparser=argparser)
+    add_serve_arguments(argparser=argparser)
+    add_history_arguments(argparser=argparser)
+    argparser.add_argument(
+        "-a",
+        "--addresses",
+        type=address_filter,
+        action="append",
+        help="An IP Address (or hostname, or CIDR network, i.e. 10.0.0.0/24), repeat it for each.",
+    )
+    argparser.add_argument("--group", type=str, action="append", help="An inventory group, repeat it for each.")
+    argparser.add_argument("--platform", type=str, action="append", help="A Netmiko platform, repeat it for each.")
+    argparser.add_argument(
+        "--site", type=str, action="append", help="A site (from each device's `site` data), repeat it for each."
+    )
     command_group = argparser.add_argument_group("command/config")
     command_group.add_argument("--command", type=str, help="1 command to execute on the selected devices.")
     command_group.add_argument(
@@ -135,16 +504,323 @@ def arg_parsing() -> Namespace:
         help="output logs to specified directory, default is /var/log/stockpiler/",
     )
 
-    return argparser.parse_args()
+    args = argparser.parse_args()
+    validate_engine_args(argparser=argparser, args=args)
+    validate_run_args(argparser=argparser, args=args)
+
+    return args
+
+
+def add_engine_arguments(argparser: ArgumentParser) -> None:
+    """
+    Add the arguments choosing our collection engine, and distributing collection, to our parser
+    :param argparser:
+    :return:
+    """
+
+    argparser.add_argument(
+        "--engine",
+        choices=["nornir", "async"],
+        default="nornir",
+        help="Collection engine for backups, `async` runs every session on one event loop (requires stockpiler[async])",
+    )
+    argparser.add_argument(
+        "--async_workers",
+        type=int,
+        default=1000,
+        help="Maximum number of devices in flight at once with the async engine, default 1000",
+    )
+    argparser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Partition the devices across this many worker processes, each with its own Nornir thread pool"
+        " (nornir engine only), default 1",
+    )
+    distributed_group = argparser.add_argument_group("distributed")
+    distributed_group.add_argument(
+        "--coordinator",
+        type=str,
+        help="'host:port' to listen on as a coordinator, handing shards of the inventory out to workers and"
+        " committing their results.  Requires the STOCKPILER_AUTHKEY environment variable.",
+    )
+    distributed_group.add_argument(
+        "--shards", type=int, default=2, help="How many shards the coordinator splits the inventory into, default 2"
+    )
+    distributed_group.add_argument(
+        "--shard_by",
+        choices=["hash", "group", "site"],
+        default="hash",
+        help="Split the inventory by a hash of each device name, or keep devices of a group or site together",
+    )
+    distributed_group.add_argument(
+        "--worker",
+        type=str,
+        help="'host:port' of a coordinator to stockpile a shard of the inventory for."
+        " Requires the STOCKPILER_AUTHKEY environment variable.",
+    )
+    distributed_group.add_argument(
+        "--shard", type=int, help="As a worker, ask the coordinator for this shard rather than the next available"
+    )
+
+
+def add_backup_arguments(argparser: ArgumentParser) -> None:
+    """
+    Add the arguments controlling how (and which) devices are backed up, and how our stockpile is kept, to our parser
+    :param argparser:
+    :return:
+    """
+
+    argparser.add_argument(
+        "--skip_unchanged",
+        action="store_true",
+        help="Ask each device for a cheap change marker (i.e. its config checksum) first, and skip the full backup if"
+        " it hasn't changed since the last backup (nornir engine only).  Also set per device in the inventory with"
+        " `stockpile_skip_unchanged`.",
+    )
+    argparser.add_argument(
+        "--save_config",
+        choices=["inline", "deferred", "changed", "off"],
+        help="When to save each device's running config: as part of its backup (`inline`, the default), after every"
+        " backup has finished (`deferred`), only then if its config changed since the last stockpile (`changed`), or"
+        " not at all (`off`).  Also set per device in the inventory with `stockpile_save_config` (nornir engine only).",
+    )
+    argparser.add_argument(
+        "--save_config_workers",
+        type=int,
+        default=10,
+        help="Maximum number of devices saving their config at once after the backups, default 10",
+    )
+    argparser.add_argument(
+        "--preflight",
+        action="store_true",
+        help="Check the management ports of every device in one sweep before dispatching backups,"
+        " so unreachable devices don't take up a worker.",
+    )
+    argparser.add_argument(
+        "--preflight_workers",
+        type=int,
+        default=512,
+        help="Maximum concurrent connection attempts in the pre-flight sweep (keep below your open file limit),"
+        " default 512",
+    )
+    argparser.add_argument(
+        "--metrics_dir",
+        type=str,
+        help="Write the time spent in each phase of the run (connecting, backup, commit, etc.) to this directory,"
+        " as a Prometheus textfile (`stockpiler.prom`) and a JSON summary (`stockpiler_summary.json`)",
+    )
+    argparser.add_argument(
+        "--commit_backend",
+        choices=["index", "fast-import"],
+        default="index",
+        help="Commit through the stockpile repository's index (the default), or stream changed configs straight into"
+        " `git fast-import`, which doesn't read or write the index and is much faster for very large stockpiles",
+    )
+    argparser.add_argument(
+        "--layout",
+        choices=["flat", "site", "platform", "hash"],
+        help="Keep configs in the stockpile's top directory (`flat`, the default), or in a directory per device `site`,"
+        " `platform`, or `hash` prefix of its name, for very large stockpiles.  Also set per device in the inventory"
+        " with `stockpile_layout`, configs are moved when their layout changes.",
+    )
+    argparser.add_argument(
+        "--collection",
+        choices=["ssh", "api"],
+        help="Collect NX-OS, EOS, and IOS-XE configs over SSH (the default) or through their native API (NX-API,"
+        " eAPI, or NETCONF), falling back to SSH if it fails.  Also set per device in the inventory with"
+        " `stockpile_collection`, and the API's port with `stockpile_api_port`.",
+    )
+    argparser.add_argument(
+        "--transfer",
+        choices=["running-config", "startup-config", "off"],
+        help="Back up devices by copying their running (or startup) config to a file on the device and transferring"
+        " that straight into the stockpile, rather than reading it through the shell, for very large configs.  Also"
+        " set per device (or group) in the inventory with `stockpile_transfer`.",
+    )
+    argparser.add_argument(
+        "--transfer_protocol",
+        choices=["scp", "sftp"],
+        help="Transfer configs with SCP (the default) or SFTP, also set in the inventory with"
+        " `stockpile_transfer_protocol`",
+    )
+    argparser.add_argument(
+        "--adaptive_cadence",
+        action="store_true",
+        help="Only back up devices that are due, by how often their config has changed recently, so backups can run"
+        " often (i.e. hourly) without pulling every device each time.  Also set per group (or device) in the"
+        " inventory with `stockpile_cadence`, see stockpiler/runners/cadence.py.",
+    )
+    argparser.add_argument(
+        "--force_all",
+        action="store_true",
+        help="Back up every device this run, whether or not it is due under its cadence",
+    )
+    argparser.add_argument(
+        "--deadline",
+        type=float,
+        help="Seconds the run has to finish in.  Devices that can't be expected to finish in time (by how long they"
+        " took in previous runs) aren't started, and are reported as `deferred` in results.csv (nornir engine only).",
+    )
+    argparser.add_argument(
+        "--resume",
+        nargs="?",
+        const="12h",
+        type=resume_window,
+        metavar="WINDOW",
+        help="Resume an interrupted run: devices it already backed up within WINDOW (i.e. `12h`, the default, or an"
+        " ISO 8601 date/time in UTC) are carried over rather than backed up again, then committed with the rest",
+    )
+
+
+def add_serve_arguments(argparser: ArgumentParser) -> None:
+    """
+    Add the arguments of `serve` to our parser
+    :param argparser:
+    :return:
+    """
+
+    daemon_group = argparser.add_argument_group("serve")
+    daemon_group.add_argument(
+        "--interval",
+        type=float,
+        default=43200,
+        help="Seconds between backups of each device when serving, default 43200 (12 hours)."
+        " Devices may set their own `stockpile_interval` in the inventory.",
+    )
+    daemon_group.add_argument(
+        "--connection_pool_size",
+        type=int,
+        default=100,
+        help="Maximum number of frequently polled devices (a `stockpile_interval` below --interval) to keep"
+        " connections open to between backups when serving, default 100",
+    )
+
+
+def add_history_arguments(argparser: ArgumentParser) -> None:
+    """
+    Add the arguments of `history` to our parser
+    :param argparser:
+    :return:
+    """
+
+    history_group = argparser.add_argument_group("history")
+    history_group.add_argument(
+        "--device",
+        type=str,
+        action="append",
+        help="A device (inventory name) to show recent backups of, repeat it for each",
+    )
+    history_group.add_argument(
+        "--changed_since",
+        type=str,
+        help="List the devices whose config changed since then, relative (i.e. `7d`, `12h`) or an ISO 8601 UTC time",
+    )
+    history_group.add_argument(
+        "--changed_only", action="store_true", help="Only show backups where the device's config changed"
+    )
+    history_group.add_argument(
+        "--limit", type=int, default=10, help="How many recent backups to show of each device, default 10"
+    )
+
 
+def address_filter(value: str) -> str:
+    """
+    Check an --addresses value that looks like a CIDR network is one (hostnames and IP addresses are taken as given)
+    :param value:
+    :return:
+    """
+
+    if "/" in value:
+        import ipaddress
+
+        try:
+            ipaddress.ip_network(value, strict=False)
+        except ValueError as e:
+            raise ArgumentTypeError(str(e))
+    return value
 
-def nornir_initialize(args: Namespace) -> Nornir:
+
+def resume_window(value: str) -> str:
+    """
+    Check a --resume window is one we can parse (see stockpiler.history.parse_since)
+    :param value:
+    :return:
+    """
+
+    from stockpiler.history import parse_since
+
+    try:
+        parse_since(value)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+    return value
+
+
+def validate_engine_args(argparser: ArgumentParser, args: Namespace) -> None:
+    """
+    Exit with an error if we were given options our chosen engine (or proxies) doesn't support
+    :param argparser:
+    :param args: The populated Namespace object returned by argparser.parse_args()
+    :return:
+    """
+
+    if args.processes > 1 and args.engine != "nornir":
+        argparser.error("--processes is only supported with the nornir engine")
+    if args.skip_unchanged and args.engine != "nornir":
+        argparser.error("--skip_unchanged is only supported with the nornir engine")
+    if args.save_config not in (None, "inline") and args.engine != "nornir":
+        argparser.error("--save_config is only supported with the nornir engine")
+    if args.collection == "api" and args.engine != "nornir":
+        argparser.error("--collection api is only supported with the nornir engine")
+    if args.transfer not in (None, "off") and args.engine != "nornir":
+        argparser.error("--transfer is only supported with the nornir engine")
+    if args.deadline is not None and args.engine != "nornir":
+        argparser.error("--deadline is only supported with the nornir engine")
+    if (args.proxy_ssh or len(args.proxy or []) > 1) and args.engine != "nornir":
+        argparser.error("A pool of proxies (or SSH through them) is only supported with the nornir engine")
+
+
+def validate_run_args(argparser: ArgumentParser, args: Namespace) -> None:
+    """
+    Exit with an error if we were given options that don't go together with our action, or distributed role
+    :param argparser:
+    :param args: The populated Namespace object returned by argparser.parse_args()
+    :return:
+    """
+
+    if args.save_config in ("deferred", "changed") and (args.coordinator or args.worker):
+        argparser.error("Distributed collection saves configs inline (or with `off`, not at all)")
+    if args.proxy_ssh and not args.proxy:
+        argparser.error("--proxy_ssh requires --proxy")
+    if args.proxy_ssh and args.preflight:
+        argparser.error("--preflight can't check management ports behind a proxy, drop it with --proxy_ssh")
+    if args.coordinator and args.worker:
+        argparser.error("--coordinator and --worker are mutually exclusive")
+    if args.action == "serve" and (
+        args.command or args.config or args.coordinator or args.worker or args.engine != "nornir" or args.processes > 1
+    ):
+        argparser.error("serve only runs scheduled backups, with the nornir engine")
+    if args.action == "serve" and args.resume:
+        argparser.error("serve doesn't resume interrupted runs, each scheduled backup is committed as it completes")
+    if args.resume and args.worker:
+        argparser.error("--resume is given to the coordinator, which keeps the checkpoint journal")
+    if args.action == "serve" and args.adaptive_cadence:
+        argparser.error("serve schedules each device by its --interval (or `stockpile_interval`), not its cadence")
+
+
+def nornir_initialize(args: Namespace) -> "Nornir":
     """
     Given the parsed argument Namespace object, initialize a Nornir inventory/execution object and return it.
     :param args: A parsed/instantiated argpase.Namespace object with our command line arguments
     :return:
     """
 
+    from nornir import InitNornir
+    from nornir.core.inventory import ConnectionOptions
+    from yaml import safe_load
+    from yaml.constructor import ConstructorError
+
     log_file = pathlib.Path(pathlib.Path(args.logging_dir) / "stockpiler.log")
 
     # A directory in the path doesn't exist, this can happen with the default logging path of `/var/log/stockpiler/`
@@ -284,25 +960,44 @@ def gather_credentials(
     return username, password, enable
 
 
-def filtering(args: Namespace, norns: Nornir) -> Nornir:
+def gather_authkey() -> bytes:
+    """
+    Gather the key shared between a distributed coordinator and its workers from the environment.
+    :return:
+    """
+
+    authkey = os.environ.get("STOCKPILER_AUTHKEY", None)
+    if not authkey:
+        raise OSError("No STOCKPILER_AUTHKEY has been provided for distributed collection!")
+    return authkey.encode()
+
+
+def filtering(args: Namespace, norns: "Nornir") -> "Nornir":
     """
-    Provide inventory filtering based on attributes from args.
+    Provide inventory filtering based on attributes from args.  Hosts are selected by index lookups (see
+    stockpiler.inventory.index), and must match every filter given.
 
     :param args: The populated Namespace object returned by argparser.parse_args()
     :param norns: An instantiated Nornir object with our full inventory for filtering
     :return:
     """
 
-    print("Filtering Target Hosts")
+    from nornir.core import Nornir
 
-    def is_cli_selected_host(host):
-        return host.hostname in args.addresses
+    from stockpiler.inventory.index import host_index, indexed_inventory
 
-    if args.addresses:
-        return norns.filter(filter_func=is_cli_selected_host)
-    else:
+    print("Filtering Target Hosts")
+
+    selected = host_index(inventory=norns.inventory).select(
+        addresses=args.addresses, groups=args.group, platforms=args.platform, sites=args.site
+    )
+    if selected is None:
         return norns
 
+    filtered_norns = Nornir(**norns.__dict__)
+    filtered_norns.inventory = indexed_inventory(inventory=norns.inventory, host_names=selected)
+    return filtered_norns
+
 
 if __name__ == "__main__":
     main()
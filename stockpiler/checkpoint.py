@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+A checkpoint journal of the hosts a run has completed, so a run that's interrupted (killed, out of memory, a reboot)
+can be resumed rather than started again from the first host.
+
+`ProcessStockpiles` appends a line of JSON to the journal as each host completes, with its results and the blob hash
+of the config it wrote, and removes the journal once the run has made its commit.  If a run never gets that far,
+`stockpiler --resume` carries over the hosts it already backed up successfully (within a freshness window, and whose
+config file still holds what they wrote), backs up only the rest, and commits them all together.
+
+The journal lives in the stockpile's `.stockpiler` state directory, which is excluded from the Git repository.
+"""
+
+import datetime
+import json
+from logging import getLogger
+import os
+import pathlib
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+
+from nornir.core import Nornir
+
+
+from stockpiler.history import parse_since
+from stockpiler.inventory.index import indexed_inventory
+from stockpiler.tasks.stockpile.change_markers import state_directory
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+logger = getLogger("stockpiler")
+
+JOURNAL_FILE = "journal.jsonl"
+
+# How recently a host must have been backed up for `--resume` to carry it over, unless given
+DEFAULT_RESUME_WINDOW = "12h"
+
+# Every line is flushed as it's written, so it survives the process being killed, and synced to disk (to survive a
+# reboot) every so many lines
+SYNC_EVERY = 50
+
+# The keys of a host's StockpileResults kept in the journal (everything but the config itself)
+JOURNAL_FIELDS = StockpileResults.report_fields + ["change_marker"]
+
+
+def journal_path(stockpile_directory: pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(state_directory(stockpile_directory=stockpile_directory) / JOURNAL_FILE)
+
+
+def load_journal(stockpile_directory: pathlib.Path) -> Dict[str, Dict[str, Any]]:
+    """
+    Read a stockpile's checkpoint journal, if it has one (i.e. its last run was interrupted)
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :return: A Dict of host name to its latest journal entry
+    """
+
+    path = journal_path(stockpile_directory=stockpile_directory)
+    entries = {}
+    try:
+        with path.open() as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line is torn if we were killed while writing it
+                    logger.debug("Ignoring an incomplete line in the checkpoint journal %s", path)
+                    continue
+                entries[entry["host"]] = entry
+    except OSError:
+        return {}
+    return entries
+
+
+def resumable_entries(stockpile_directory: pathlib.Path, since: datetime.datetime) -> Dict[str, Dict[str, Any]]:
+    """
+    The journal entries of the hosts an interrupted run can carry over: those backed up successfully since a point in
+    time, whose config file is still the one they wrote.  Failed and deferred hosts are backed up again.
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param since: The oldest backup (UTC) to carry over
+    :return: A Dict of host name to its journal entry
+    """
+
+    from stockpiler.processors.process_stockpiles import ProcessStockpiles
+
+    resumable = {}
+    for host_name, entry in load_journal(stockpile_directory=stockpile_directory).items():
+        result = entry.get("result") or {}
+        if not result.get("backup_successful"):
+            continue
+        if result.get("skip_reason") == "deferred":
+            continue
+        if datetime.datetime.fromisoformat(entry["completed"]) < since:
+            continue
+        config_file = pathlib.Path(stockpile_directory / (entry.get("path") or f"{host_name}.txt"))
+        if not config_file.is_file() or ProcessStockpiles.git_blob_hash(config_file) != entry.get("blob"):
+            logger.info("Backing up %s again, its config has changed since it was journaled", host_name)
+            continue
+        resumable[host_name] = entry
+    return resumable
+
+
+def resume_checkpoint(
+    norns: Nornir, stockpile_directory: pathlib.Path, window: str = DEFAULT_RESUME_WINDOW
+) -> Tuple[Nornir, Dict[str, Dict[str, Any]]]:
+    """
+    Resume an interrupted run: take the hosts it already backed up out of our inventory
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param window: How recently a host must have been backed up to be carried over, i.e. `12h`, or an ISO 8601
+        date/time (in UTC)
+    :return: A Nornir object of the hosts still to back up, and a Dict of host name to the journal entry of those
+        carried over, for ProcessStockpiles to report and commit
+    """
+
+    entries = resumable_entries(stockpile_directory=stockpile_directory, since=parse_since(window))
+    carried = {name: entry for (name, entry) in entries.items() if name in norns.inventory.hosts}
+    remaining = [name for name in norns.inventory.hosts if name not in carried]
+    logger.info(
+        "Resuming an interrupted run, carrying over %s devices and backing up %s", len(carried), len(remaining)
+    )
+    resumed_norns = Nornir(**norns.__dict__)
+    resumed_norns.inventory = indexed_inventory(inventory=norns.inventory, host_names=remaining)
+    return resumed_norns, carried
+
+
+class CheckpointJournal:
+    """
+    The checkpoint journal of a run in progress
+    """
+
+    def __init__(self, stockpile_directory: pathlib.Path, carried: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+        """
+        Start a run's journal, replacing that of any previous run, with the entries of the hosts it carried over
+        from one that was interrupted (so they're carried over again if this run is interrupted too)
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :param carried: A Dict of host name to its journal entry
+        """
+
+        self.path = journal_path(stockpile_directory=stockpile_directory)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=str(self.path.parent), prefix=f".{self.path.name}.")
+        try:
+            with os.fdopen(fd, mode="w") as f:
+                for entry in (carried or {}).values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(temp_path, str(self.path))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.file = self.path.open(mode="a")
+        self.unsynced = 0
+
+    def record(
+        self,
+        host_name: str,
+        stockpile_info: StockpileResults,
+        path: Optional[str] = None,
+        blob: Optional[str] = None,
+        size: Optional[int] = None,
+        duration: Optional[float] = None,
+    ) -> None:
+        """
+        Append a completed host to the journal
+        :param host_name:
+        :param stockpile_info: The host's StockpileResults
+        :param path: The repository relative path of its config (see stockpiler.tasks.stockpile.config_files)
+        :param blob: The blob hash of its config, if we have it
+        :param size: The size (in bytes) of its config, if we have it
+        :param duration: How long (in seconds) its stockpile took
+        :return:
+        """
+
+        entry = {
+            "host": host_name,
+            "completed": datetime.datetime.utcnow().isoformat(),
+            "path": path,
+            "blob": blob,
+            "size": size,
+            "duration": duration,
+            "result": {key: stockpile_info.get(key) for key in JOURNAL_FIELDS},
+        }
+        self.file.write(json.dumps(entry, default=str) + "\n")
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= SYNC_EVERY:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+    def remove(self) -> None:
+        """
+        The run has been committed, so there's nothing to resume
+        :return:
+        """
+
+        self.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
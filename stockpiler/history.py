@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+"""
+An SQLite index of each device's backup history, so questions like "when did core-rtr-01 last change?" or "which
+devices changed this week?" are answered by lookup rather than by walking `git log` of a large stockpile.
+
+`ProcessStockpiles` records every host's result (with the blob hash and size of its config, whether it changed, and
+how long it took) in one transaction per run.  The index lives in the stockpile's `.stockpiler` state directory,
+which is excluded from the Git repository, and only covers runs since it was introduced.
+"""
+
+import datetime
+import pathlib
+import re
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+from stockpiler.tasks.stockpile.change_markers import state_directory
+
+
+HISTORY_FILE = "history.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    finished TEXT,
+    commit_sha TEXT
+);
+CREATE TABLE IF NOT EXISTS backups (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    host TEXT NOT NULL,
+    completed TEXT NOT NULL,
+    last_backup_attempt TEXT,
+    backup_successful INTEGER NOT NULL,
+    save_config_successful INTEGER NOT NULL,
+    http_used INTEGER NOT NULL,
+    ssh_used INTEGER NOT NULL,
+    skip_reason TEXT,
+    blob TEXT,
+    size INTEGER,
+    changed INTEGER NOT NULL,
+    duration REAL,
+    api_used TEXT,
+    PRIMARY KEY (host, run_id)
+);
+CREATE INDEX IF NOT EXISTS backups_changed ON backups (changed, completed);
+CREATE TABLE IF NOT EXISTS devices (
+    host TEXT PRIMARY KEY,
+    last_attempt TEXT NOT NULL,
+    last_successful_backup TEXT,
+    last_changed TEXT,
+    blob TEXT,
+    duration REAL
+);
+"""
+
+# Columns added since the index was introduced, added to existing indexes when they're opened
+ADDED_COLUMNS = {"backups": {"duration": "REAL", "api_used": "TEXT"}, "devices": {"duration": "REAL"}}
+
+# The native APIs a device may be backed up through (see stockpiler.tasks.stockpile.stockpile_api), as we print them
+API_NAMES = {"nxapi": "NX-API", "eapi": "eAPI", "netconf": "NETCONF"}
+
+# How much each new duration of a device counts towards its expected duration, versus those before it
+DURATION_WEIGHT = 0.5
+
+# Keep the latest state of each device, carrying over what its latest backup didn't change.  UPSERT needs SQLite 3.24
+# or later, with earlier versions each device is inserted (if it's new) then updated.
+UPSERT_VERSION = (3, 24, 0)
+DEVICE_INSERT = """
+INSERT OR IGNORE INTO devices (host, last_attempt, last_successful_backup, last_changed, blob, duration)
+VALUES (:host, :completed, :successful, :changed, :blob, :duration)
+"""
+DEVICE_UPDATE = """
+UPDATE devices SET
+    last_attempt = :completed,
+    last_successful_backup = COALESCE(:successful, last_successful_backup),
+    last_changed = COALESCE(:changed, last_changed),
+    blob = COALESCE(:blob, blob),
+    duration = COALESCE(:weight * :duration + (1 - :weight) * duration, :duration, duration)
+WHERE host = :host
+"""
+DEVICE_UPSERT = """
+INSERT INTO devices (host, last_attempt, last_successful_backup, last_changed, blob, duration)
+VALUES (:host, :completed, :successful, :changed, :blob, :duration)
+ON CONFLICT (host) DO UPDATE SET
+    last_attempt = excluded.last_attempt,
+    last_successful_backup = COALESCE(excluded.last_successful_backup, last_successful_backup),
+    last_changed = COALESCE(excluded.last_changed, last_changed),
+    blob = COALESCE(excluded.blob, blob),
+    duration = COALESCE(:weight * excluded.duration + (1 - :weight) * duration, excluded.duration, duration)
+"""
+
+# A row of the backups table, as recorded for each host in a run
+BackupRow = Tuple[
+    str,
+    str,
+    Optional[str],
+    bool,
+    bool,
+    bool,
+    bool,
+    Optional[str],
+    Optional[str],
+    Optional[int],
+    bool,
+    Optional[float],
+    Optional[str],
+]
+
+# Relative times for `stockpiler history --changed_since`, i.e. `7d` or `12h`
+RELATIVE_TIME = re.compile(r"^(\d+)([smhdw])$")
+RELATIVE_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
+
+def history_path(stockpile_directory: pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(state_directory(stockpile_directory=stockpile_directory) / HISTORY_FILE)
+
+
+def parse_since(value: str, now: Optional[datetime.datetime] = None) -> datetime.datetime:
+    """
+    Parse a point in time given either relative to now (i.e. `7d`, `12h`) or as an ISO 8601 date/time (in UTC)
+    :param value:
+    :param now: What time it is now (UTC), defaults to now
+    :return:
+    """
+
+    match = RELATIVE_TIME.match(value.strip())
+    if match:
+        delta = datetime.timedelta(**{RELATIVE_UNITS[match.group(2)]: int(match.group(1))})
+        return (now or datetime.datetime.utcnow()) - delta
+    try:
+        return datetime.datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise ValueError(f"Unable to parse {value}, expected i.e. `7d`, `12h`, or `2020-01-25T13:00:00`")
+
+
+class HistoryIndex:
+    """
+    The backup history of a stockpile
+    """
+
+    def __init__(self, stockpile_directory: pathlib.Path, create: bool = True) -> None:
+        """
+        Open (and if need be, create) the history index of a stockpile
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :param create: Create the index if it doesn't exist, otherwise raise an OSError
+        """
+
+        self.path = history_path(stockpile_directory=stockpile_directory)
+        if not self.path.is_file():
+            if not create:
+                raise OSError(f"No backup history found at {self.path}, it is recorded by each stockpile run")
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Opened when a run starts and written when it completes, which runners may do from different threads
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self) -> None:
+        """
+        Add any columns an index created by an earlier version doesn't have
+        :return:
+        """
+
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row[1] for row in self.connection.execute(f"PRAGMA table_info({table})")}
+            for column, column_type in columns.items():
+                if column not in existing:
+                    self.connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def last_successful_backups(self) -> Dict[str, str]:
+        """
+        When each device was last backed up successfully
+        :return: A Dict of host name to the time of its last successful backup (ISO 8601, UTC)
+        """
+
+        rows = self.connection.execute(
+            "SELECT host, last_successful_backup FROM devices WHERE last_successful_backup IS NOT NULL"
+        )
+        return dict(rows.fetchall())
+
+    def expected_durations(self) -> Dict[str, float]:
+        """
+        How long each device's stockpile is expected to take, from a moving average of how long its recent ones took
+        :return: A Dict of host name to seconds
+        """
+
+        rows = self.connection.execute("SELECT host, duration FROM devices WHERE duration IS NOT NULL")
+        return dict(rows.fetchall())
+
+    def record_run(
+        self, started: str, finished: str, commit_sha: Optional[str], backups: Iterable[BackupRow]
+    ) -> int:
+        """
+        Record a run, and the result for each of its hosts, in one transaction
+        :param started: When the run started (ISO 8601, UTC)
+        :param finished: When it finished
+        :param commit_sha: The commit it made, if it made one
+        :param backups: Each host's (host, completed, last_backup_attempt, backup_successful, save_config_successful,
+            http_used, ssh_used, skip_reason, blob, size, changed, duration, api_used), duration is None if the
+            host's stockpile wasn't timed or shouldn't count towards its expected duration (i.e. it was deferred), and
+            api_used is the native API it was backed up through, if any
+        :return: The run's ID
+        """
+
+        with self.connection:
+            run_id = self.connection.execute(
+                "INSERT INTO runs (started, finished, commit_sha) VALUES (?, ?, ?)", (started, finished, commit_sha)
+            ).lastrowid
+            backups = list(backups)
+            self.connection.executemany(
+                "INSERT INTO backups (run_id, host, completed, last_backup_attempt, backup_successful, "
+                "save_config_successful, http_used, ssh_used, skip_reason, blob, size, changed, duration, api_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id,) + tuple(row) for row in backups],
+            )
+            # Keep the latest state of each device, carrying over what this run didn't change
+            devices = [
+                {
+                    "host": row[0],
+                    "completed": row[1],
+                    "successful": row[1] if row[3] else None,
+                    "changed": row[1] if row[10] else None,
+                    "blob": row[8],
+                    "duration": row[11],
+                    "weight": DURATION_WEIGHT,
+                }
+                for row in backups
+            ]
+            if sqlite3.sqlite_version_info >= UPSERT_VERSION:
+                self.connection.executemany(DEVICE_UPSERT, devices)
+            else:
+                # The row inserted for a new device is then "updated" to the same values
+                self.connection.executemany(DEVICE_INSERT, devices)
+                self.connection.executemany(DEVICE_UPDATE, devices)
+        return run_id
+
+    def device(self, host: str) -> Optional[Dict[str, Optional[str]]]:
+        """
+        The latest state of a device
+        :param host:
+        :return: Its last attempt, last successful backup, last change, and current blob hash, or None if unknown
+        """
+
+        row = self.connection.execute(
+            "SELECT last_attempt, last_successful_backup, last_changed, blob FROM devices WHERE host = ?", (host,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("last_attempt", "last_successful_backup", "last_changed", "blob"), row))
+
+    def device_history(self, host: str, limit: int = 10, changed_only: bool = False) -> List[Dict]:
+        """
+        A device's most recent backups
+        :param host:
+        :param limit: How many backups to return
+        :param changed_only: Only backups where its config changed
+        :return: Newest first, with the commit each was made in
+        """
+
+        cursor = self.connection.execute(
+            f"""
+            SELECT b.completed, b.backup_successful, b.save_config_successful, b.http_used, b.ssh_used, b.api_used,
+                b.skip_reason, b.blob, b.size, b.changed, b.duration, r.commit_sha
+            FROM backups b JOIN runs r USING (run_id)
+            WHERE b.host = ? {"AND b.changed" if changed_only else ""}
+            ORDER BY b.completed DESC LIMIT ?
+            """,
+            (host, limit),
+        )
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def change_counts(self, since: datetime.datetime) -> Dict[str, int]:
+        """
+        How many times each device's config changed since a point in time
+        :param since: (UTC)
+        :return: A Dict of host name to its number of changes, devices without changes are left out
+        """
+
+        rows = self.connection.execute(
+            "SELECT host, COUNT(*) FROM backups WHERE changed AND completed >= ? GROUP BY host", (since.isoformat(),)
+        )
+        return dict(rows.fetchall())
+
+    def changed_since(self, since: datetime.datetime) -> List[Tuple[str, str]]:
+        """
+        Devices whose config changed since a point in time
+        :param since: (UTC)
+        :return: (host, when it last changed) of each, most recently changed first
+        """
+
+        return self.connection.execute(
+            "SELECT host, MAX(completed) AS last FROM backups WHERE changed AND completed >= ? "
+            "GROUP BY host ORDER BY last DESC",
+            (since.isoformat(),),
+        ).fetchall()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+A Nornir inventory plugin that caches the compiled (parsed and deserialized) SimpleInventory between runs.
+
+Parsing a large `hosts.yml` and building every Host through Nornir's deserializer can take tens of seconds, while
+unpickling the result takes a fraction of a second.  The cache is keyed on the size, modification time, and SHA256 of
+each inventory source file: if a file's size and mtime are unchanged it is trusted as is, otherwise its content is
+hashed, and the cache is only rebuilt if the content actually changed.  Host indexes (see stockpiler.inventory.index)
+are built along with the inventory and cached with it.
+
+Use it in place of SimpleInventory in the Nornir config file:
+
+    inventory:
+      plugin: stockpiler.inventory.cached_inventory.CachedSimpleInventory
+      options:
+        host_file: "/etc/stockpiler/inventory/hosts.yml"
+        group_file: "/etc/stockpiler/inventory/groups.yml"
+        cache_file: "~/.cache/stockpiler/inventory.pickle"
+"""
+
+import gc
+import hashlib
+from logging import getLogger
+import os
+import pathlib
+import pickle
+import tempfile
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+from nornir.core import inventory
+from nornir.core.deserializer.inventory import Inventory
+from nornir.plugins.inventory.simple import SimpleInventory
+
+
+from stockpiler.inventory.index import InventoryIndex
+
+
+logger = getLogger("stockpiler")
+
+# Bump this when the cached objects change shape, so caches from older versions are rebuilt rather than loaded
+CACHE_VERSION = 1
+
+
+class IndexedInventory(inventory.Inventory):
+    """
+    A Nornir Inventory that carries the InventoryIndex of its hosts
+    """
+
+    def __init__(self, *args, index: Optional[InventoryIndex] = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.index = index
+
+
+def file_state(file_path: pathlib.Path, previous: Optional[Tuple[int, int, str]] = None) -> Tuple[int, int, str]:
+    """
+    The (size, mtime, SHA256) of a file, only hashing the content if the size or mtime differ from its previous state
+    :param file_path:
+    :param previous: The state of this file when the cache was built
+    :return:
+    """
+
+    if not file_path.is_file():
+        return 0, 0, ""
+    stat = file_path.stat()
+    if previous is not None and previous[:2] == (stat.st_size, stat.st_mtime_ns):
+        return previous
+    return stat.st_size, stat.st_mtime_ns, hashlib.sha256(file_path.read_bytes()).hexdigest()
+
+
+class CachedSimpleInventory(Inventory):
+    @classmethod
+    def deserialize(
+        cls,
+        transform_function: Optional[Callable[..., Any]] = None,
+        transform_function_options: Optional[Dict[str, Any]] = None,
+        host_file: str = "hosts.yaml",
+        group_file: str = "groups.yaml",
+        defaults_file: str = "defaults.yaml",
+        cache_file: str = "~/.cache/stockpiler/inventory.pickle",
+        *args: Any,
+        **kwargs: Any,
+    ) -> inventory.Inventory:
+        """
+        Load our inventory from the cache if its source files are unchanged, otherwise from the source files through
+        SimpleInventory, then rebuild the cache.
+        :param transform_function: A Nornir transform function, applied after loading (it is not cached)
+        :param transform_function_options:
+        :param host_file: See SimpleInventory
+        :param group_file: See SimpleInventory
+        :param defaults_file: See SimpleInventory
+        :param cache_file: Where to keep our cache, it is only readable by this user as it may contain credentials
+        :return: An IndexedInventory
+        """
+
+        sources = [pathlib.Path(os.path.expanduser(f)) for f in (host_file, group_file, defaults_file) if f]
+        cache_path = pathlib.Path(os.path.expanduser(cache_file))
+
+        cached = cls.load_cache(cache_path=cache_path)
+        if cached is not None:
+            previous_states = cached["sources"]
+            states = {str(f): file_state(file_path=f, previous=previous_states.get(str(f))) for f in sources}
+            if {f: s[2] for (f, s) in states.items()} == {f: s[2] for (f, s) in previous_states.items()}:
+                logger.debug("Loaded inventory from cache %s", cache_path)
+                hosts, groups, defaults, index = cached["inventory"]
+                if states != previous_states:
+                    # Only the mtime changed (i.e. the file was touched or checked out again), note that for next time
+                    cached["sources"] = states
+                    cls.write_cache(cache_path=cache_path, cache=cached)
+            else:
+                cached = None
+
+        if cached is None:
+            logger.info("Inventory has changed (or isn't cached), parsing %s", host_file)
+            states = {str(f): file_state(file_path=f) for f in sources}
+            compiled = SimpleInventory.deserialize(
+                host_file=host_file, group_file=group_file, defaults_file=defaults_file, *args, **kwargs
+            )
+            hosts, groups, defaults = compiled.hosts, compiled.groups, compiled.defaults
+            index = InventoryIndex.build(inventory=compiled)
+            cls.write_cache(
+                cache_path=cache_path,
+                cache={"version": CACHE_VERSION, "sources": states, "inventory": (hosts, groups, defaults, index)},
+            )
+
+        return IndexedInventory(
+            hosts=hosts,
+            groups=groups,
+            defaults=defaults,
+            transform_function=transform_function,
+            transform_function_options=transform_function_options or {},
+            index=index,
+        )
+
+    @staticmethod
+    def load_cache(cache_path: pathlib.Path) -> Optional[Dict[str, Any]]:
+        """
+        Load our cache, if there is a usable one
+        :param cache_path:
+        :return:
+        """
+
+        if not cache_path.is_file():
+            return None
+        # The cyclic garbage collector repeatedly walks the objects being created while unpickling a large
+        # inventory, and none of them are garbage, so hold it off until we're done
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with cache_path.open(mode="rb") as f:
+                cached = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+            logger.warning("Unable to read inventory cache %s, rebuilding it: %s", cache_path, e)
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if not isinstance(cached, dict) or cached.get("version") != CACHE_VERSION:
+            return None
+        return cached
+
+    @staticmethod
+    def write_cache(cache_path: pathlib.Path, cache: Dict[str, Any]) -> None:
+        """
+        Write our cache (only readable by this user), replacing any previous cache at once so a concurrent run never
+        reads a partial one.  Failing to write the cache isn't fatal, we'll just parse the inventory again next time.
+        :param cache_path:
+        :param cache:
+        :return:
+        """
+
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=str(cache_path.parent), prefix=f".{cache_path.name}.")
+            try:
+                with os.fdopen(fd, mode="wb") as f:
+                    pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path, str(cache_path))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except (OSError, pickle.PicklingError, AttributeError, TypeError) as e:
+            logger.warning("Unable to write inventory cache %s: %s", cache_path, e)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Indexes of an inventory's hosts, so filters resolve by lookup rather than by checking every host.
+"""
+
+import bisect
+from collections import defaultdict
+import ipaddress
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+
+from nornir.core.inventory import Group, Hosts, Inventory
+
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class InventoryIndex:
+    """
+    Host names of an inventory indexed by hostname (address), group (including groups inherited from other groups),
+    platform, and site, along with a sorted list of host IP addresses for CIDR lookups.
+    """
+
+    def __init__(self) -> None:
+        self.position: Dict[str, int] = {}
+        self.by_hostname: Dict[str, List[str]] = defaultdict(list)
+        self.by_group: Dict[str, List[str]] = defaultdict(list)
+        self.by_platform: Dict[str, List[str]] = defaultdict(list)
+        self.by_site: Dict[str, List[str]] = defaultdict(list)
+        # One sorted list of (integer address, host name) per IP version
+        self.addresses: Dict[int, List[Tuple[int, str]]] = {4: [], 6: []}
+
+    @staticmethod
+    def ancestor_groups(groups: Iterable[Group]) -> Set[str]:
+        """
+        Names of these groups and every group they inherit from
+        :param groups:
+        :return:
+        """
+
+        names: Set[str] = set()
+        pending = list(groups)
+        while pending:
+            group = pending.pop()
+            if group.name not in names:
+                names.add(group.name)
+                pending.extend(group.groups.refs)
+        return names
+
+    @classmethod
+    def build(cls, inventory: Inventory) -> "InventoryIndex":
+        """
+        Index every host in an inventory
+        :param inventory: A Nornir Inventory object
+        :return:
+        """
+
+        index = cls()
+        for position, (name, host) in enumerate(inventory.hosts.items()):
+            index.position[name] = position
+            if host.hostname:
+                index.by_hostname[host.hostname].append(name)
+                try:
+                    address = ipaddress.ip_address(host.hostname)
+                except ValueError:
+                    pass
+                else:
+                    index.addresses[address.version].append((int(address), name))
+            for group in cls.ancestor_groups(groups=host.groups.refs):
+                index.by_group[group].append(name)
+            if host.platform:
+                index.by_platform[host.platform].append(name)
+            site = host.get("site", None)
+            if site:
+                index.by_site[str(site)].append(name)
+
+        for addresses in index.addresses.values():
+            addresses.sort()
+        # Drop the defaultdict factories, so lookups of missing keys don't grow the index (and it pickles cleanly)
+        for attribute in ("by_hostname", "by_group", "by_platform", "by_site"):
+            setattr(index, attribute, dict(getattr(index, attribute)))
+        return index
+
+    def in_network(self, network: IPNetwork) -> List[str]:
+        """
+        Names of the hosts whose hostname is an IP address within a network
+        :param network:
+        :return:
+        """
+
+        addresses = self.addresses[network.version]
+        start = bisect.bisect_left(addresses, (int(network.network_address), ""))
+        end = bisect.bisect_right(addresses, (int(network.broadcast_address), chr(0x10FFFF)))
+        return [name for (_, name) in addresses[start:end]]
+
+    def lookup_addresses(self, addresses: Iterable[str]) -> Set[str]:
+        """
+        Names of the hosts matching any of these hostnames, IP addresses, or CIDR networks (i.e. `10.0.0.0/24`)
+        :param addresses:
+        :return:
+        """
+
+        selected: Set[str] = set()
+        for address in addresses:
+            selected.update(self.by_hostname.get(address, []))
+            if "/" in address:
+                selected.update(self.in_network(network=ipaddress.ip_network(address, strict=False)))
+        return selected
+
+    def select(
+        self,
+        addresses: Optional[Iterable[str]] = None,
+        groups: Optional[Iterable[str]] = None,
+        platforms: Optional[Iterable[str]] = None,
+        sites: Optional[Iterable[str]] = None,
+    ) -> Optional[List[str]]:
+        """
+        Names of the hosts matching every given filter, where a host matches a filter if it matches any of its values
+        :param addresses: Hostnames, IP addresses, or CIDR networks
+        :param groups: Group names, including groups inherited from other groups
+        :param platforms: Netmiko platforms
+        :param sites: Sites from the hosts' `site` data
+        :return: Host names in inventory order, or None if no filters were given
+        """
+
+        selections = []
+        if addresses:
+            selections.append(self.lookup_addresses(addresses=addresses))
+        for values, index in ((groups, self.by_group), (platforms, self.by_platform), (sites, self.by_site)):
+            if values:
+                selections.append({name for value in values for name in index.get(value, [])})
+        if not selections:
+            return None
+        return sorted(set.intersection(*selections), key=self.position.__getitem__)
+
+
+def indexed_inventory(inventory: Inventory, host_names: Iterable[str]) -> Inventory:
+    """
+    A new Inventory of just these hosts, built without checking every host in the original inventory
+    (as `Inventory.filter()` does)
+    :param inventory: A Nornir Inventory object
+    :param host_names:
+    :return:
+    """
+
+    hosts = Hosts()
+    for name in host_names:
+        hosts[name] = inventory.hosts[name]
+    return Inventory(hosts=hosts, groups=inventory.groups, defaults=inventory.defaults)
+
+
+def host_index(inventory: Inventory) -> InventoryIndex:
+    """
+    The index of an inventory, as built by `CachedSimpleInventory`, otherwise building one now
+    :param inventory: A Nornir Inventory object
+    :return:
+    """
+
+    index = getattr(inventory, "index", None)
+    if index is None or len(index.position) != len(inventory.hosts):
+        index = InventoryIndex.build(inventory=inventory)
+    return index
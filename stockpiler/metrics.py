@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+Per host, per phase timings of a stockpile run, aggregated into histograms.
+
+Phases are named after the subtasks of our stockpile tasks (i.e. `tcp_ping`, `connect`, `backup`, `save_config`, and
+`write_file`), plus `host` (the whole of each host's task), `csv` (writing out the results CSV),
+`deferred_save_config` (saving configs after the backups, see stockpiler.runners.save_config), and `commit` (recording
+change markers and the Git commit at the end of the run).
+
+The histograms can be written as a Prometheus textfile (for the node_exporter textfile collector) and as a JSON run
+summary, which also names the slowest hosts of each phase.
+"""
+
+from collections import Counter, defaultdict
+import datetime
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+# Upper bounds (in seconds) of our histogram buckets, from a quick local write up to a device timing out
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# The order phases happen in for each host, phases not listed here (i.e. from new tasks) are reported after these
+PHASE_ORDER = (
+    "tcp_ping",
+    "connect",
+    "change_marker",
+    "copy_config",
+    "backup",
+    "delete_file",
+    "save_config",
+    "write_file",
+    "csv",
+    "host",
+    "deferred_save_config",
+    "commit",
+)
+
+PROMETHEUS_FILE = "stockpiler.prom"
+SUMMARY_FILE = "stockpiler_summary.json"
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    The nearest rank percentile of some (sorted) values
+    :param values: Sorted values
+    :param percent: 0-100
+    :return:
+    """
+
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))]
+
+
+class RunMetrics:
+    """
+    Phase timings of a single stockpile run.  Timers are keyed by host and phase, so hosts may be timed from any
+    number of worker threads at once.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.start_time = datetime.datetime.utcnow()
+        self.end_time: Optional[datetime.datetime] = None
+        self.end_timestamp: Optional[float] = None
+        self.timers: Dict[Tuple[str, str], float] = {}
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.host_phases: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self.outcomes: Counter = Counter()
+
+    def start(self, host_name: str, phase: str) -> None:
+        self.timers[(host_name, phase)] = time.perf_counter()
+
+    def stop(self, host_name: str, phase: str) -> None:
+        started = self.timers.pop((host_name, phase), None)
+        if started is not None:
+            self.observe(phase=phase, seconds=time.perf_counter() - started, host_name=host_name)
+
+    def observe(self, phase: str, seconds: float, host_name: Optional[str] = None) -> None:
+        """
+        Record how long a phase took
+        :param phase:
+        :param seconds:
+        :param host_name: The host this phase was for, if any (the run wide phases, i.e. `commit`, have none)
+        :return:
+        """
+
+        with self.lock:
+            self.samples[phase].append(seconds)
+            if host_name is not None:
+                phases = self.host_phases[host_name]
+                phases[phase] = phases.get(phase, 0.0) + seconds
+
+    def record_outcome(self, outcome: str) -> None:
+        with self.lock:
+            self.outcomes[outcome] += 1
+
+    def finish(self) -> None:
+        self.end_time = datetime.datetime.utcnow()
+        self.end_timestamp = time.time()
+
+    def elapsed(self) -> float:
+        return ((self.end_time or datetime.datetime.utcnow()) - self.start_time).total_seconds()
+
+    def phases(self) -> List[str]:
+        return sorted(
+            self.samples, key=lambda p: (PHASE_ORDER.index(p) if p in PHASE_ORDER else len(PHASE_ORDER), p)
+        )
+
+    def summary(self, slowest: int = 10) -> dict:
+        """
+        Summarize our run: host outcomes, then for each phase its count, total, mean, p50, p99, and max, along with its
+        slowest hosts.
+        :param slowest: How many of the slowest hosts to name for each phase
+        :return:
+        """
+
+        phases = {}
+        for phase in self.phases():
+            ordered = sorted(self.samples[phase])
+            host_times = [(times[phase], name) for (name, times) in self.host_phases.items() if phase in times]
+            phases[phase] = {
+                "count": len(ordered),
+                "total_seconds": sum(ordered),
+                "mean_seconds": sum(ordered) / len(ordered),
+                "p50_seconds": percentile(ordered, 50),
+                "p99_seconds": percentile(ordered, 99),
+                "max_seconds": ordered[-1],
+                "slowest_hosts": [
+                    {"host": name, "seconds": seconds} for (seconds, name) in sorted(host_times, reverse=True)[:slowest]
+                ],
+            }
+        return {
+            "start_time": self.start_time.isoformat(),
+            "end_time": (self.end_time or datetime.datetime.utcnow()).isoformat(),
+            "elapsed_seconds": self.elapsed(),
+            "hosts": dict(self.outcomes),
+            "phases": phases,
+        }
+
+    def prometheus_text(self) -> str:
+        """
+        Our histograms (and run totals) in the Prometheus text exposition format
+        :return:
+        """
+
+        lines = [
+            "# HELP stockpiler_phase_duration_seconds Time spent in each phase of stockpiling a host.",
+            "# TYPE stockpiler_phase_duration_seconds histogram",
+        ]
+        for phase in self.phases():
+            samples = self.samples[phase]
+            for bound in self.buckets:
+                count = sum(1 for s in samples if s <= bound)
+                lines.append(f'stockpiler_phase_duration_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}')
+            lines.append(f'stockpiler_phase_duration_seconds_bucket{{phase="{phase}",le="+Inf"}} {len(samples)}')
+            lines.append(f'stockpiler_phase_duration_seconds_sum{{phase="{phase}"}} {sum(samples)}')
+            lines.append(f'stockpiler_phase_duration_seconds_count{{phase="{phase}"}} {len(samples)}')
+
+        lines.extend(
+            [
+                "# HELP stockpiler_run_hosts Hosts in the last stockpile run, by outcome.",
+                "# TYPE stockpiler_run_hosts gauge",
+            ]
+        )
+        for outcome, count in sorted(self.outcomes.items()):
+            lines.append(f'stockpiler_run_hosts{{outcome="{outcome}"}} {count}')
+        lines.extend(
+            [
+                "# HELP stockpiler_run_duration_seconds Duration of the last stockpile run.",
+                "# TYPE stockpiler_run_duration_seconds gauge",
+                f"stockpiler_run_duration_seconds {self.elapsed()}",
+                "# HELP stockpiler_run_timestamp_seconds When the last stockpile run finished.",
+                "# TYPE stockpiler_run_timestamp_seconds gauge",
+                f"stockpiler_run_timestamp_seconds {self.end_timestamp or time.time()}",
+            ]
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_directory: pathlib.Path) -> None:
+        """
+        Write our Prometheus textfile and JSON run summary, each replacing the previous at once so a collector never
+        reads a partial file
+        :param metrics_directory: An instantiated pathlib.Path object for the directory to write them in
+        :return:
+        """
+
+        metrics_directory.mkdir(parents=True, exist_ok=True)
+        for file_name, content in (
+            (PROMETHEUS_FILE, self.prometheus_text()),
+            (SUMMARY_FILE, json.dumps(self.summary(), indent=2)),
+        ):
+            fd, temp_path = tempfile.mkstemp(dir=str(metrics_directory), prefix=f".{file_name}.")
+            try:
+                with os.fdopen(fd, mode="w") as f:
+                    f.write(content)
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, str(metrics_directory / file_name))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
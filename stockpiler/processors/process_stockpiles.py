@@ -6,106 +6,726 @@ Process our backup tasks/results within the Nornir processor framework.
 See https://nornir.readthedocs.io/en/latest/tutorials/intro/processors.html for more information.
 """
 
-import csv
 import datetime
 import logging
 import pathlib
+import posixpath
+import sqlite3
+import subprocess
 import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple, TYPE_CHECKING
 
 
-from git import Actor, Repo
+from git import Actor, GitCommandError, Repo
 from nornir.core.inventory import Host
 from nornir.core.processor import Processor
-from nornir.core.task import AggregatedResult, MultiResult, Task
+from nornir.core.task import AggregatedResult, MultiResult, Result, Task
+
+
+from stockpiler.checkpoint import CheckpointJournal
+from stockpiler.history import HistoryIndex
+from stockpiler.metrics import RunMetrics
+from stockpiler.runners.save_config import save_config_mode
+from stockpiler.tasks.stockpile.change_markers import STATE_DIRECTORY, load_manifest, save_manifest, state_directory
+from stockpiler.tasks.stockpile.config_files import blob_hash, ConfigHashes, config_path, sync_configs
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults, StockpileResultsTable
+
+
+if TYPE_CHECKING:  # pragma: no cover
+    from stockpiler.runners.save_config import DeferredSaveConfig
 
 
 logger = logging.getLogger("stockpiler")
 
 
 class ProcessStockpiles(Processor):
-    def __init__(self, **kwargs) -> None:
+    def __init__(
+        self,
+        unreachable: Optional[List[StockpileResults]] = None,
+        repo: Optional[Repo] = None,
+        metrics_directory: Optional[pathlib.Path] = None,
+        commit_backend: str = "index",
+        resumed: Optional[Dict[str, Dict[str, Any]]] = None,
+        deferred_save: Optional["DeferredSaveConfig"] = None,
+        **kwargs,
+    ) -> None:
         """
         Initialize some base values for this processor
+        :param unreachable: StockpileResults of hosts that failed a pre-flight reachability sweep, and so were never
+            dispatched, to be included in our report.
+        :param repo: An already open git.Repo object for our stockpile (i.e. kept by `stockpiler serve`), otherwise
+            the repository is opened (or created) when the task starts.
+        :param metrics_directory: Where to write a Prometheus textfile and JSON summary of this run's phase timings
+            (see stockpiler.metrics), otherwise they are only summarized in our output.
+        :param commit_backend: How to commit changed configs, `index` stages them through the repository's index
+            with GitPython, while `fast-import` streams them straight into `git fast-import` without reading or
+            writing the index (much faster with very large stockpiles).
+        :param resumed: The checkpoint journal entries of hosts carried over from an interrupted run (see
+            stockpiler.checkpoint), to be reported and committed along with the hosts backed up in this one.
+        :param deferred_save: Our save config phase, for hosts whose config is saved after every backup has finished
+            rather than as part of their own (see stockpiler.runners.save_config).
         :param kwargs:
         """
 
         self.task_start_time = datetime.datetime.utcnow()
+        self.unreachable = unreachable or []
         self.lock = threading.Lock()
+        self.repo = repo
+        self.committed_blobs: Dict[str, str] = {}
+        self.changed_files: Set[str] = set()
+        self.change_markers: Dict[str, str] = {}
+        self.change_markers_updated = False
+        self.csv_out: Optional[pathlib.Path] = None
+        self.config_hashes: Optional[ConfigHashes] = None
+        self.committed_configs: Dict[str, str] = {}
+        self.removed_files: Set[str] = set()
+        self.results = StockpileResultsTable()
+        self.metrics_directory = metrics_directory
+        self.metrics = RunMetrics()
+        self.history: Optional[HistoryIndex] = None
+        self.last_successful_backups: Dict[str, str] = {}
+        self.history_rows: List[tuple] = []
+        self.resumed = resumed or {}
+        self.journal: Optional[CheckpointJournal] = None
+        self.deferred_save = deferred_save
+        self.pending_saves: Dict[str, Dict[str, Any]] = {}
+        if commit_backend not in ("index", "fast-import"):
+            raise ValueError(f"Unknown commit backend {commit_backend}, expected `index` or `fast-import`")
+        self.commit_backend = commit_backend
         super().__init__(**kwargs)
 
     def task_started(self, task: Task) -> None:
         """
-        When the overall stockpile task starts, print the start time.
+        When the overall stockpile task starts, print the start time, then initialize our Git repository and
+        note the blob hash of every file in the last commit so we can tell which configs change during this run,
+        and load the change markers of the configs we have, and when each host was last backed up successfully.
+        Lastly, start our results table (see StockpileResultsTable), streaming each host's row into our CSV report as
+        it's added, and checkpoint journal, reporting any hosts carried over from an interrupted run.
         :param task:
         :return:
         """
 
         print(f"Backup Task Start Time: {self.task_start_time.isoformat()}")
+        self.metrics = RunMetrics()
+
+        # Plumb up Git repository
+        if self.repo is None:
+            self.repo = self.git_initialize(stockpile_directory=task.params["stockpile_directory"])
+        self.committed_blobs = self.git_committed_blobs(repo=self.repo)
+        self.committed_configs = self.committed_config_paths(committed_blobs=self.committed_blobs)
+        self.config_hashes = ConfigHashes(stockpile_directory=task.params["stockpile_directory"])
+
+        # Our state (i.e. the change marker manifest) lives in the stockpile, but isn't part of the repository
+        self.git_exclude(repo=self.repo, pattern=f"/{STATE_DIRECTORY}/")
+        self.load_change_markers(stockpile_directory=task.params["stockpile_directory"])
+        self.open_history(stockpile_directory=task.params["stockpile_directory"])
+
+        self.csv_out = pathlib.Path(f"{task.params['stockpile_directory']}/results.csv")
+        print(f"Putting results into a CSV at {self.csv_out}")
+        self.results.close_csv()
+        self.results = StockpileResultsTable()
+        self.results.stream_csv(path=self.csv_out)
+        for stockpile_info in self.unreachable:
+            host_name = stockpile_info.name.rsplit("_backup", 1)[0]
+            self.record_history(host_name=host_name, stockpile_info=stockpile_info)
+            self.results.append(host_name=host_name, stockpile_info=stockpile_info)
+            print(f"  - {stockpile_info['hostname']}: Stockpile Failed (Unreachable)")
+        self.journal = CheckpointJournal(stockpile_directory=task.params["stockpile_directory"], carried=self.resumed)
+        for host_name, entry in self.resumed.items():
+            self.carry_over(stockpile_directory=task.params["stockpile_directory"], host_name=host_name, entry=entry)
 
     def task_completed(self, task: Task, result: AggregatedResult) -> None:
         """
         When the overall stockpile task finishes, do the following:
             1) Print finish time and calculate run time
-            2) Initialize our Git repository
-            3) Write a CSV report on this backup task
-            4) Add all written files to this commit, and commit it
+            2) Save the configs of hosts left to our deferred save config phase (adding their rows to the CSV report
+               on this backup task), then close the report
+            3) Record the change markers and hashes of the configs we backed up, and flush them to disk (once, rather
+               than as each was written)
+            4) Add the changed config files (and the report) to this commit, removing any that moved (as their layout
+               changed), and commit it, if any configs changed, then let Git pack up loose objects and packs if
+               they've built up
+            5) Record this run, and each host's result, in our history index (see stockpiler.history), and remove our
+               checkpoint journal, as there's nothing left to resume
+            6) Summarize the time spent in each phase, and write out our metrics
         :param task:
         :param result:
         :return:
         """
 
-        # Process our results into a CSV and write it to the stockpile output directory.
-
         task_end_time = datetime.datetime.utcnow()
         print(f"Backup Task End Time: {task_end_time.isoformat()}")
         print(f"Backup Task Elapsed Time: {task_end_time - self.task_start_time}")
 
-        # Plumb up Git repository
-        repo = self.git_initialize(stockpile_directory=task.params["stockpile_directory"])
-        author = Actor(name="Stockpiler", email="stockpiler@localhost.local")
-
-        csv_out = pathlib.Path(f"{task.params['stockpile_directory']}/results.csv")
-        print(f"Putting results into a CSV at {csv_out}")
-        with csv_out.open(mode="w") as output_file:
-            fieldnames = [i for i in next(result[x] for x in result)[0].result.keys() if i not in ["device_config"]]
+        if self.pending_saves:
+            self.run_deferred_save()
+        csv_start = time.perf_counter()
+        self.results.close_csv()
+        self.metrics.observe(phase="csv", seconds=time.perf_counter() - csv_start)
 
-            writer = csv.DictWriter(output_file, fieldnames=fieldnames)
+        commit_start = time.perf_counter()
+        if self.change_markers_updated:
+            save_manifest(stockpile_directory=task.params["stockpile_directory"], markers=self.change_markers)
+        self.config_hashes.save()
+        sync_configs(
+            stockpile_directory=task.params["stockpile_directory"],
+            relative_paths=sorted(self.changed_files | self.removed_files),
+        )
 
-            writer.writeheader()
-            for host in result.keys():
-                # Don't try to write this if it's not a dict.
-                if not isinstance(result[host][0].result, dict):
-                    continue
-                writer.writerow({k: v for (k, v) in result[host][0].result.items() if k not in ["device_config"]})
+        commit_sha = self.commit_changes(stockpile_directory=task.params["stockpile_directory"])
+        self.finish_history(commit_sha=commit_sha)
+        self.metrics.observe(phase="commit", seconds=time.perf_counter() - commit_start)
 
-        # Git Commit the changed/stockpiled files
-        repo.git.add(
-            all=True
-        )  # Should be changed to explicitly add all filenames from the results... but that's harder
-        repo.index.commit(message=f"Stockpile Built at {datetime.datetime.utcnow().isoformat()}", author=author)
+        self.metrics.finish()
+        self.print_phase_summary()
+        if self.metrics_directory is not None:
+            try:
+                self.metrics.write(metrics_directory=self.metrics_directory)
+            except OSError as e:
+                logger.error("Unable to write metrics to %s: %s", self.metrics_directory, e)
 
     def task_instance_started(self, task: Task, host: Host) -> None:
-        pass  # This is required for implementation, but at this time we're taking no action here
+        self.metrics.start(host_name=host.name, phase="host")
 
     def task_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
         """
-        Print Successful/Failed for each individual stockpile attempt.
+        Print Successful/Failed for each individual stockpile attempt, add its row to our results table (and CSV
+        report, history index, and checkpoint journal), and note if its config file changed.  Then drop the config text
+        (and any subtask output holding a copy of it) so we aren't holding every device's config in memory until the
+        end of the run.  The rows of hosts awaiting our deferred save config phase are held until they've been saved.
+        The time taken by the host's task is recorded in our metrics.
         :param task:
         :param host:
         :param result:
         :return:
         """
-        self.lock.acquire()
-        print(f"  - {host.name}: Stockpile {'Failed' if result.failed else 'Successful'}")
-        self.lock.release()
+        self.metrics.stop(host_name=host.name, phase="host")
+
+        stockpile_info = result[0].result
+        repo_path = config_path(host=host)
+        blob, size, changed_file, moved_file = self.config_changes(
+            stockpile_directory=task.params["stockpile_directory"],
+            host=host,
+            stockpile_info=stockpile_info,
+            repo_path=repo_path,
+        )
+
+        with self.lock:
+            if changed_file is not None:
+                self.changed_files.add(changed_file)
+            if moved_file is not None:
+                self.removed_files.add(moved_file)
+            # Don't try to write this if it's not a StockpileResults (i.e. the task raised).
+            if isinstance(stockpile_info, StockpileResults):
+                if stockpile_info.get("backup_successful"):
+                    self.record_change_marker(host_name=host.name, marker=stockpile_info.get("change_marker"))
+                self.record_host(
+                    host=host,
+                    stockpile_info=stockpile_info,
+                    repo_path=repo_path,
+                    blob=blob,
+                    size=size,
+                    changed=changed_file is not None,
+                )
+            print(f"  - {host.name}: Stockpile {self.outcome(result=result, stockpile_info=stockpile_info).title()}")
+
+        self.metrics.record_outcome(outcome=self.outcome(result=result, stockpile_info=stockpile_info))
+
+        self.release_results(results=result)
 
     def subtask_instance_started(self, task: Task, host: Host) -> None:
-        pass  # This is required for implementation, but at this time we're taking no action here
+        """
+        Start timing a phase of a host's stockpile task, our stockpile tasks name each subtask after its phase
+        (i.e. `connect` or `backup`)
+        :param task:
+        :param host:
+        :return:
+        """
+
+        self.metrics.start(host_name=host.name, phase=task.name)
 
     def subtask_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
-        pass  # This is required for implementation, but at this time we're taking no action here
+        self.metrics.stop(host_name=host.name, phase=task.name)
+
+    def observe_host_phases(self, host_name: str, phases: Dict[str, float]) -> None:
+        """
+        Record the phase timings of a host whose task ran in another process (see stockpiler.runners.multiprocess), in
+        place of timing it with the hooks above
+        :param host_name:
+        :param phases: A Dict of phase (i.e. `host` or `backup`) to the seconds it took
+        :return:
+        """
+
+        for phase, seconds in phases.items():
+            self.metrics.observe(phase=phase, seconds=seconds, host_name=host_name)
 
     # Helper functions, not core to Nornir internals of handling task stages.
+    def config_changes(
+        self, stockpile_directory: pathlib.Path, host: Host, stockpile_info: Any, repo_path: str
+    ) -> Tuple[Optional[str], Optional[int], Optional[str], Optional[str]]:
+        """
+        Note if the config file a host wrote differs from what's in our last commit, and if it moved there from
+        elsewhere (as its layout changed)
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :param host:
+        :param stockpile_info: The host's StockpileResults (or whatever its task returned, if it raised)
+        :param repo_path: Where its config is in our stockpile
+        :return: A Tuple of its config's blob hash and size (if it has one), and the paths it changed and moved from
+            (if it did)
+        """
+
+        if not isinstance(stockpile_info, StockpileResults) or not stockpile_info.get("backup_successful"):
+            return None, None, None, None
+        config_file = pathlib.Path(stockpile_directory / repo_path)
+        if not config_file.is_file():
+            return None, None, None, None
+        size = config_file.stat().st_size
+        if stockpile_info.get("skip_reason"):
+            # Skipped hosts didn't rewrite their config, so it's still the one in our last commit
+            return self.committed_blobs.get(repo_path), size, None, None
+
+        blob = self.config_hashes.blob(relative_path=repo_path)
+        changed_file = repo_path if self.committed_blobs.get(repo_path) != blob else None
+        # If its layout has changed, its config moves, so remove it from where it was
+        moved_file = None
+        if self.committed_configs.get(host.name, repo_path) != repo_path:
+            moved_file = self.committed_configs[host.name]
+        return blob, size, changed_file, moved_file
+
+    def record_host(
+        self,
+        host: Host,
+        stockpile_info: StockpileResults,
+        repo_path: str,
+        blob: Optional[str],
+        size: Optional[int],
+        changed: bool,
+    ) -> None:
+        """
+        Add a host's row to our results table and history index (or hold it for our deferred save config phase), and
+        record it in our checkpoint journal
+        :param host:
+        :param stockpile_info: The host's StockpileResults
+        :param repo_path: Where its config is in our stockpile
+        :param blob: The blob hash of its config, if we have it
+        :param size: The size (in bytes) of its config, if we have it
+        :param changed: Did its config change since our last commit?
+        :return:
+        """
+
+        duration = self.metrics.host_phases.get(host.name, {}).get("host")
+        history = {"blob": blob, "size": size, "changed": changed, "duration": duration}
+        if self.awaiting_save(host=host, stockpile_info=stockpile_info, changed=changed):
+            history["completed"] = datetime.datetime.utcnow().isoformat()
+            self.pending_saves[host.name] = {"stockpile_info": stockpile_info, **history}
+        else:
+            self.record_history(host_name=host.name, stockpile_info=stockpile_info, **history)
+            self.results.append(host_name=host.name, stockpile_info=stockpile_info)
+        self.journal.record(
+            host_name=host.name, stockpile_info=stockpile_info, path=repo_path, blob=blob, size=size, duration=duration
+        )
+
+    def commit_changes(self, stockpile_directory: pathlib.Path) -> Optional[str]:
+        """
+        Git Commit the changed/stockpiled files (and our report), staging only the paths that changed rather than the
+        whole tree, and removing any that moved, then let Git pack up loose objects and packs if they've built up
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :return: The SHA of our commit, or None if no configs changed
+        """
+
+        if not self.changed_files:
+            print("No configuration changes found, skipping commit")
+            return None
+
+        print(f"Committing {len(self.changed_files)} changed configuration(s)")
+        author = Actor(name="Stockpiler", email="stockpiler@localhost.local")
+        paths = sorted(self.changed_files) + [self.repo_path(self.repo, self.csv_out)]
+        removed = sorted(self.removed_files)
+        message = f"Stockpile Built at {datetime.datetime.utcnow().isoformat()}"
+        stale_index_flag = pathlib.Path(state_directory(stockpile_directory) / "index_stale")
+        if self.commit_backend == "fast-import":
+            self.git_fast_import_commit(repo=self.repo, paths=paths, message=message, author=author, removed=removed)
+            for path in removed:
+                try:
+                    pathlib.Path(stockpile_directory / path).unlink()
+                except FileNotFoundError:
+                    pass
+            # The index no longer matches HEAD, note that so the index backend brings it up to date first
+            stale_index_flag.parent.mkdir(parents=True, exist_ok=True)
+            stale_index_flag.touch()
+        else:
+            if stale_index_flag.is_file():
+                logger.info("Reading HEAD into the index, after commits made with the fast-import backend")
+                self.repo.git.read_tree("HEAD")
+                stale_index_flag.unlink()
+            index = self.repo.index
+            if removed:
+                index.remove(items=removed, working_tree=True)
+            index.add(items=paths, write=True)
+            index.commit(message=message, author=author)
+        self.git_maintenance(repo=self.repo)
+        return self.repo.head.commit.hexsha
+
+    def finish_history(self, commit_sha: Optional[str]) -> None:
+        """
+        Record this run, and each host's result, in our history index, and remove our checkpoint journal, as there's
+        nothing left to resume
+        :param commit_sha: The SHA of this run's commit, if it made one
+        :return:
+        """
+
+        self.write_history(commit_sha=commit_sha)
+        self.journal.remove()
+
+    def open_history(self, stockpile_directory: pathlib.Path) -> None:
+        """
+        Open our stockpile's history index, and note when each host was last backed up successfully.  Our history is
+        a convenience, so if it can't be opened the run goes ahead without it.
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :return:
+        """
+
+        self.history_rows = []
+        self.last_successful_backups = {}
+        try:
+            self.history = HistoryIndex(stockpile_directory=stockpile_directory)
+            self.last_successful_backups = self.history.last_successful_backups()
+        except (OSError, sqlite3.Error) as e:
+            logger.error("Unable to open the history index of %s: %s", stockpile_directory, e)
+            self.history = None
+
+    def record_history(
+        self,
+        host_name: str,
+        stockpile_info: StockpileResults,
+        blob: Optional[str] = None,
+        size: Optional[int] = None,
+        changed: bool = False,
+        duration: Optional[float] = None,
+        completed: Optional[str] = None,
+    ) -> None:
+        """
+        Fill in when a host was last backed up successfully (when it completed, if this attempt was), and note its row
+        for our history index, to be recorded with the rest of this run's when it completes
+        :param host_name:
+        :param stockpile_info: The host's StockpileResults
+        :param blob: The blob hash of its config, if we have it
+        :param size: The size (in bytes) of its config, if we have it
+        :param changed: Did its config change since our last commit?
+        :param duration: How long (in seconds) its stockpile took, not counted if it was deferred
+        :param completed: When it completed (ISO 8601, UTC), defaults to now
+        :return:
+        """
+
+        completed = completed or datetime.datetime.utcnow().isoformat()
+        if stockpile_info.get("backup_successful"):
+            self.last_successful_backups[host_name] = completed
+        stockpile_info["last_successful_backup"] = self.last_successful_backups.get(host_name)
+        if stockpile_info.get("skip_reason") == "deferred":
+            duration = None
+        self.history_rows.append(
+            (
+                host_name,
+                completed,
+                stockpile_info.get("last_backup_attempt"),
+                bool(stockpile_info.get("backup_successful")),
+                bool(stockpile_info.get("save_config_successful")),
+                bool(stockpile_info.get("http_used")),
+                bool(stockpile_info.get("ssh_used")),
+                stockpile_info.get("skip_reason"),
+                blob,
+                size,
+                changed,
+                duration,
+                stockpile_info.get("api_used"),
+            )
+        )
+
+    def awaiting_save(self, host: Host, stockpile_info: StockpileResults, changed: bool) -> bool:
+        """
+        Is this host's config left to our deferred save config phase?  Only hosts we've just backed up are saved, with
+        `changed`, only if their config changed since our last commit.
+        :param host:
+        :param stockpile_info: The host's StockpileResults
+        :param changed: Did its config change since our last commit?
+        :return:
+        """
+
+        mode = save_config_mode(host=host)
+        if mode not in ("deferred", "changed") or not stockpile_info.get("backup_successful"):
+            return False
+        if stockpile_info.get("skip_reason") or (mode == "changed" and not changed):
+            return False
+        if self.deferred_save is None:
+            logger.warning("Not saving the configuration of %s, this engine has no deferred save config phase", host)
+            return False
+        return True
+
+    def run_deferred_save(self) -> None:
+        """
+        Save the configs of the hosts awaiting our deferred save config phase, then report them as we would have when
+        they completed
+        :return:
+        """
+
+        print(f"Saving the configuration of {len(self.pending_saves)} device(s)")
+        save_start = time.perf_counter()
+        saved = self.deferred_save.run(
+            saves={
+                host_name: {
+                    "http_used": bool(pending["stockpile_info"].get("http_used")),
+                    "http_mgmt_port": pending["stockpile_info"].get("http_mgmt_port"),
+                    "api_used": pending["stockpile_info"].get("api_used"),
+                }
+                for (host_name, pending) in self.pending_saves.items()
+            }
+        )
+        self.metrics.observe(phase="deferred_save_config", seconds=time.perf_counter() - save_start)
+
+        for host_name, pending in self.pending_saves.items():
+            stockpile_info = pending.pop("stockpile_info")
+            stockpile_info["save_config_successful"] = saved.get(host_name, False)
+            self.record_history(host_name=host_name, stockpile_info=stockpile_info, **pending)
+            self.results.append(host_name=host_name, stockpile_info=stockpile_info)
+            if not stockpile_info["save_config_successful"]:
+                print(f"  - {host_name}: Save Config Failed")
+        self.pending_saves = {}
+
+    def carry_over(self, stockpile_directory: pathlib.Path, host_name: str, entry: Dict[str, Any]) -> None:
+        """
+        Report a host carried over from an interrupted run as though it was backed up in this one, and note if the
+        config file it wrote differs from what's in our last commit
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :param host_name:
+        :param entry: Its checkpoint journal entry
+        :return:
+        """
+
+        stockpile_info = StockpileResults(name=f"{host_name}_backup", **entry["result"])
+        repo_path = entry.get("path") or f"{host_name}.txt"
+        changed = self.committed_blobs.get(repo_path) != entry["blob"]
+        if changed:
+            self.changed_files.add(repo_path)
+        self.record_change_marker(host_name=host_name, marker=stockpile_info.get("change_marker"))
+        self.record_history(
+            host_name=host_name,
+            stockpile_info=stockpile_info,
+            blob=entry["blob"],
+            size=entry.get("size"),
+            changed=changed,
+            duration=entry.get("duration"),
+            completed=entry["completed"],
+        )
+        self.results.append(host_name=host_name, stockpile_info=stockpile_info)
+        self.metrics.record_outcome(outcome="resumed")
+        print(f"  - {host_name}: Stockpile Resumed")
+
+    def write_history(self, commit_sha: Optional[str]) -> None:
+        """
+        Record this run, and every host's row, in our history index, then close it
+        :param commit_sha: The commit this run made, if it made one
+        :return:
+        """
+
+        if self.history is None:
+            return
+        try:
+            self.history.record_run(
+                started=self.metrics.start_time.isoformat(),
+                finished=datetime.datetime.utcnow().isoformat(),
+                commit_sha=commit_sha,
+                backups=self.history_rows,
+            )
+        except sqlite3.Error as e:
+            logger.error("Unable to record this run in the history index at %s: %s", self.history.path, e)
+        self.history.close()
+        self.history = None
+        self.history_rows = []
+
+    def print_phase_summary(self) -> None:
+        """
+        Print the median, 99th percentile, and total time spent in each phase of this run
+        :return:
+        """
+
+        phases = self.metrics.summary(slowest=0)["phases"]
+        if not phases:
+            return
+        print("Backup Task Phase Timings (p50 / p99 / total seconds):")
+        for phase, stats in phases.items():
+            print(
+                f"  - {phase}: {stats['p50_seconds']:.3f} / {stats['p99_seconds']:.3f} / {stats['total_seconds']:.3f}"
+            )
+
+    @staticmethod
+    def outcome(result: MultiResult, stockpile_info: Any) -> str:
+        """
+        Classify the outcome of a host's stockpile task
+        :param result: The host's MultiResult
+        :param stockpile_info: Its StockpileResults (if it has them)
+        :return: `failed`, `deferred` (not started before the run's deadline), `skipped` (i.e. unchanged), or
+            `successful`
+        """
+
+        if result.failed:
+            return "failed"
+        skip_reason = stockpile_info.get("skip_reason") if isinstance(stockpile_info, StockpileResults) else None
+        if skip_reason == "deferred":
+            return "deferred"
+        if skip_reason:
+            return "skipped"
+        return "successful"
+
+    @classmethod
+    def release_results(cls, results: Any) -> None:
+        """
+        Drop the device config from a host's results, along with the subtask outputs that hold copies of it
+        (command output, HTTP responses, and file diffs), leaving the StockpileResults for reporting.
+        :param results: A Nornir MultiResult (or Result) for a host
+        :return:
+        """
+
+        if isinstance(results, Result):
+            results = [results]
+        for r in results:
+            if isinstance(r, MultiResult):
+                cls.release_results(results=r)
+            elif isinstance(r.result, StockpileResults):
+                r.result["device_config"] = None
+            else:
+                r.result = None
+                r.diff = ""
+                if hasattr(r, "response"):
+                    r.response = None
+
+    def load_change_markers(self, stockpile_directory: pathlib.Path) -> None:
+        """
+        Load the change markers recorded at each host's last successful backup, dropping any whose config is no longer
+        in our stockpile (so that host isn't skipped), and rewriting the manifest if we did, before any tasks read it.
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :return:
+        """
+
+        markers = load_manifest(stockpile_directory=stockpile_directory)
+        self.change_markers = {
+            host_name: marker
+            for (host_name, marker) in markers.items()
+            if pathlib.Path(stockpile_directory / self.committed_configs.get(host_name, f"{host_name}.txt")).is_file()
+        }
+        if len(self.change_markers) != len(markers):
+            save_manifest(stockpile_directory=stockpile_directory, markers=self.change_markers)
+
+    def record_change_marker(self, host_name: str, marker: Optional[str]) -> None:
+        """
+        Record (or forget, if it has none) the change marker of a host we've successfully backed up
+        :param host_name:
+        :param marker:
+        :return:
+        """
+
+        if marker is not None and self.change_markers.get(host_name) != marker:
+            self.change_markers[host_name] = marker
+            self.change_markers_updated = True
+        elif marker is None and host_name in self.change_markers:
+            del self.change_markers[host_name]
+            self.change_markers_updated = True
+
+    @staticmethod
+    def git_exclude(repo: Repo, pattern: str) -> None:
+        """
+        Ensure a pattern is in the repository's (local, uncommitted) `.git/info/exclude`
+        :param repo: An instantiated git.Repo object
+        :param pattern: A gitignore style pattern
+        :return:
+        """
+
+        exclude_file = pathlib.Path(repo.git_dir) / "info" / "exclude"
+        existing = exclude_file.read_text() if exclude_file.is_file() else ""
+        if pattern in existing.splitlines():
+            return
+        exclude_file.parent.mkdir(parents=True, exist_ok=True)
+        with exclude_file.open(mode="a") as f:
+            if existing and not existing.endswith("\n"):
+                f.write("\n")
+            f.write(f"{pattern}\n")
+
+    @staticmethod
+    def git_fast_import_commit(
+        repo: Repo, paths: List[str], message: str, author: Actor, removed: Optional[List[str]] = None
+    ) -> None:
+        """
+        Commit files from the work tree onto the current branch by streaming them straight into `git fast-import`.
+        Unlike committing through the index, neither the index nor the rest of the work tree is read or written,
+        so the cost depends only on the files being committed, not on the size of the repository.
+        :param repo: An instantiated git.Repo object
+        :param paths: Repository relative (posix) paths of the files to commit
+        :param message: The commit message
+        :param author: Author (and committer) of the commit
+        :param removed: Repository relative (posix) paths of files to remove in the commit
+        :return:
+        """
+
+        branch = repo.git.symbolic_ref("HEAD")
+        identity = f"{author.name} <{author.email}> {int(time.time())} +0000".encode()
+        message_bytes = message.encode()
+        work_tree = pathlib.Path(repo.working_tree_dir)
+
+        process = subprocess.Popen(
+            ["git", "fast-import", "--quiet", "--done"],
+            cwd=str(work_tree),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            stream = process.stdin
+            stream.write(b"commit %s\n" % branch.encode())
+            stream.write(b"author %s\ncommitter %s\n" % (identity, identity))
+            stream.write(b"data %d\n%s\n" % (len(message_bytes), message_bytes))
+            if repo.head.is_valid():
+                stream.write(b"from %s\n" % repo.head.commit.hexsha.encode())
+            for path in removed or []:
+                stream.write(b"D %s\n" % ProcessStockpiles.fast_import_quote(path))
+            for path in paths:
+                content = pathlib.Path(work_tree / path).read_bytes()
+                quoted = ProcessStockpiles.fast_import_quote(path)
+                stream.write(b"M 100644 inline %s\ndata %d\n" % (quoted, len(content)))
+                stream.write(content)
+                stream.write(b"\n")
+            stream.write(b"done\n")
+        except BrokenPipeError:
+            pass  # fast-import exited early, its error is reported below
+        # Finishes our stream (closing fast-import's input) and waits for it to exit
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            raise OSError(f"git fast-import failed to commit to {work_tree}: {stderr.decode(errors='replace')}")
+
+    @staticmethod
+    def fast_import_quote(path: str) -> bytes:
+        """
+        C style quote a path for `git fast-import`, in case a host name has spaces or quotes in it
+        :param path: A repository relative (posix) path
+        :return:
+        """
+
+        return ('"' + path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"').encode()
+
+    @staticmethod
+    def git_maintenance(repo: Repo) -> None:
+        """
+        Let Git repack the repository if loose objects or packs have built up (every fast-import commit adds a pack),
+        according to its `gc.auto` and `gc.autoPackLimit` settings, so the pack count stays bounded.  This is a quick
+        check most runs, and the repack itself runs in the background.
+        :param repo: An instantiated git.Repo object
+        :return:
+        """
+
+        try:
+            repo.git.gc("--auto", "--quiet")
+        except GitCommandError as e:
+            logger.warning("Unable to run git gc on %s: %s", repo.working_tree_dir, e)
+
     @staticmethod
     def git_initialize(stockpile_directory: pathlib.Path) -> Repo:
         """
@@ -134,3 +754,60 @@ class ProcessStockpiles(Processor):
             repo = Repo(path=str(stockpile_directory))
 
         return repo
+
+    @staticmethod
+    def git_committed_blobs(repo: Repo) -> Dict[str, str]:
+        """
+        Gather the blob hash of every file in the HEAD commit, without walking the work tree.
+        :param repo: An instantiated git.Repo object
+        :return: A Dict of repository relative (posix) paths to their blob hex SHA
+        """
+
+        if not repo.head.is_valid():
+            return {}
+
+        blobs = {}
+        for entry in repo.git.ls_tree("-r", "-z", "HEAD").split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", maxsplit=1)
+            _, object_type, sha = info.split()
+            if object_type == "blob":
+                blobs[path] = sha
+        return blobs
+
+    @staticmethod
+    def committed_config_paths(committed_blobs: Dict[str, str]) -> Dict[str, str]:
+        """
+        Where each host's config is in our last commit, whatever layout it was written under
+        (see stockpiler.tasks.stockpile.config_files)
+        :param committed_blobs: A Dict of repository relative (posix) paths to their blob hex SHA
+        :return: A Dict of host name to the repository relative path of its config
+        """
+
+        return {
+            posixpath.basename(path)[: -len(".txt")]: path
+            for path in committed_blobs
+            if path.endswith(".txt") and not path.startswith(f"{STATE_DIRECTORY}/")
+        }
+
+    @staticmethod
+    def git_blob_hash(file_path: pathlib.Path) -> str:
+        """
+        Calculate the hash Git would give this file's contents as a blob, i.e. `git hash-object <file>`
+        :param file_path: An instantiated pathlib.Path object for the file to hash
+        :return: The blob hex SHA
+        """
+
+        return blob_hash(file_path.read_bytes())
+
+    @staticmethod
+    def repo_path(repo: Repo, file_path: pathlib.Path) -> str:
+        """
+        Convert a file path into the repository relative, posix style path Git uses
+        :param repo: An instantiated git.Repo object
+        :param file_path: An instantiated pathlib.Path object of a file within the repository
+        :return:
+        """
+
+        return pathlib.Path(file_path).resolve().relative_to(pathlib.Path(repo.working_tree_dir).resolve()).as_posix()
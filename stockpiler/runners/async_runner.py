@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+
+"""
+An asyncio based collection engine for stockpiling device configurations.
+
+Rather than holding a worker thread (and a paramiko session) per device like the Nornir thread pool does, this runs
+every SSH/HTTPS session on a single event loop so thousands of devices can be in flight at once.  The work done per
+device mirrors `stockpile_cisco_generic` and `stockpile_cisco_asa`, and the results are fed through the same
+Processor hooks so `ProcessStockpiles` builds the CSV and Git commit unchanged.
+
+Requires the optional `async` dependencies: `pip install stockpiler[async]`
+"""
+
+import asyncio
+import ipaddress
+from logging import getLogger
+import pathlib
+import re
+import traceback
+from typing import List, Optional, Tuple
+from urllib.parse import quote_plus
+
+
+from nornir.core import Nornir
+from nornir.core.inventory import Host
+from nornir.core.processor import Processor, Processors
+from nornir.core.task import AggregatedResult, MultiResult, Result, Task
+
+
+from stockpiler.runners.reachability import tcp_port_open
+from stockpiler.tasks.stockpile.config_files import config_path, write_config
+from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+try:
+    import aiohttp
+    import asyncssh
+except ImportError:  # pragma: no cover - optional dependencies
+    aiohttp = None
+    asyncssh = None
+
+try:
+    from aiohttp_socks import ProxyConnector
+except ImportError:  # pragma: no cover - optional dependency
+    ProxyConnector = None
+
+
+logger = getLogger("stockpiler")
+
+# A Cisco-like prompt at the end of the buffer, i.e. `router#` or `fw/pri/act>`
+PROMPT_PATTERN = re.compile(r"[\w.\-/:()@]+[>#]\s*$")
+LINEFEED_PATTERN = re.compile(r"\r\n\r|\r\r\r\n|\r\r\n|\r\n|\n\r")
+
+# Save configuration commands that differ from the `write mem` default (matching Netmiko's save_config)
+SAVE_CONFIG_COMMANDS = {
+    "cisco_nxos": "copy running-config startup-config",
+}
+
+
+class AsyncCliSession:
+    """
+    A minimal interactive CLI session over an asyncssh connection, enough to send show commands to a Cisco-like
+    device and collect the output up to the next prompt.
+    """
+
+    def __init__(self, connection: "asyncssh.SSHClientConnection", command_timeout: int = 120) -> None:
+        """
+        Initialize our CLI session
+        :param connection: An established asyncssh client connection
+        :param command_timeout: How long to wait for a prompt after sending a command
+        """
+
+        self.connection = connection
+        self.command_timeout = command_timeout
+        self.process = None
+        self.prompt = None
+
+    async def open(self) -> None:
+        """
+        Open an interactive shell, learn the device prompt, and disable paging.
+        :return:
+        """
+
+        self.process = await self.connection.create_process(term_type="vt100", term_size=(511, 24))
+        self.process.stdin.write("\n")
+        output = await self.read_until_prompt()
+        self.prompt = output.strip().splitlines()[-1].strip()
+        await self.send_command("terminal length 0")
+
+    async def read_until_prompt(self, echo: Optional[str] = None) -> str:
+        """
+        Read from the session until we see our learned prompt (or any prompt, if we haven't learned it yet)
+        :param echo: If provided, only accept a prompt that comes after this command echo, so stray prompts
+            left over from earlier output don't end the read early.
+        :return: The raw output read from the device
+        """
+
+        output = ""
+        start = 0
+        while True:
+            chunk = await asyncio.wait_for(self.process.stdout.read(65536), timeout=self.command_timeout)
+            if not chunk:
+                raise ConnectionError("Session closed while waiting for the device prompt")
+            output += chunk
+            if echo is not None:
+                echo_index = output.find(echo)
+                if echo_index < 0:
+                    continue
+                start = echo_index + len(echo)
+            tail_start = max(start, len(output) - 512)
+            stripped = output[tail_start:].rstrip()
+            if self.prompt is not None and stripped.endswith(self.prompt):
+                return output[start:]
+            if self.prompt is None and PROMPT_PATTERN.search(stripped):
+                return output[start:]
+
+    async def send_command(self, command: str) -> str:
+        """
+        Send a command and return its output, with the command echo and trailing prompt stripped
+        :param command: The command to execute
+        :return:
+        """
+
+        self.process.stdin.write(f"{command}\n")
+        output = LINEFEED_PATTERN.sub("\n", await self.read_until_prompt(echo=command)).replace("\r", "")
+        lines = output.split("\n")
+        if lines and not lines[0].strip():
+            lines = lines[1:]
+        if lines and lines[-1].strip().endswith(self.prompt):
+            lines = lines[:-1]
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        if self.process is not None:
+            self.process.close()
+        self.connection.close()
+
+
+class AsyncStockpileRunner:
+    """
+    Run a stockpile of every host in a Nornir inventory on a single asyncio event loop.
+    """
+
+    def __init__(
+        self,
+        norns: Nornir,
+        processors: Optional[List[Processor]] = None,
+        max_in_flight: int = 1000,
+        connect_timeout: int = 10,
+        command_timeout: int = 120,
+    ) -> None:
+        """
+        Initialize our runner
+        :param norns: An instantiated (and likely filtered) Nornir object, used for its inventory and configuration
+        :param processors: Nornir Processor objects to notify as the stockpile progresses, i.e. ProcessStockpiles
+        :param max_in_flight: Maximum number of devices being stockpiled at the same time
+        :param connect_timeout: Timeout for TCP port checks and SSH/HTTPS connection setup
+        :param command_timeout: Timeout to wait for a device to respond to a command
+        """
+
+        if asyncssh is None or aiohttp is None:
+            raise ImportError(
+                "The async engine requires the optional `asyncssh` and `aiohttp` packages,"
+                " install them with `pip install stockpiler[async]`"
+            )
+
+        self.norns = norns
+        self.processors = Processors(processors or [])
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        try:
+            self.ssh_config_file = norns.config.ssh.config_file
+        except AttributeError:
+            self.ssh_config_file = None
+
+    def run(
+        self,
+        stockpile_directory: pathlib.Path,
+        proxies: Optional[dict] = None,
+        backup_command: str = "more system:running-config",
+    ) -> AggregatedResult:
+        """
+        Stockpile every host in our inventory, notifying our processors just as `Nornir.run()` would.
+        :param stockpile_directory: An instantiated pathlib.Path object for the directory where we're writing configs
+        :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+        :param backup_command: What command to execute for backup, defaults to `more system:running-config`
+        :return: A Nornir AggregatedResult of each host's StockpileResults
+        """
+
+        task = Task(task=stockpile_device_config, proxies=proxies, stockpile_directory=stockpile_directory)
+        self.processors.task_started(task)
+        result = asyncio.run(self._run_all(task=task, backup_command=backup_command))
+        self.processors.task_completed(task, result)
+
+        return result
+
+    async def _run_all(self, task: Task, backup_command: str) -> AggregatedResult:
+        """
+        Schedule every host onto the event loop, bounded by our in flight limit.
+        :param task:
+        :param backup_command:
+        :return:
+        """
+
+        agg_result = AggregatedResult(task.name)
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        proxies = task.params["proxies"]
+
+        connector = self._http_connector(proxies=proxies)
+        async with aiohttp.ClientSession(connector=connector) as http_session:
+
+            async def run_host(host: Host) -> None:
+                async with in_flight:
+                    agg_result[host.name] = await self._run_host(
+                        task=task, host=host, http_session=http_session, backup_command=backup_command
+                    )
+
+            await asyncio.gather(*(run_host(host) for host in self.norns.inventory.hosts.values()))
+
+        return agg_result
+
+    def _http_connector(self, proxies: Optional[dict]) -> "aiohttp.BaseConnector":
+        """
+        Build the shared HTTP connector, routing through our SOCKS proxy if we have one.
+        :param proxies: Optional Dict of SOCKS proxies, as passed to the Nornir tasks
+        :return:
+        """
+
+        if proxies:
+            if ProxyConnector is None:
+                raise ImportError("SOCKS proxies with the async engine require `pip install aiohttp-socks`")
+            return ProxyConnector.from_url(proxies["https"], limit=self.max_in_flight)
+        return aiohttp.TCPConnector(limit=self.max_in_flight)
+
+    async def _run_host(
+        self, task: Task, host: Host, http_session: "aiohttp.ClientSession", backup_command: str
+    ) -> MultiResult:
+        """
+        Stockpile a single host and wrap it up in a MultiResult as though Nornir had run it.
+        :param task:
+        :param host:
+        :param http_session:
+        :param backup_command:
+        :return:
+        """
+
+        self.processors.task_instance_started(task, host)
+
+        try:
+            if host.platform == "cisco_asa":
+                stockpile_info = await self.stockpile_cisco_asa(
+                    host=host,
+                    stockpile_directory=task.params["stockpile_directory"],
+                    http_session=http_session,
+                    backup_command=backup_command,
+                    proxies=task.params["proxies"],
+                )
+            else:
+                stockpile_info = await self.stockpile_cisco_generic(
+                    host=host, stockpile_directory=task.params["stockpile_directory"], backup_command=backup_command
+                )
+            r = Result(host=host, result=stockpile_info, changed=False, failed=not stockpile_info["backup_successful"])
+        except Exception as e:
+            tb = traceback.format_exc()
+            logger.error("Host %r: task %r failed with traceback:\n%s", host.name, task.name, tb)
+            r = Result(host=host, exception=e, result=tb, failed=True)
+
+        r.name = task.name
+        results = MultiResult(task.name)
+        results.append(r)
+
+        self.processors.task_instance_completed(task, host, results)
+        return results
+
+    @staticmethod
+    async def port_check(host: Host, check_name: str, port: int) -> bool:
+        """
+        Non-blocking equivalent of `port_check`, honoring any pre-flight reachability sweep results
+        :param host:
+        :param check_name: The name of this check in StockpileResults, i.e. `ssh_port_check_ok`
+        :param port:
+        :return:
+        """
+
+        if check_name in host.data:
+            return host.data[check_name]
+        return await tcp_port_open(hostname=host.hostname, port=port, timeout=1)
+
+    async def cli_backup(self, host: Host, port: int, backup_command: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Gather a backup via SSH, and save the config on the box.
+        :param host:
+        :param port:
+        :param backup_command:
+        :return: A Tuple of the backup output, and the save config output (either None if it failed, both if we
+            couldn't connect)
+        """
+
+        connect_kwargs = {
+            "port": port,
+            "username": host.username,
+            "password": host.password,
+            "known_hosts": None,
+            "client_keys": None,
+            "agent_path": None,
+        }
+        if self.ssh_config_file and pathlib.Path(self.ssh_config_file).expanduser().is_file():
+            connect_kwargs["config"] = [str(pathlib.Path(self.ssh_config_file).expanduser())]
+
+        try:
+            connection = await asyncio.wait_for(
+                asyncssh.connect(host.hostname, **connect_kwargs), timeout=self.connect_timeout
+            )
+        except (OSError, asyncio.TimeoutError, asyncssh.Error) as e:
+            logger.error("Unable to connect to %s via SSH: %s", host, e)
+            return None, None
+
+        session = AsyncCliSession(connection=connection, command_timeout=self.command_timeout)
+        backup_output = save_output = None
+        try:
+            await session.open()
+            backup_output = await session.send_command(backup_command)
+        except (OSError, asyncio.TimeoutError, asyncssh.Error) as e:
+            logger.error("Unable to backup %s via SSH: %s", host, e)
+        else:
+            try:
+                save_output = await session.send_command(SAVE_CONFIG_COMMANDS.get(host.platform, "write mem"))
+            except (OSError, asyncio.TimeoutError, asyncssh.Error) as e:
+                logger.error("Unable to save configuration on %s: %s", host, e)
+        finally:
+            session.close()
+
+        return backup_output, save_output
+
+    async def stockpile_cisco_generic(
+        self, host: Host, stockpile_directory: pathlib.Path, backup_command: str = "more system:running-config"
+    ) -> StockpileResults:
+        """
+        Async equivalent of `stockpile_cisco_generic`
+        :param host:
+        :param stockpile_directory: An instantiated pathlib.Path object for the directory we're writing this to
+        :param backup_command: What command to execute for backup, defaults to `more system:running-config`
+        :return:
+        """
+
+        stockpile_info = StockpileResults(
+            name=f"{host}_backup",
+            ip=host.hostname,
+            hostname=host.get("device_name", host),
+            ssh_mgmt_port=host.get("port", 22) or 22,  # Need `or` statement as we're getting None from inventory
+        )
+
+        stockpile_info["ssh_port_check_ok"] = await self.port_check(
+            host=host, check_name="ssh_port_check_ok", port=stockpile_info["ssh_mgmt_port"]
+        )
+        if not stockpile_info["ssh_port_check_ok"]:
+            logger.error("Unable to reach SSH (%s) management port on %s", stockpile_info["ssh_mgmt_port"], host)
+            return stockpile_info
+
+        logger.debug("Attempting to backup %s:%s via SSH", host, stockpile_info["ssh_mgmt_port"])
+        backup_output, save_output = await self.cli_backup(
+            host=host, port=stockpile_info["ssh_mgmt_port"], backup_command=backup_command
+        )
+        self._update_cli_results(host=host, stockpile_info=stockpile_info, backup=backup_output, save=save_output)
+
+        await self._write_backup(host=host, stockpile_info=stockpile_info, stockpile_directory=stockpile_directory)
+        return stockpile_info
+
+    async def stockpile_cisco_asa(
+        self,
+        host: Host,
+        stockpile_directory: pathlib.Path,
+        http_session: "aiohttp.ClientSession",
+        backup_command: str = "more system:running-config",
+        proxies: Optional[dict] = None,
+    ) -> StockpileResults:
+        """
+        Async equivalent of `stockpile_cisco_asa`
+        :param host:
+        :param stockpile_directory: An instantiated pathlib.Path object for the directory we're writing this to
+        :param http_session: A shared aiohttp ClientSession for our HTTPS requests
+        :param backup_command: What command to execute for backup, defaults to `more system:running-config`
+        :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+        :return:
+        """
+
+        stockpile_info = StockpileResults(
+            name=f"{host}_backup",
+            ip=host.hostname,
+            hostname=host.get("device_name", host),
+            http_management=host.get("http_management", False),
+            http_mgmt_port=host.get("http_mgmt_port", 8443),
+            ssh_mgmt_port=host.get("port", 22) or 22,  # Need `or` statement as we're getting None from inventory
+        )
+
+        # Skip the HTTP port check if we're behind a proxy, it won't do us any good.
+        if stockpile_info["http_management"] and proxies is not None:
+            stockpile_info["http_port_check_ok"] = True
+        elif stockpile_info["http_management"]:
+            stockpile_info["http_port_check_ok"] = await self.port_check(
+                host=host, check_name="http_port_check_ok", port=stockpile_info["http_mgmt_port"]
+            )
+        stockpile_info["ssh_port_check_ok"] = await self.port_check(
+            host=host, check_name="ssh_port_check_ok", port=stockpile_info["ssh_mgmt_port"]
+        )
+
+        if not stockpile_info["http_port_check_ok"] and not stockpile_info["ssh_port_check_ok"]:
+            logger.error(
+                "Unable to reach either HTTP (%s) or SSH (%s) management ports on %s",
+                stockpile_info["http_mgmt_port"],
+                stockpile_info["ssh_mgmt_port"],
+                host,
+            )
+            return stockpile_info
+
+        if stockpile_info["http_port_check_ok"]:
+            logger.debug("Attempting to backup %s:%s via HTTPS", host, stockpile_info["http_mgmt_port"])
+            try:
+                await self._asa_http_backup(
+                    host=host, stockpile_info=stockpile_info, http_session=http_session, backup_command=backup_command
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error("HTTPS backup of %s failed: %s", host, e)
+
+        if not stockpile_info["backup_successful"] and stockpile_info["ssh_port_check_ok"]:
+            logger.debug("Attempting to backup %s:%s via SSH", host, stockpile_info["ssh_mgmt_port"])
+            backup_output, save_output = await self.cli_backup(
+                host=host, port=stockpile_info["ssh_mgmt_port"], backup_command=backup_command
+            )
+            self._update_cli_results(host=host, stockpile_info=stockpile_info, backup=backup_output, save=save_output)
+
+        await self._write_backup(host=host, stockpile_info=stockpile_info, stockpile_directory=stockpile_directory)
+        return stockpile_info
+
+    async def _asa_http_backup(
+        self, host: Host, stockpile_info: StockpileResults, http_session: "aiohttp.ClientSession", backup_command: str
+    ) -> None:
+        """
+        Gather a backup from an ASA via its `/admin/exec/` HTTPS interface, and save the config on the box.
+        :param host:
+        :param stockpile_info:
+        :param http_session:
+        :param backup_command:
+        :return:
+        """
+
+        # Don't verify TLS if host.hostname is an IP address:
+        try:
+            _ = ipaddress.ip_address(host.hostname)
+            ssl = False
+        except ValueError:
+            ssl = None
+
+        url = f"https://{host.hostname}:{stockpile_info['http_mgmt_port']}/admin/exec/"
+        request_kwargs = {
+            "auth": aiohttp.BasicAuth(host.username, host.password),
+            "headers": {"User-Agent": "ASDM"},
+            "ssl": ssl,
+            "timeout": aiohttp.ClientTimeout(total=self.command_timeout, sock_connect=self.connect_timeout),
+        }
+
+        async with http_session.get(url + quote_plus(backup_command), **request_kwargs) as response:
+            text = await response.text()
+            if response.status < 400 and "command authorization failed" not in text.lower():
+                stockpile_info["device_config"] = text
+                stockpile_info["backup_successful"] = True
+                stockpile_info["http_used"] = True
+                logger.debug("Successfully backed up %s", host)
+
+        async with http_session.get(url + quote_plus("write mem"), **request_kwargs) as response:
+            text = await response.text()
+            if response.status < 400 and "command authorization failed" not in text.lower():
+                stockpile_info["save_config_successful"] = True
+                logger.debug("Successfully saved configuration on %s", host)
+
+    @staticmethod
+    def _update_cli_results(
+        host: Host, stockpile_info: StockpileResults, backup: Optional[str], save: Optional[str]
+    ) -> None:
+        """
+        Record the outcome of an SSH backup in our StockpileResults
+        :param host:
+        :param stockpile_info:
+        :param backup: Output of the backup command
+        :param save: Output of the save config command
+        :return:
+        """
+
+        if backup is not None and "command authorization failed" not in backup.lower():
+            stockpile_info["device_config"] = backup
+            stockpile_info["backup_successful"] = True
+            stockpile_info["ssh_used"] = True
+            logger.debug("Successfully backed up %s", host)
+        if save is not None and "command authorization failed" not in save.lower():
+            stockpile_info["save_config_successful"] = True
+            logger.debug("Successfully saved configuration on %s", host)
+
+    @staticmethod
+    async def _write_backup(host: Host, stockpile_info: StockpileResults, stockpile_directory: pathlib.Path) -> None:
+        """
+        Write the backup to disk (off the event loop, atomically, and only if it changed) if we have one
+        :param host:
+        :param stockpile_info:
+        :param stockpile_directory:
+        :return:
+        """
+
+        if not stockpile_info["backup_successful"]:
+            logger.error("Failed to backup %s", host)
+            return
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, write_config, stockpile_directory, config_path(host=host), stockpile_info["device_config"]
+        )
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Decide which devices are due a backup this run, from how often each one's config has changed recently.
+
+Most devices change rarely (access switches monthly, say) while a few change daily (core routers, firewalls), so
+backing every device up on one fixed schedule mostly re-reads configs that haven't changed.  With a cadence policy a
+timer can fire often (i.e. hourly), and each run only backs up the devices that are due: a device is backed up a few
+times (`CHECKS_PER_CHANGE`) for each interval between its recent changes, bounded by a minimum and maximum interval.
+Change history comes from the history index (see stockpiler.history), devices without history are always due.
+
+The policy is set with `stockpile_cadence` in a device's (or more usually its groups') inventory data, as either:
+    - `adaptive`: the adaptive policy with our default bounds
+    - a number: a fixed interval, in seconds
+    - a dict: the adaptive policy with any of `min_interval`, `max_interval`, and `lookback` (all in seconds)
+Devices without a `stockpile_cadence` are backed up every run, as are those whose `stockpile_cadence` is invalid.
+"""
+
+import datetime
+from logging import getLogger
+import pathlib
+import sqlite3
+from typing import Dict, Optional, Tuple, Union
+
+
+from nornir.core import Nornir
+from nornir.core.inventory import Host
+
+
+from stockpiler.history import HistoryIndex
+from stockpiler.inventory.index import indexed_inventory
+
+
+logger = getLogger("stockpiler")
+
+DEFAULT_MIN_INTERVAL = 3600.0
+DEFAULT_MAX_INTERVAL = 86400.0
+DEFAULT_LOOKBACK = 30 * 86400.0
+
+# How many backups to take in the typical interval between a device's changes
+CHECKS_PER_CHANGE = 4
+
+# How early (as a fraction of its interval) a device is already due, so a run firing on the hour isn't missed by a
+# device whose last backup finished a minute after the hour
+DUE_SLACK = 0.1
+
+Cadence = Union[str, float, int, Dict[str, float]]
+
+
+def cadence_bounds(host: Host, cadence: Cadence) -> Tuple[float, float, float]:
+    """
+    The (min_interval, max_interval, lookback) of a host's cadence policy
+    :param host: A Nornir Host object, for our error message
+    :param cadence: Its `stockpile_cadence`
+    :return:
+    """
+
+    if cadence == "adaptive":
+        return DEFAULT_MIN_INTERVAL, DEFAULT_MAX_INTERVAL, DEFAULT_LOOKBACK
+    if isinstance(cadence, (int, float)) and not isinstance(cadence, bool):
+        return float(cadence), float(cadence), DEFAULT_LOOKBACK
+    if isinstance(cadence, dict) and set(cadence) <= {"min_interval", "max_interval", "lookback"}:
+        try:
+            bounds = (
+                float(cadence.get("min_interval", DEFAULT_MIN_INTERVAL)),
+                float(cadence.get("max_interval", DEFAULT_MAX_INTERVAL)),
+                float(cadence.get("lookback", DEFAULT_LOOKBACK)),
+            )
+        except (TypeError, ValueError):
+            bounds = None
+        if bounds is not None and bounds[0] <= bounds[1] and bounds[2] > 0:
+            return bounds
+    raise ValueError(
+        f"Invalid stockpile_cadence for {host}: {cadence!r}, expected `adaptive`, a number of seconds, or a dict of"
+        " `min_interval` (no more than `max_interval`), `max_interval`, and `lookback` seconds"
+    )
+
+
+def cadence_interval(min_interval: float, max_interval: float, lookback: float, changes: int) -> float:
+    """
+    How long to wait between backups of a device, given how often it has changed
+    :param min_interval: The shortest interval, no matter how often it changes
+    :param max_interval: The longest interval, for a device that hasn't changed
+    :param lookback: Seconds of history its changes were counted over
+    :param changes: How many times it changed in that time
+    :return: Seconds
+    """
+
+    if not changes:
+        return max_interval
+    return min(max_interval, max(min_interval, lookback / changes / CHECKS_PER_CHANGE))
+
+
+def due_hosts(
+    norns: Nornir,
+    last_successful_backups: Dict[str, str],
+    history: Optional[HistoryIndex],
+    now: Optional[datetime.datetime] = None,
+) -> Nornir:
+    """
+    Filter our inventory down to the hosts due a backup under their cadence policy
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param last_successful_backups: A Dict of host name to its last successful backup (ISO 8601, UTC)
+    :param history: Our stockpile's HistoryIndex, to count each host's changes
+    :param now: What time it is now (UTC), defaults to now
+    :return: A Nornir object of just the hosts that are due
+    """
+
+    now = now or datetime.datetime.utcnow()
+    change_counts: Dict[float, Dict[str, int]] = {}
+    due = []
+    for name, host in norns.inventory.hosts.items():
+        cadence = host.get("stockpile_cadence")
+        last_successful = last_successful_backups.get(name)
+        if cadence is None or last_successful is None:
+            due.append(name)
+            continue
+
+        try:
+            min_interval, max_interval, lookback = cadence_bounds(host=host, cadence=cadence)
+        except ValueError as e:
+            # One typo in the inventory shouldn't stop the backups of the rest of the fleet
+            logger.error("%s, backing it up every run (as without a cadence) until it's fixed", e)
+            due.append(name)
+            continue
+        # Changes are counted once for each lookback window in use, there are rarely more than one or two
+        if lookback not in change_counts:
+            since = now - datetime.timedelta(seconds=lookback)
+            change_counts[lookback] = history.change_counts(since=since) if history is not None else {}
+        interval = cadence_interval(
+            min_interval=min_interval,
+            max_interval=max_interval,
+            lookback=lookback,
+            changes=change_counts[lookback].get(name, 0),
+        )
+        elapsed = (now - datetime.datetime.fromisoformat(last_successful)).total_seconds()
+        if elapsed >= interval * (1 - DUE_SLACK):
+            due.append(name)
+
+    logger.info("%s of %s devices are due a backup under their cadence", len(due), len(norns.inventory.hosts))
+    due_norns = Nornir(**norns.__dict__)
+    due_norns.inventory = indexed_inventory(inventory=norns.inventory, host_names=due)
+    return due_norns
+
+
+def select_due(norns: Nornir, stockpile_directory: pathlib.Path) -> Nornir:
+    """
+    Filter our inventory down to the hosts due a backup, from our stockpile's history index.  Without one, every
+    host is due.
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :return:
+    """
+
+    try:
+        history = HistoryIndex(stockpile_directory=stockpile_directory, create=False)
+    except (OSError, sqlite3.Error) as e:
+        logger.info("Backing up every device, without a history to set their cadence from: %s", e)
+        return norns
+    try:
+        return due_hosts(norns=norns, last_successful_backups=history.last_successful_backups(), history=history)
+    finally:
+        history.close()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+A long-running Stockpiler daemon, with an internal scheduler and warm device connections.
+
+Rather than paying Python/Nornir start up, inventory parsing, credential gathering, and opening the Git repository
+on every run, `stockpiler serve` keeps all of these loaded and runs backups on a schedule.  Each host is backed up
+every `--interval` seconds, unless it sets its own (usually shorter) `stockpile_interval` in its inventory data.
+
+Frequently polled hosts (those with a `stockpile_interval` shorter than the default) keep their Netmiko connection
+(or HTTPS session) open between runs in a bounded, least recently used pool, so a short interval backup of a core
+device costs one command round-trip instead of a full login.
+"""
+
+from collections import OrderedDict
+from logging import getLogger
+import pathlib
+import signal
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, TYPE_CHECKING
+
+
+from nornir.core import Nornir
+from nornir.core.inventory import Host
+
+
+from stockpiler.processors.process_stockpiles import ProcessStockpiles
+from stockpiler.runners.reachability import reachability_sweep
+from stockpiler.tasks.stockpile.http_sessions import HTTPSessions
+from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+
+
+if TYPE_CHECKING:  # pragma: no cover
+    from stockpiler.runners.save_config import DeferredSaveConfig
+
+
+logger = getLogger("stockpiler")
+
+
+class ConnectionPool:
+    """
+    A bounded pool of hosts whose Netmiko connections are kept open between runs, evicting the least recently used.
+    """
+
+    def __init__(self, size: int = 100) -> None:
+        """
+        Initialize our pool
+        :param size: Maximum number of hosts to keep connections open for
+        """
+
+        self.size = size
+        self.hosts: "OrderedDict[str, Host]" = OrderedDict()
+
+    @staticmethod
+    def close(host: Host) -> None:
+        """
+        Close any open connections (and HTTPS session) to a host, ignoring errors from connections the device already
+        dropped
+        :param host:
+        :return:
+        """
+
+        HTTPSessions.close(host_name=host.name)
+
+        for connection in list(host.connections.keys()):
+            try:
+                host.close_connection(connection)
+            except Exception as e:
+                logger.debug("Error closing %s connection to %s: %s", connection, host, e)
+
+    def prune(self) -> None:
+        """
+        Drop pooled connections the device (or something in between) has closed since our last run,
+        so the next backup opens a fresh one.
+        :return:
+        """
+
+        for name, host in list(self.hosts.items()):
+            connection = host.connections.get("netmiko")
+            if connection is None:
+                # Hosts managed over HTTPS only hold a session, whose dropped connections are replaced as needed
+                if name not in HTTPSessions:
+                    del self.hosts[name]
+                continue
+            try:
+                alive = connection.connection.is_alive()
+            except Exception:
+                alive = False
+            if not alive:
+                logger.debug("Pooled connection to %s is no longer alive, dropping it", name)
+                self.close(host)
+                del self.hosts[name]
+
+    def checkin(self, hosts: Iterable[Host], warm: Iterable[str]) -> None:
+        """
+        After a run, keep connections to the warm hosts (marking them most recently used), close the rest, and evict
+        the least recently used hosts beyond our size.
+        :param hosts: The hosts that were just backed up
+        :param warm: Names of the hosts that should keep their connections open
+        :return:
+        """
+
+        warm = set(warm)
+        for host in hosts:
+            if host.name in warm and ("netmiko" in host.connections or host.name in HTTPSessions):
+                self.hosts[host.name] = host
+                self.hosts.move_to_end(host.name)
+            elif host.name not in self.hosts:
+                self.close(host)
+
+        while len(self.hosts) > self.size:
+            name, host = self.hosts.popitem(last=False)
+            logger.debug("Evicting %s from the connection pool", name)
+            self.close(host)
+
+    def close_all(self) -> None:
+        for host in self.hosts.values():
+            self.close(host)
+        self.hosts.clear()
+
+
+class StockpileDaemon:
+    """
+    Keep our inventory and stockpile repository loaded, and back up each host on its schedule.
+    """
+
+    def __init__(
+        self,
+        norns: Nornir,
+        stockpile_directory: pathlib.Path,
+        proxies: Optional[dict] = None,
+        interval: float = 43200,
+        pool_size: int = 100,
+        preflight: bool = False,
+        preflight_workers: int = 512,
+        metrics_directory: Optional[pathlib.Path] = None,
+        commit_backend: str = "index",
+        deferred_save: Optional["DeferredSaveConfig"] = None,
+    ) -> None:
+        """
+        Initialize our daemon
+        :param norns: An instantiated (and likely filtered) Nornir object, with credentials already set
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+        :param interval: Default number of seconds between backups of a host, hosts may override this with
+            `stockpile_interval` in their inventory data
+        :param pool_size: Maximum number of frequently polled hosts to keep connections open to
+        :param preflight: Run a reachability sweep before each scheduled run
+        :param preflight_workers: Maximum concurrent connection attempts in the reachability sweep
+        :param metrics_directory: Where to write the phase timings of each scheduled run (see stockpiler.metrics)
+        :param commit_backend: How to commit changed configs, `index` or `fast-import` (see ProcessStockpiles)
+        :param deferred_save: Our save config phase, run after each scheduled run's backups (see
+            stockpiler.runners.save_config)
+        """
+
+        self.norns = norns
+        self.stockpile_directory = stockpile_directory
+        self.proxies = proxies
+        self.interval = interval
+        self.preflight = preflight
+        self.preflight_workers = preflight_workers
+        self.metrics_directory = metrics_directory
+        self.commit_backend = commit_backend
+        self.deferred_save = deferred_save
+        self.pool = ConnectionPool(size=pool_size)
+        self.repo = ProcessStockpiles.git_initialize(stockpile_directory=stockpile_directory)
+        self.stopping = threading.Event()
+        self.next_due: Dict[str, float] = {name: 0.0 for name in norns.inventory.hosts}
+
+    def host_interval(self, host: Host) -> float:
+        """
+        How often should this host be backed up?
+        :param host:
+        :return: Seconds between backups
+        """
+
+        return float(host.get("stockpile_interval", self.interval) or self.interval)
+
+    def warm_hosts(self) -> List[str]:
+        """
+        Names of the hosts polled more often than our default interval, whose connections are worth keeping open
+        :return:
+        """
+
+        return [name for (name, host) in self.norns.inventory.hosts.items() if self.host_interval(host) < self.interval]
+
+    def stop(self, *args) -> None:
+        """
+        Ask the daemon to stop after any run in progress, i.e. on SIGTERM from systemd
+        :return:
+        """
+
+        logger.info("Stopping Stockpiler daemon")
+        self.stopping.set()
+
+    def run_due(self) -> None:
+        """
+        Back up every host that is due, as one run with one commit, and schedule their next backups.
+        :return:
+        """
+
+        now = time.monotonic()
+        due = {name for (name, due_at) in self.next_due.items() if due_at <= now}
+        if not due:
+            return
+
+        logger.info("Running scheduled backup of %s devices", len(due))
+        # Nornir skips hosts that failed a previous run, we want to retry them on schedule
+        self.norns.data.reset_failed_hosts()
+        self.pool.prune()
+
+        due_norns = self.norns.filter(filter_func=lambda h: h.name in due)
+        unreachable = []
+        if self.preflight:
+            due_norns, unreachable = reachability_sweep(
+                norns=due_norns, proxies=self.proxies, max_in_flight=self.preflight_workers
+            )
+
+        processor = ProcessStockpiles(
+            unreachable=unreachable,
+            repo=self.repo,
+            metrics_directory=self.metrics_directory,
+            commit_backend=self.commit_backend,
+            deferred_save=self.deferred_save,
+        )
+        due_norns.with_processors(processors=[processor]).run(
+            task=stockpile_device_config, proxies=self.proxies, stockpile_directory=self.stockpile_directory
+        )
+        self.pool.checkin(hosts=due_norns.inventory.hosts.values(), warm=self.warm_hosts())
+
+        for name in due:
+            self.next_due[name] = now + self.host_interval(self.norns.inventory.hosts[name])
+
+    def serve(self) -> None:
+        """
+        Run scheduled backups until we're asked to stop.
+        :return:
+        """
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(
+            "Stockpiler daemon started for %s devices (%s frequently polled)",
+            len(self.norns.inventory.hosts),
+            len(self.warm_hosts()),
+        )
+
+        try:
+            while not self.stopping.is_set():
+                self.run_due()
+                if not self.next_due:
+                    break
+                self.stopping.wait(timeout=max(min(self.next_due.values()) - time.monotonic(), 0))
+        finally:
+            self.pool.close_all()
+            HTTPSessions.close_all()
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+"""
+Distributed collection across several collector nodes, with one authoritative stockpile repository.
+
+A coordinator splits the inventory into shards (see stockpiler.runners.sharding) and hands one to each worker that
+connects.  A worker stockpiles its shard into a scratch directory, then ships back a compact bundle: the compressed
+configs that differ from what the coordinator last committed, and each host's StockpileResults (and phase timings, taken
+on the worker, see stockpiler.runners.multiprocess.TimeHostPhases).  The coordinator
+writes the changed configs into its stockpile and feeds the results through the same Processor hooks, so
+`ProcessStockpiles` writes one `results.csv` and makes a single Git commit.
+
+Coordinator and workers talk over `multiprocessing.connection`, authenticated with a shared key.
+"""
+
+from logging import getLogger
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+import pathlib
+import queue
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import zlib
+
+
+from nornir.core import Nornir
+from nornir.core.inventory import Host
+from nornir.core.processor import Processor, Processors
+from nornir.core.task import AggregatedResult, MultiResult, Task
+
+
+from stockpiler.processors.process_stockpiles import ProcessStockpiles
+from stockpiler.runners.multiprocess import portable_result, report_host_result, TimeHostPhases
+from stockpiler.runners.reachability import reachability_sweep
+from stockpiler.runners.sharding import shard_hosts
+from stockpiler.tasks.stockpile.change_markers import load_manifest, save_manifest
+from stockpiler.tasks.stockpile.config_files import config_path, write_config
+from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+logger = getLogger("stockpiler")
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """
+    Split a `host:port` string into a (host, port) Tuple
+    :param address:
+    :return:
+    """
+
+    host, _, port = address.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+
+class BundleResults(TimeHostPhases):
+    """
+    A Nornir Processor, used on a worker, that collects each host's results (and phase timings) and any config that
+    changed from what the coordinator has committed, to be shipped back to the coordinator as one bundle.
+    """
+
+    def __init__(self, stockpile_directory: pathlib.Path, committed_blobs: Dict[str, Optional[str]]) -> None:
+        """
+        Initialize our bundle
+        :param stockpile_directory: The (scratch) directory our configs are being written to
+        :param committed_blobs: A Dict of host name to the blob hash of its config in the coordinator's last commit
+        """
+
+        super().__init__()
+        self.stockpile_directory = stockpile_directory
+        self.committed_blobs = committed_blobs
+        self.rows: List[Tuple[str, Any, bool, Dict[str, float]]] = []
+        self.configs: Dict[str, bytes] = {}
+        self.lock = threading.Lock()
+
+    def task_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
+        """
+        Add this host's results to the bundle, along with its compressed config if it changed
+        :param task:
+        :param host:
+        :param result:
+        :return:
+        """
+
+        phases = self.host_phases(host=host)
+        config = None
+        host_result = result[0].result
+        config_file = pathlib.Path(self.stockpile_directory / config_path(host=host))
+        if isinstance(host_result, StockpileResults) and host_result.get("backup_successful") and config_file.is_file():
+            if ProcessStockpiles.git_blob_hash(config_file) != self.committed_blobs.get(host.name):
+                config = zlib.compress(config_file.read_bytes())
+            config_file.unlink()
+
+        with self.lock:
+            self.rows.append((host.name, portable_result(host_result), result.failed, phases))
+            if config is not None:
+                self.configs[host.name] = config
+        ProcessStockpiles.release_results(results=result)
+
+
+class DistributedWorker:
+    """
+    Connect to a coordinator, stockpile the shard it assigns us, and send back the results.
+    """
+
+    def __init__(
+        self,
+        norns: Nornir,
+        address: Tuple[str, int],
+        authkey: bytes,
+        shard: Optional[int] = None,
+        stockpile_task: Callable[..., Any] = stockpile_device_config,
+        connect_timeout: float = 300,
+        preflight: bool = False,
+        preflight_workers: int = 512,
+    ) -> None:
+        """
+        Initialize our worker
+        :param norns: An instantiated Nornir object, with credentials already set
+        :param address: The (host, port) of the coordinator
+        :param authkey: The key shared with the coordinator
+        :param shard: Ask for a specific shard (i.e. for a regional collector), otherwise take whichever is next
+        :param stockpile_task: The Nornir task to stockpile each host with
+        :param connect_timeout: How long to keep retrying to reach the coordinator, in seconds
+        :param preflight: Check the reachability of our shard's hosts in one sweep before stockpiling them
+        :param preflight_workers: Maximum concurrent connection attempts in that sweep
+        """
+
+        self.norns = norns
+        self.address = address
+        self.authkey = authkey
+        self.shard = shard
+        self.stockpile_task = stockpile_task
+        self.connect_timeout = connect_timeout
+        self.preflight = preflight
+        self.preflight_workers = preflight_workers
+
+    def connect(self) -> Connection:
+        """
+        Connect to our coordinator, retrying until our connect timeout as it may not be listening yet.
+        :return:
+        """
+
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return Client(self.address, authkey=self.authkey)
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                logger.debug("Coordinator at %s:%s is not listening yet, retrying", *self.address)
+                time.sleep(1)
+
+    def run(self, proxies: Optional[dict] = None) -> bool:
+        """
+        Stockpile one shard for the coordinator.  With pre-flight, only the hosts of our shard are swept (see
+        stockpiler.runners.reachability), and those found unreachable are reported along with the rest of it.
+        :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity from this collector
+        :return: True if we were assigned (and completed) a shard
+        """
+
+        with self.connect() as conn:
+            conn.send({"shard": self.shard})
+            assignment = conn.recv()
+            if assignment is None:
+                logger.info("Coordinator at %s:%s has no shards left to assign", *self.address)
+                return False
+
+            host_names = set(assignment["host_names"])
+            logger.info(
+                "Assigned shard %s of %s (%s devices)", assignment["shard"], assignment["shards"], len(host_names)
+            )
+            shard_norns = self.norns.filter(filter_func=lambda h: h.name in host_names)
+            unreachable: List[StockpileResults] = []
+            if self.preflight:
+                shard_norns, unreachable = reachability_sweep(
+                    norns=shard_norns, proxies=proxies, max_in_flight=self.preflight_workers
+                )
+
+            with tempfile.TemporaryDirectory(prefix="stockpiler-") as scratch_directory:
+                # Our hosts' change markers from the coordinator, so unchanged configs can be skipped here too
+                save_manifest(
+                    stockpile_directory=pathlib.Path(scratch_directory), markers=assignment.get("change_markers", {})
+                )
+                bundler = BundleResults(
+                    stockpile_directory=pathlib.Path(scratch_directory), committed_blobs=assignment["committed_blobs"]
+                )
+                shard_norns.with_processors(processors=[bundler]).run(
+                    task=self.stockpile_task, proxies=proxies, stockpile_directory=pathlib.Path(scratch_directory)
+                )
+
+            # Report the hosts in our shard we found unreachable, and let the coordinator know about any other hosts
+            # missing from our inventory
+            for stockpile_info in unreachable:
+                host_name = stockpile_info.name.rsplit("_backup", 1)[0]
+                bundler.rows.append((host_name, portable_result(stockpile_info), True, {}))
+            reported = {row[0] for row in bundler.rows}
+            for host_name in host_names.difference(reported):
+                bundler.rows.append((host_name, "Host not found in worker inventory", True, {}))
+
+            conn.send({"shard": assignment["shard"], "rows": bundler.rows, "configs": bundler.configs})
+            logger.info("Sent %s results and %s changed configs", len(bundler.rows), len(bundler.configs))
+
+        return True
+
+
+class DistributedCoordinator:
+    """
+    Hand out shards of our inventory to workers and merge their results into our stockpile.
+    """
+
+    def __init__(
+        self,
+        norns: Nornir,
+        address: Tuple[str, int],
+        authkey: bytes,
+        processors: Optional[List[Processor]] = None,
+        shards: int = 2,
+        shard_by: str = "hash",
+        timeout: float = 43200,
+    ) -> None:
+        """
+        Initialize our coordinator
+        :param norns: An instantiated (and likely filtered) Nornir object
+        :param address: The (host, port) to listen for workers on
+        :param authkey: The key shared with our workers
+        :param processors: Nornir Processor objects to notify as results come in, i.e. ProcessStockpiles
+        :param shards: How many shards to split our inventory into
+        :param shard_by: How to split the inventory, see stockpiler.runners.sharding.shard_hosts
+        :param timeout: How long to wait for workers to complete every shard, in seconds
+        """
+
+        self.norns = norns
+        self.address = address
+        self.authkey = authkey
+        self.processors = Processors(processors or [])
+        self.shards = shards
+        self.shard_by = shard_by
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+    def run(self, stockpile_directory: pathlib.Path, proxies: Optional[dict] = None) -> AggregatedResult:
+        """
+        Wait for workers to stockpile every shard, notifying our processors just as `Nornir.run()` would.
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :param proxies: Unused, each worker uses its own proxy configuration
+        :return: A Nornir AggregatedResult of each host's StockpileResults
+        """
+
+        task = Task(task=stockpile_device_config, proxies=proxies, stockpile_directory=stockpile_directory)
+        self.processors.task_started(task)
+
+        sharded = [s for s in shard_hosts(norns=self.norns, shards=self.shards, shard_by=self.shard_by) if s]
+        assignments = self._assignments(sharded=sharded, stockpile_directory=stockpile_directory)
+        pending: "queue.Queue[int]" = queue.Queue()
+        for shard in range(len(sharded)):
+            pending.put(shard)
+        completed = set()
+        all_completed = threading.Event()
+        if not sharded:
+            all_completed.set()
+        agg_result = AggregatedResult(task.name)
+
+        def serve(conn: Connection) -> None:
+            exchanged = self._exchange(conn=conn, pending=pending, assignments=assignments)
+            if exchanged is None:
+                return
+            shard, bundle = exchanged
+            self._merge(task=task, bundle=bundle, agg_result=agg_result)
+            with self.lock:
+                completed.add(shard)
+                if len(completed) == len(sharded):
+                    all_completed.set()
+
+        listener = Listener(self.address, authkey=self.authkey)
+        logger.info("Waiting for workers on %s:%s to stockpile %s shards", *self.address, len(sharded))
+        threading.Thread(target=self._accept, args=(listener, serve, all_completed), daemon=True).start()
+        if not all_completed.wait(timeout=self.timeout):
+            logger.error("Timed out waiting for workers to complete every shard")
+        listener.close()
+
+        self._report_lost(task=task, agg_result=agg_result)
+        self.processors.task_completed(task, agg_result)
+        return agg_result
+
+    def _assignments(self, sharded: List[List[str]], stockpile_directory: pathlib.Path) -> List[Dict[str, Any]]:
+        """
+        What to send the worker assigned each shard: its hosts, with the blob hashes of their configs in our last
+        commit and their change markers, so unchanged configs can be skipped
+        :param sharded: The host names of each shard
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        :return: A List of each shard's assignment
+        """
+
+        committed_blobs = ProcessStockpiles.git_committed_blobs(
+            repo=ProcessStockpiles.git_initialize(stockpile_directory=stockpile_directory)
+        )
+        change_markers = load_manifest(stockpile_directory=stockpile_directory)
+        return [
+            {
+                "shard": shard,
+                "shards": len(sharded),
+                "host_names": host_names,
+                "committed_blobs": {
+                    n: committed_blobs.get(config_path(host=self.norns.inventory.hosts[n])) for n in host_names
+                },
+                "change_markers": {n: change_markers[n] for n in host_names if n in change_markers},
+            }
+            for (shard, host_names) in enumerate(sharded)
+        ]
+
+    def _exchange(
+        self, conn: Connection, pending: "queue.Queue[int]", assignments: List[Dict[str, Any]]
+    ) -> Optional[Tuple[int, dict]]:
+        """
+        Assign a connected worker a pending shard, and wait for its bundle of results.  If we lose the worker, its
+        shard is given to the next worker that connects.
+        :param conn: Our connection to the worker
+        :param pending: Shards yet to be assigned
+        :param assignments: Each shard's assignment
+        :return: A Tuple of the shard and the worker's bundle, or None if it has none for us
+        """
+
+        shard = None
+        try:
+            request = conn.recv()
+            shard = self._next_shard(pending=pending, requested=request.get("shard"))
+            if shard is None:
+                conn.send(None)
+                return None
+            conn.send(assignments[shard])
+            return shard, conn.recv()
+        except (EOFError, OSError) as e:
+            logger.error("Lost the worker handling shard %s: %s", shard, e)
+            if shard is not None:
+                pending.put(shard)
+            return None
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _accept(listener: Listener, serve: Callable[[Connection], None], all_completed: threading.Event) -> None:
+        """
+        Accept workers until every shard is completed, serving each on its own thread
+        :param listener:
+        :param serve: Called with each worker's connection
+        :param all_completed: Set once every shard is completed
+        :return:
+        """
+
+        while not all_completed.is_set():
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                logger.error("Rejected a worker with a bad authentication key")
+                continue
+            except OSError:
+                return  # The listener was closed
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    def _report_lost(self, task: Task, agg_result: AggregatedResult) -> None:
+        """
+        Report any host we never heard back about as failed, it was lost with its shard
+        :param task:
+        :param agg_result:
+        :return:
+        """
+
+        with self.lock:
+            for host_name, host in self.norns.inventory.hosts.items():
+                if host_name not in agg_result:
+                    agg_result[host_name] = report_host_result(
+                        processors=self.processors,
+                        task=task,
+                        host=host,
+                        host_result="No worker completed this host's shard",
+                        failed=True,
+                    )
+
+    @staticmethod
+    def _next_shard(pending: "queue.Queue[int]", requested: Optional[int]) -> Optional[int]:
+        """
+        Take the requested shard if it is still pending, otherwise the next pending shard.
+        :param pending:
+        :param requested:
+        :return:
+        """
+
+        shards = []
+        while True:
+            try:
+                shards.append(pending.get_nowait())
+            except queue.Empty:
+                break
+        shard = None
+        if requested in shards:
+            shard = requested
+        elif requested is None and shards:
+            shard = shards[0]
+        for s in shards:
+            if s != shard:
+                pending.put(s)
+        return shard
+
+    def _merge(self, task: Task, bundle: dict, agg_result: AggregatedResult) -> None:
+        """
+        Write a worker's changed configs into our stockpile, then report each of its hosts to our processors.
+        :param task:
+        :param bundle:
+        :param agg_result:
+        :return:
+        """
+
+        started = time.monotonic()
+        for host_name, config in bundle["configs"].items():
+            if host_name not in self.norns.inventory.hosts:
+                continue
+            write_config(
+                stockpile_directory=task.params["stockpile_directory"],
+                relative_path=config_path(host=self.norns.inventory.hosts[host_name]),
+                content=zlib.decompress(config),
+            )
+
+        with self.lock:
+            for host_name, host_result, failed, phases in bundle["rows"]:
+                if host_name not in self.norns.inventory.hosts:
+                    continue
+                agg_result[host_name] = report_host_result(
+                    processors=self.processors,
+                    task=task,
+                    host=self.norns.inventory.hosts[host_name],
+                    host_result=host_result,
+                    failed=failed,
+                    phases=phases,
+                )
+        logger.info(
+            "Merged shard %s (%s results, %s changed configs) in %.2fs",
+            bundle["shard"],
+            len(bundle["rows"]),
+            len(bundle["configs"]),
+            time.monotonic() - started,
+        )
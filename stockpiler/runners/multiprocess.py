@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+A multi-process collection engine for stockpiling device configurations.
+
+A single Stockpiler process spends most of its time in paramiko key exchange and cipher work, all bound to one core
+by the GIL.  This partitions the inventory across worker processes, each running its own Nornir thread pool.  The
+workers write config files into the stockpile directory as usual and stream each host's StockpileResults (and how long
+each phase of its task took, as they're timed where they run) back to the parent, which feeds them through the same
+Processor hooks so `ProcessStockpiles` writes one `results.csv` and makes a single Git commit.
+
+Worker processes are forked so they inherit the already initialized (and credentialed) Nornir inventory, so this
+engine is only available on POSIX platforms.
+"""
+
+from logging import getLogger
+import multiprocessing
+import pathlib
+import queue
+from typing import Dict, List, Optional, Union
+
+
+from nornir.core import Nornir
+from nornir.core.inventory import Host
+from nornir.core.processor import Processor, Processors
+from nornir.core.task import AggregatedResult, MultiResult, Result, Task
+
+
+from stockpiler.metrics import RunMetrics
+from stockpiler.processors.process_stockpiles import ProcessStockpiles
+from stockpiler.tasks.stockpile.concurrency import Limits
+from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+logger = getLogger("stockpiler")
+
+# Sent by a worker once it has reported on every host in its partition
+WORKER_DONE = "__stockpiler_worker_done__"
+
+
+def portable_result(host_result: object) -> Union[StockpileResults, str]:
+    """
+    Prepare a host's result to be sent to another process: StockpileResults without the config (which is written
+    to disk separately) and with values that aren't simple types (i.e. a `hostname` that is a Nornir Host) as
+    strings, or for a failed task, its failure text.
+    :param host_result: The `result` of a host's stockpile task
+    :return:
+    """
+
+    if not isinstance(host_result, StockpileResults):
+        return str(host_result)
+    return StockpileResults(
+        name=str(host_result.name),
+        **{
+            k: v if isinstance(v, (bool, int, float, str, type(None))) else str(v)
+            for (k, v) in host_result.items()
+            if k != "device_config"
+        },
+    )
+
+
+def report_host_result(
+    processors: Processors,
+    task: Task,
+    host: Host,
+    host_result: object,
+    failed: bool,
+    phases: Optional[Dict[str, float]] = None,
+) -> MultiResult:
+    """
+    Wrap up a host's results from another process as though Nornir had run it here, and notify our processors.  As
+    its task ran elsewhere, the phase timings it was sent with are recorded by ProcessStockpiles in place of timing
+    it here (which would only time how long it took us to report it).
+    :param processors: The Processors to notify
+    :param task:
+    :param host:
+    :param host_result: The host's StockpileResults, or a description of its failure
+    :param failed:
+    :param phases: A Dict of phase (i.e. `host` or `backup`) to the seconds it took, as timed by TimeHostPhases
+    :return:
+    """
+
+    for processor in processors:
+        if isinstance(processor, ProcessStockpiles):
+            processor.observe_host_phases(host_name=host.name, phases=phases or {})
+        else:
+            processor.task_instance_started(task, host)
+    r = Result(host=host, result=host_result, changed=False, failed=failed)
+    r.name = task.name
+    results = MultiResult(task.name)
+    results.append(r)
+    processors.task_instance_completed(task, host, results)
+    return results
+
+
+class TimeHostPhases:
+    """
+    A base for the Nornir Processors that send hosts' results on to another process, timing each host's task and its
+    phases (just as ProcessStockpiles would) where it runs, so they can be sent along with its results.
+    """
+
+    def __init__(self) -> None:
+        self.metrics = RunMetrics()
+
+    def task_started(self, task: Task) -> None:
+        pass  # This is required for implementation, but at this time we're taking no action here
+
+    def task_completed(self, task: Task, result: AggregatedResult) -> None:
+        pass  # This is required for implementation, but at this time we're taking no action here
+
+    def task_instance_started(self, task: Task, host: Host) -> None:
+        self.metrics.start(host_name=host.name, phase="host")
+
+    def task_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
+        pass  # This is required for implementation, but at this time we're taking no action here
+
+    def subtask_instance_started(self, task: Task, host: Host) -> None:
+        self.metrics.start(host_name=host.name, phase=task.name)
+
+    def subtask_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
+        self.metrics.stop(host_name=host.name, phase=task.name)
+
+    def host_phases(self, host: Host) -> Dict[str, float]:
+        """
+        Stop timing a host's task, and take its phase timings
+        :param host:
+        :return: A Dict of phase to the seconds it took
+        """
+
+        self.metrics.stop(host_name=host.name, phase="host")
+        with self.metrics.lock:
+            return dict(self.metrics.host_phases.pop(host.name, {}))
+
+
+class QueueResults(TimeHostPhases):
+    """
+    A Nornir Processor, used within a worker process, that sends each host's results (and phase timings) back to the
+    parent process as it completes, and releases the results from the worker's memory.
+    """
+
+    def __init__(self, result_queue: "multiprocessing.Queue") -> None:
+        super().__init__()
+        self.result_queue = result_queue
+
+    def task_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
+        """
+        Send this host's StockpileResults (without the config, that's already on disk) or failure to the parent.
+        :param task:
+        :param host:
+        :param result:
+        :return:
+        """
+
+        phases = self.host_phases(host=host)
+        self.result_queue.put((host.name, portable_result(result[0].result), result.failed, phases))
+        ProcessStockpiles.release_results(results=result)
+
+
+def stockpile_worker(
+    norns: Nornir, host_names: List[str], result_queue: "multiprocessing.Queue", task_params: dict
+) -> None:
+    """
+    Entry point of a worker process, stockpile our partition of the inventory with a Nornir thread pool.
+    :param norns: The parent's Nornir object, inherited when this process was forked
+    :param host_names: The names of the hosts in this worker's partition
+    :param result_queue: Queue to send each host's results back to the parent on
+    :param task_params: Keyword arguments for `stockpile_device_config`
+    :return:
+    """
+
+    partition = set(host_names)
+    worker_norns = norns.filter(filter_func=lambda h: h.name in partition)
+    worker_norns = worker_norns.with_processors(processors=[QueueResults(result_queue=result_queue)])
+    try:
+        worker_norns.run(task=stockpile_device_config, **task_params)
+    finally:
+        result_queue.put((WORKER_DONE, None, None, None))
+
+
+class MultiProcessStockpileRunner:
+    """
+    Run a stockpile of every host in a Nornir inventory, partitioned across several worker processes.
+    """
+
+    def __init__(self, norns: Nornir, processors: Optional[List[Processor]] = None, processes: int = 2) -> None:
+        """
+        Initialize our runner
+        :param norns: An instantiated (and likely filtered) Nornir object, with credentials already set
+        :param processors: Nornir Processor objects to notify as the stockpile progresses, i.e. ProcessStockpiles
+        :param processes: How many worker processes to partition the inventory across
+        """
+
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise OSError("Multi-process stockpiling requires a platform that supports forking worker processes")
+
+        self.norns = norns
+        self.processors = Processors(processors or [])
+        self.processes = processes
+
+    def partition(self) -> List[List[str]]:
+        """
+        Split the inventory's host names as evenly as possible across our worker processes
+        :return:
+        """
+
+        host_names = list(self.norns.inventory.hosts.keys())
+        processes = self.processes
+        return [p for p in (host_names[i::processes] for i in range(processes)) if p]
+
+    def run(self, stockpile_directory: pathlib.Path, proxies: Optional[dict] = None) -> AggregatedResult:
+        """
+        Stockpile every host in our inventory, notifying our processors just as `Nornir.run()` would.
+        :param stockpile_directory: An instantiated pathlib.Path object for the directory where we're writing configs
+        :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+        :return: A Nornir AggregatedResult of each host's StockpileResults
+        """
+
+        task = Task(task=stockpile_device_config, proxies=proxies, stockpile_directory=stockpile_directory)
+        self.processors.task_started(task)
+
+        context = multiprocessing.get_context("fork")
+        # Each worker must take from the same concurrency limits, or `--processes N` would allow N times each limit
+        Limits.share(norns=self.norns, context=context)
+        result_queue = context.Queue()
+        workers = [
+            context.Process(
+                target=stockpile_worker,
+                args=(self.norns, host_names, result_queue, task.params),
+                name=f"stockpiler-worker-{i}",
+            )
+            for (i, host_names) in enumerate(self.partition())
+        ]
+        logger.info("Stockpiling %s devices across %s processes", len(self.norns.inventory.hosts), len(workers))
+        for worker in workers:
+            worker.start()
+
+        agg_result = AggregatedResult(task.name)
+        running = len(workers)
+        while running:
+            try:
+                host_name, host_result, failed, phases = result_queue.get(timeout=1)
+            except queue.Empty:
+                # Make sure we don't wait forever on a worker that died without telling us
+                if not any(worker.is_alive() for worker in workers) and result_queue.empty():
+                    break
+                continue
+            if host_name == WORKER_DONE:
+                running -= 1
+                continue
+            agg_result[host_name] = report_host_result(
+                processors=self.processors,
+                task=task,
+                host=self.norns.inventory.hosts[host_name],
+                host_result=host_result,
+                failed=failed,
+                phases=phases,
+            )
+
+        for worker in workers:
+            worker.join()
+
+        # Any host we never heard back about was lost with its worker process
+        for host_name, host in self.norns.inventory.hosts.items():
+            if host_name not in agg_result:
+                logger.error("Lost the worker process stockpiling %s", host_name)
+                agg_result[host_name] = report_host_result(
+                    processors=self.processors,
+                    task=task,
+                    host=host,
+                    host_result="Worker process exited unexpectedly",
+                    failed=True,
+                )
+
+        self.processors.task_completed(task, agg_result)
+        return agg_result
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+A fleet-wide, non-blocking reachability sweep run before dispatching stockpile tasks.
+
+Rather than each host holding a worker slot while it runs its own `tcp_ping` subtask(s), every host's management
+ports are checked up front on a single asyncio event loop.  The results are stored on each host (as
+`ssh_port_check_ok`, `http_port_check_ok`, and `api_port_check_ok`, which the stockpile tasks honor instead of pinging
+again) and only reachable hosts are handed on to the worker pool.
+"""
+
+import asyncio
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
+
+from nornir.core import Nornir
+from nornir.core.inventory import Host
+
+
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+logger = getLogger("stockpiler")
+
+
+def management_ports(host: Host, proxies: Optional[dict] = None) -> Dict[str, int]:
+    """
+    Determine which management ports need checking for a host, matching the checks done in the stockpile tasks.
+    :param host: A Nornir Host object
+    :param proxies: Optional Dict of SOCKS proxies, if set the HTTP port check is skipped (it won't do us any good)
+    :return: A Dict of the check name (i.e. `ssh_port_check_ok`) to the port to check
+    """
+
+    # Need `or` statement as we're getting None from inventory
+    ports = {"ssh_port_check_ok": host.get("port", 22) or 22}
+    if host.platform == "cisco_asa" and host.get("http_management", False) and proxies is None:
+        ports["http_port_check_ok"] = host.get("http_mgmt_port", 8443)
+    if host.get("stockpile_collection", None) == "api":
+        from stockpiler.tasks.stockpile.stockpile_api import api_port, native_api
+
+        # As with HTTP, NX-API and eAPI aren't checked behind a proxy
+        api = native_api(host=host)
+        if api is not None and (api == "netconf" or proxies is None):
+            ports["api_port_check_ok"] = api_port(host=host, api=api)
+    return ports
+
+
+async def tcp_port_open(hostname: str, port: int, timeout: float) -> bool:
+    """
+    Attempt a TCP three way handshake to a port, without blocking the event loop.
+    :param hostname: The hostname or IP address to connect to
+    :param port: The TCP port to connect to
+    :param timeout: How long to wait for the connection
+    :return: True if the port accepted our connection
+    """
+
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(hostname, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        # The port accepted our connection, it doesn't matter if it was reset as we closed it
+        pass
+    return True
+
+
+async def _sweep(hosts: List[Host], proxies: Optional[dict], timeout: float, max_in_flight: int) -> None:
+    """
+    Check every host's management ports concurrently, storing the results on each host.
+    :param hosts:
+    :param proxies:
+    :param timeout:
+    :param max_in_flight:
+    :return:
+    """
+
+    in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def check(host: Host, check_name: str, port: int) -> None:
+        async with in_flight:
+            host.data[check_name] = await tcp_port_open(hostname=host.hostname, port=port, timeout=timeout)
+
+    await asyncio.gather(
+        *(
+            check(host=host, check_name=check_name, port=port)
+            for host in hosts
+            for (check_name, port) in management_ports(host=host, proxies=proxies).items()
+        )
+    )
+
+
+def reachability_sweep(
+    norns: Nornir, proxies: Optional[dict] = None, timeout: float = 1, max_in_flight: int = 512
+) -> Tuple[Nornir, List[StockpileResults]]:
+    """
+    Check the management ports of every host in the inventory in one sweep, and split out the unreachable hosts.
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :param timeout: How long to wait for each TCP connection, matching the 1 second tcp_ping in our tasks
+    :param max_in_flight: Maximum number of connection attempts at once, keep this below your open file limit
+    :return: A Tuple of a Nornir object filtered to the reachable hosts, and failed StockpileResults for the rest
+    """
+
+    hosts = list(norns.inventory.hosts.values())
+    logger.info("Checking management port reachability of %s devices", len(hosts))
+    asyncio.run(_sweep(hosts=hosts, proxies=proxies, timeout=timeout, max_in_flight=max_in_flight))
+
+    reachable = set()
+    unreachable = []
+    for host in hosts:
+        # With proxies, HTTP management is assumed reachable (as in `stockpile_cisco_asa`)
+        http_ok = host.data.get("http_port_check_ok", False)
+        if proxies is not None and host.platform == "cisco_asa" and host.get("http_management", False):
+            http_ok = True
+        # As is a native API (see `stockpile_native_api`), NX-API and eAPI with proxies
+        api_ok = host.data.get("api_port_check_ok", False)
+        if proxies is not None and host.get("stockpile_collection", None) == "api":
+            from stockpiler.tasks.stockpile.stockpile_api import native_api
+
+            api_ok = api_ok or native_api(host=host) in ("nxapi", "eapi")
+        if host.data["ssh_port_check_ok"] or http_ok or api_ok:
+            reachable.add(host.name)
+            continue
+
+        logger.error("Unable to reach management ports on %s", host)
+        stockpile_info = StockpileResults(
+            name=f"{host}_backup",
+            ip=host.hostname,
+            hostname=host.get("device_name", host),
+            ssh_mgmt_port=host.get("port", 22) or 22,
+        )
+        if host.platform == "cisco_asa":
+            stockpile_info["http_management"] = host.get("http_management", False)
+            stockpile_info["http_mgmt_port"] = host.get("http_mgmt_port", 8443)
+        unreachable.append(stockpile_info)
+
+    logger.info("%s devices reachable, %s unreachable", len(reachable), len(unreachable))
+    return norns.filter(filter_func=lambda h: h.name in reachable), unreachable
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+A deferred save config phase, run after every backup has finished.
+
+Saving a device's running config (`write mem`) can block for 5-30 seconds while it's written to NVRAM, and doing it
+as part of the backup holds a worker long after we have the config.  Hosts whose `stockpile_save_config` (set for
+every host by `--save_config`) is `deferred` are instead saved once the backups are done, on a smaller pool of their
+own, or with `changed`, only if their config changed since our last stockpile.  `off` doesn't save them at all, and
+`inline` (the default) saves them as part of their backup.
+
+ProcessStockpiles holds the report rows of hosts awaiting a save, and runs this phase before it commits, so their
+`save_config_successful` is reported as usual.
+"""
+
+from logging import getLogger
+from typing import Any, Dict, Optional
+
+
+from nornir.core import Nornir
+from nornir.core.inventory import Host
+from nornir.core.task import Result, Task
+
+
+from stockpiler.inventory.index import indexed_inventory
+from stockpiler.tasks.stockpile.concurrency import Limits
+from stockpiler.tasks.stockpile.proxy_pool import Proxies
+
+
+logger = getLogger("stockpiler")
+
+SAVE_CONFIG_MODES = ("inline", "deferred", "changed", "off")
+
+# Saves run after the backups, so a small pool is enough and keeps the load on devices (and AAA servers) down
+DEFAULT_SAVE_CONFIG_WORKERS = 10
+
+
+def save_config_mode(host: Host) -> str:
+    """
+    How a host's config should be saved, `inline`, `deferred`, `changed`, or `off` (see above)
+    :param host: A Nornir Host object
+    :return:
+    """
+
+    mode = host.get("stockpile_save_config", "inline") or "inline"
+    if mode not in SAVE_CONFIG_MODES:
+        logger.warning("Unknown stockpile_save_config %s for %s, saving its config inline", mode, host)
+        return "inline"
+    return mode
+
+
+def save_device_config(task: Task, saves: Dict[str, Dict[str, Any]], proxies: Optional[dict] = None) -> Result:
+    """
+    Save the running config of a host we've backed up, holding its concurrency limits and (if we have a proxy pool) a
+    proxy, as its backup did
+    :param task: Nornir task execution object.
+    :param saves: A Dict of host name to how it was backed up, `http_used`, `http_mgmt_port`, and `api_used`
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: A Result whose result is True if the config was saved
+    """
+
+    save = dict(saves[task.host.name])
+    api = save.pop("api_used", None)
+    with Limits.acquire(limits=Limits.host_limits(task=task)), Proxies.lease(host=task.host) as proxy:
+        if proxy is not None:
+            proxies = proxy.proxies
+        if api:
+            from stockpiler.tasks.stockpile.stockpile_api import save_api_config
+
+            return save_api_config(task, api=api, proxies=proxies)
+
+        from stockpiler.tasks.stockpile.stockpile_cisco import save_cisco_config
+
+        return save_cisco_config(task, proxies=proxies, **save)
+
+
+class DeferredSaveConfig:
+    """
+    Save the configs of the hosts we've backed up, after the fact
+    """
+
+    def __init__(
+        self, norns: Nornir, workers: int = DEFAULT_SAVE_CONFIG_WORKERS, proxies: Optional[dict] = None
+    ) -> None:
+        """
+        Initialize our save config phase
+        :param norns: An instantiated (and likely filtered) Nornir object, with credentials already set.  Its hosts
+            are those of our backups, so any connection left open by a host's backup is used again for its save.
+        :param workers: How many hosts to save at once
+        :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+        """
+
+        self.norns = norns
+        self.workers = workers
+        self.proxies = proxies
+
+    def run(self, saves: Dict[str, Dict[str, Any]]) -> Dict[str, bool]:
+        """
+        Save the config of each of these hosts
+        :param saves: A Dict of host name to how it was backed up, `http_used`, `http_mgmt_port`, and `api_used`
+        :return: A Dict of host name to whether its config was saved
+        """
+
+        save_norns = self.norns.with_processors(processors=[])
+        save_norns.inventory = indexed_inventory(
+            inventory=self.norns.inventory, host_names=[name for name in saves if name in self.norns.inventory.hosts]
+        )
+        results = save_norns.run(
+            task=save_device_config,
+            name="save_config",
+            num_workers=self.workers,
+            on_failed=True,
+            saves=saves,
+            proxies=self.proxies,
+        )
+        saved = {}
+        for host_name, result in results.items():
+            saved[host_name] = not result.failed and bool(result[0].result)
+            if not saved[host_name]:
+                logger.error("Failed to save the configuration of %s", host_name)
+        return saved
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Order a stockpile run by how long each device is expected to take, longest first, and set a deadline after which
+no more devices are started.
+
+Nornir dispatches hosts in inventory order, so a few large, slow devices at the end of the inventory stretch the
+whole run out while every other worker sits idle.  Dispatching the longest expected jobs first (the classic "longest
+processing time" schedule) lets the quick ones fill in around them.  Expected durations come from the history index
+(see stockpiler.history), devices without history are expected to take as long as the median device.
+
+With a deadline, a device that can't be expected to finish before it is deferred (reported in `results.csv` with a
+`skip_reason` of `deferred`) rather than started.
+"""
+
+from logging import getLogger
+import statistics
+import time
+from typing import Dict, Optional
+
+
+from nornir.core import Nornir
+from nornir.core.task import Task
+
+
+from stockpiler.inventory.index import indexed_inventory
+
+
+logger = getLogger("stockpiler")
+
+
+def longest_first(norns: Nornir, durations: Dict[str, float]) -> Nornir:
+    """
+    Order our inventory by expected duration, longest first, noting each host's expected duration in its data (as
+    `stockpile_expected_duration`) for our deadline.  Hosts expected to take as long keep their inventory order.
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param durations: A Dict of host name to its expected duration in seconds, i.e. from the history index
+    :return: A Nornir object of the same hosts, in the order to dispatch them
+    """
+
+    known = [durations[name] for name in norns.inventory.hosts if name in durations]
+    default = statistics.median(known) if known else 0.0
+    for name, host in norns.inventory.hosts.items():
+        host.data["stockpile_expected_duration"] = durations.get(name, default)
+
+    ordered = sorted(
+        norns.inventory.hosts,
+        key=lambda name: norns.inventory.hosts[name].data["stockpile_expected_duration"],
+        reverse=True,
+    )
+    logger.info(
+        "Dispatching %s devices longest first, %s with history (the longest expected to take %.1fs)",
+        len(ordered),
+        len(known),
+        max(known, default=0.0),
+    )
+    ordered_norns = Nornir(**norns.__dict__)
+    ordered_norns.inventory = indexed_inventory(inventory=norns.inventory, host_names=ordered)
+    return ordered_norns
+
+
+def set_deadline(norns: Nornir, budget: float, now: Optional[float] = None) -> float:
+    """
+    Give our run a time budget, after which hosts aren't started
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param budget: Seconds from now
+    :param now: The time (in seconds since the epoch) to count from, defaults to now
+    :return: The deadline, in seconds since the epoch
+    """
+
+    deadline = (now or time.time()) + budget
+    norns.inventory.defaults.data["stockpile_deadline"] = deadline
+    return deadline
+
+
+def past_deadline(task: Task) -> bool:
+    """
+    Would starting this host now run past our deadline (`stockpile_deadline` in its inventory data, set for every
+    host by `--deadline`), given how long it's expected to take?
+    :param task:
+    :return:
+    """
+
+    deadline = task.host.get("stockpile_deadline")
+    if deadline is None:
+        return False
+    return time.time() + task.host.get("stockpile_expected_duration", 0.0) > deadline
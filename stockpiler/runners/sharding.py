@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Deterministically split an inventory into shards, for distributing collection across collector nodes.
+"""
+
+import hashlib
+from typing import Callable, Dict, List
+
+
+from nornir.core import Nornir
+from nornir.core.inventory import Host
+
+
+def _shard_key_hash(host: Host) -> str:
+    return host.name
+
+
+def _shard_key_group(host: Host) -> str:
+    # Hosts are kept together by their first (primary) group
+    return host.groups[0] if host.groups else ""
+
+
+def _shard_key_site(host: Host) -> str:
+    return str(host.get("site", "") or "")
+
+
+ShardKeys: Dict[str, Callable[[Host], str]] = {
+    "hash": _shard_key_hash,
+    "group": _shard_key_group,
+    "site": _shard_key_site,
+}
+
+
+def shard_index(key: str, shards: int) -> int:
+    """
+    Map a shard key onto a shard, stable across processes, machines, and Python versions (unlike `hash()`)
+    :param key: The shard key of a host, i.e. its name, group, or site
+    :param shards: The total number of shards
+    :return:
+    """
+
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big") % shards
+
+
+def shard_hosts(norns: Nornir, shards: int, shard_by: str = "hash") -> List[List[str]]:
+    """
+    Split the hosts of an inventory into shards.
+    :param norns: An instantiated (and likely filtered) Nornir object
+    :param shards: How many shards to split the inventory into
+    :param shard_by: How to split it: `hash` of each host name, or keeping hosts of the same `group` or `site`
+        (from the host's `site` data) together
+    :return: A List (one per shard) of Lists of host names
+    """
+
+    if shard_by not in ShardKeys:
+        raise ValueError(f"Unknown shard strategy {shard_by}, expected one of {', '.join(ShardKeys)}")
+
+    shard_key = ShardKeys[shard_by]
+    sharded: List[List[str]] = [[] for _ in range(shards)]
+    for host in norns.inventory.hosts.values():
+        sharded[shard_index(key=shard_key(host), shards=shards)].append(host.name)
+    return sharded
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Cheap device side change markers, to skip pulling the full configuration of devices that haven't changed.
+
+Before a full backup, a device is asked for a marker that changes whenever its configuration does (i.e. the IOS
+"Last configuration change" line, or the ASA's `show checksum`).  If that matches the marker recorded at its last
+successful backup, its stockpiled config is still current and the full pull is skipped.
+
+Markers are recorded by `ProcessStockpiles` in a manifest within the stockpile's `.stockpiler` state directory, which
+is excluded from the Git repository.
+"""
+
+import json
+from logging import getLogger
+import os
+import pathlib
+import re
+import tempfile
+import threading
+from typing import Dict, Optional, Pattern, Tuple
+
+
+logger = getLogger("stockpiler")
+
+# Netmiko platform to the command that returns its change marker, and a pattern to find the marker in its output
+ChangeMarkerCommands: Dict[str, Tuple[str, Pattern]] = {
+    "cisco_ios": (
+        "show running-config | include Last configuration change",
+        re.compile(r"^!\s*Last configuration change at (.+?)\s*$", re.MULTILINE),
+    ),
+    "cisco_xe": (
+        "show running-config | include Last configuration change",
+        re.compile(r"^!\s*Last configuration change at (.+?)\s*$", re.MULTILINE),
+    ),
+    "cisco_asa": ("show checksum", re.compile(r"^Cryptochecksum:\s*([0-9a-fA-F ]+?)\s*$", re.MULTILINE)),
+    "cisco_nxos": (
+        "show running-config | include Running configuration last done at",
+        re.compile(r"^!\s*Running configuration last done at:\s*(.+?)\s*$", re.MULTILINE),
+    ),
+}
+
+# Our state directory within the stockpile, and the manifest of change markers within that
+STATE_DIRECTORY = ".stockpiler"
+MANIFEST_FILE = "change_markers.json"
+
+_manifest_cache: Dict[str, Tuple[int, Dict[str, str]]] = {}
+_manifest_lock = threading.Lock()
+
+
+def parse_change_marker(platform: str, output: str) -> Optional[str]:
+    """
+    Find the change marker in a device's output
+    :param platform: The Netmiko platform of the device
+    :param output: The output of the platform's change marker command
+    :return: The marker, or None if the output doesn't contain one (i.e. the command wasn't authorized)
+    """
+
+    if platform not in ChangeMarkerCommands or not output:
+        return None
+    match = ChangeMarkerCommands[platform][1].search(output)
+    return match.group(1) if match else None
+
+
+def state_directory(stockpile_directory: pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(stockpile_directory / STATE_DIRECTORY)
+
+
+def manifest_path(stockpile_directory: pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(state_directory(stockpile_directory=stockpile_directory) / MANIFEST_FILE)
+
+
+def load_manifest(stockpile_directory: pathlib.Path) -> Dict[str, str]:
+    """
+    Load the change markers recorded for a stockpile.  As every host's task checks the manifest, it's only read from
+    disk again when it has been rewritten.
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :return: A Dict of host name to its change marker at its last successful backup
+    """
+
+    path = manifest_path(stockpile_directory=stockpile_directory)
+    try:
+        mtime = path.stat().st_mtime_ns
+    except OSError:
+        return {}
+
+    with _manifest_lock:
+        cached = _manifest_cache.get(str(path))
+        if cached is None or cached[0] != mtime:
+            try:
+                markers = json.loads(path.read_text())
+            except (OSError, ValueError) as e:
+                logger.warning("Unable to read change marker manifest %s, ignoring it: %s", path, e)
+                markers = {}
+            cached = (mtime, markers)
+            _manifest_cache[str(path)] = cached
+        return cached[1]
+
+
+def save_manifest(stockpile_directory: pathlib.Path, markers: Dict[str, str]) -> None:
+    """
+    Write the change markers for a stockpile, replacing the previous manifest at once
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param markers: A Dict of host name to its change marker at its last successful backup
+    :return:
+    """
+
+    path = manifest_path(stockpile_directory=stockpile_directory)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, mode="w") as f:
+            json.dump(markers, f, indent=0, sort_keys=True)
+        os.replace(temp_path, str(path))
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+"""
+Named concurrency limits on the shared resources our stockpile tasks lean on (i.e. an AAA server group, a proxy, or a
+site's WAN link), and backing off of devices that fail to authenticate or authorize while those resources are busy.
+
+Limits are declared as a Dict of name to the most hosts that may hold it at once, under `stockpile_concurrency_limits`
+in either the `user_defined` section of the Nornir config file or the inventory defaults, i.e.:
+
+    stockpile_concurrency_limits:
+      aaa-east: 30
+      proxy-dc1: 20
+
+Hosts name the limits they take with `stockpile_limits` (a list) in their own data or that of any of their groups
+(and the inventory defaults), these are combined, so a host can take its AAA group's limit and its site's.  Limits
+are held for the whole of a host's stockpile, and taken in name order so hosts sharing several can't deadlock.
+
+Limits are shared by the threads of one process, and `share()` makes them shared with the worker processes forked
+by `--processes` too, so a limit caps the hosts holding it across the whole run.
+"""
+
+from contextlib import contextmanager
+from logging import getLogger
+import random
+import threading
+from typing import Any, Dict, Iterator, List, Set
+
+
+from nornir.core import Nornir
+from nornir.core.exceptions import NornirSubTaskError
+from nornir.core.inventory import Host
+from nornir.core.task import Task
+
+
+logger = getLogger("stockpiler")
+
+LIMITS_KEY = "stockpile_concurrency_limits"
+
+# Retries of a host that failed to authenticate (or was refused command authorization), and the base of their
+# exponential backoff, both also set per host with `stockpile_retries` and `stockpile_retry_backoff`.  A host holds
+# its worker thread while it backs off, so no single wait is longer than MAX_RETRY_BACKOFF.
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 2.0
+MAX_RETRY_BACKOFF = 15.0
+
+# HTTP status codes of a device (or its AAA server) turning us away, rather than a real failure
+RATE_LIMITED_STATUS = (401, 403, 429)
+
+
+class ConcurrencyLimits:
+    """
+    A registry of named semaphores, created the first time each is needed (or up front by `share()`)
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.semaphores: Dict[str, Any] = {}
+        self.warned: Set[str] = set()
+
+    def share(self, norns: Nornir, context: Any) -> None:
+        """
+        Create a semaphore for every declared limit that's shared with the processes we fork afterwards, rather than
+        each of them enforcing its own
+        :param norns: An initialized Nornir object
+        :param context: The multiprocessing context the processes are forked from
+        :return:
+        """
+
+        declared = declared_limits(config=norns.config, defaults=norns.inventory.defaults)
+        with self.lock:
+            for name, size in declared.items():
+                self.semaphores[name] = context.BoundedSemaphore(value=size)
+
+    def semaphore(self, name: str, size: int) -> Any:
+        """
+        The semaphore of a limit, creating it if need be
+        :param name:
+        :param size: The most holders it allows, only used when it is created
+        :return:
+        """
+
+        with self.lock:
+            semaphore = self.semaphores.get(name)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(value=size)
+                self.semaphores[name] = semaphore
+            return semaphore
+
+    def host_limits(self, task: Task) -> Dict[str, int]:
+        """
+        The limits that apply to this task's host, and their sizes
+        :param task:
+        :return:
+        """
+
+        declared = declared_limits(config=task.nornir.config, defaults=task.host.defaults)
+        limits = {}
+        for name in host_limit_names(host=task.host):
+            if name in declared:
+                limits[name] = declared[name]
+            elif name not in self.warned:
+                logger.warning("%s takes the concurrency limit %s, which isn't declared", task.host, name)
+                self.warned.add(name)
+        return limits
+
+    @contextmanager
+    def acquire(self, limits: Dict[str, int]) -> Iterator[None]:
+        """
+        Hold some limits, waiting for each in turn
+        :param limits: A Dict of limit name to its size
+        :return:
+        """
+
+        held: List[Any] = []
+        try:
+            for name in sorted(limits):
+                semaphore = self.semaphore(name=name, size=limits[name])
+                semaphore.acquire()
+                held.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(held):
+                semaphore.release()
+
+
+# Limits for the whole process, the same way `HTTPSessions` holds our sessions
+Limits = ConcurrencyLimits()
+
+
+def declared_limits(config: Any, defaults: Any) -> Dict[str, int]:
+    """
+    The limits declared in our Nornir config's `user_defined` section and the inventory defaults, and their sizes
+    :param config: A Nornir Config object
+    :param defaults: The inventory's Defaults object
+    :return:
+    """
+
+    declared = dict(config.user_defined.get(LIMITS_KEY) or {})
+    declared.update(defaults.data.get(LIMITS_KEY) or {})
+    return {name: int(size) for name, size in declared.items()}
+
+
+def host_limit_names(host: Host) -> List[str]:
+    """
+    The names of the limits a host takes, from its own `stockpile_limits`, those of its groups (and theirs), and the
+    inventory defaults
+    :param host: A Nornir Host object
+    :return:
+    """
+
+    names: List[str] = []
+    pending = [host]
+    seen = set()
+    while pending:
+        item = pending.pop(0)
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        names.extend(item.data.get("stockpile_limits") or [])
+        pending.extend(item.groups.refs)
+    names.extend(host.defaults.data.get("stockpile_limits") or [])
+    return list(dict.fromkeys(names))
+
+
+def rate_limited(error: NornirSubTaskError) -> bool:
+    """
+    Did a subtask fail because the device (or its AAA server) turned us away, i.e. an authentication failure or
+    timeout while TACACS is overloaded, rather than for good?
+    :param error: The NornirSubTaskError raised by `task.run()`
+    :return:
+    """
+
+    from netmiko.ssh_exception import NetmikoAuthenticationException, NetmikoTimeoutException
+
+    for result in error.result:
+        exception = result.exception
+        if isinstance(exception, (NetmikoAuthenticationException, NetmikoTimeoutException)):
+            return True
+        response = getattr(exception, "response", None)
+        if getattr(response, "status_code", None) in RATE_LIMITED_STATUS:
+            return True
+    return False
+
+
+def retry_backoff(host: Host, attempt: int) -> float:
+    """
+    How long to wait before retrying a host, exponential in the attempt with full jitter, so hosts turned away
+    together don't all come back together.  It's capped at MAX_RETRY_BACKOFF, as the host's worker thread sits idle
+    for the whole wait.
+    :param host: A Nornir Host object
+    :param attempt: The attempt that failed, from 0
+    :return: Seconds
+    """
+
+    base = float(host.get("stockpile_retry_backoff", DEFAULT_RETRY_BACKOFF))
+    return random.uniform(0, min(MAX_RETRY_BACKOFF, base * 2 ** attempt))
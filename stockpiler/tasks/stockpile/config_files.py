@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+"""
+Writing device configs into our stockpile, and where in it each is kept.
+
+Configs are written atomically (to a temporary file, then renamed over the old one), so a crash part way through a
+write never leaves a truncated config behind.  A config that's byte for byte what's already there isn't written at
+all, so it keeps its mtime and Git doesn't need to hash it again.  Whether it's unchanged is answered from a cache of
+the size, mtime, and blob hash of each config (`.stockpiler/config_hashes.json`, kept up to date by ProcessStockpiles),
+falling back to comparing it with the file itself.  Nothing is fsync'd as it's written, ProcessStockpiles syncs the
+changed configs (and their directories) once before it commits.  Configs copied off a device as a file (see
+stockpiler.tasks.stockpile.stockpile_transfer) are streamed into a temporary file beside their config, and installed
+the same way without being read into memory.
+
+By default every config is kept as `<stockpile_directory>/<host>.txt`.  With `stockpile_layout` (set for every host by
+`--layout`) configs are sharded into a directory per `site`, `platform`, or `hash` (the first two hex digits of a hash
+of the host's name), so the directories of a very large stockpile stay small.
+"""
+
+import hashlib
+import json
+from logging import getLogger
+import os
+import pathlib
+import tempfile
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+
+from nornir.core.inventory import Host
+from nornir.core.task import Result, Task
+
+
+from stockpiler.tasks.stockpile.change_markers import state_directory
+
+
+logger = getLogger("stockpiler")
+
+CONFIG_LAYOUTS = ("flat", "site", "platform", "hash")
+HASH_CACHE_FILE = "config_hashes.json"
+
+# The directory of hosts without a site (or platform) to shard them by
+UNKNOWN_SHARD = "_unknown"
+
+_hash_cache: Dict[str, Tuple[int, Dict[str, List]]] = {}
+_hash_cache_lock = threading.Lock()
+
+
+def config_path(host: Host) -> str:
+    """
+    Where a host's config is kept in our stockpile, under its layout (see above)
+    :param host: A Nornir Host object
+    :return: The repository relative (posix) path of its config
+    """
+
+    layout = host.get("stockpile_layout", "flat") or "flat"
+    file_name = f"{host.name}.txt"
+    if layout == "site":
+        shard = host.get("site", None)
+    elif layout == "platform":
+        shard = host.platform
+    elif layout == "hash":
+        shard = hashlib.sha1(host.name.encode()).hexdigest()[:2]
+    else:
+        if layout != "flat":
+            logger.warning("Unknown stockpile_layout %s for %s, keeping its config at %s", layout, host, file_name)
+        return file_name
+    return f"{shard or UNKNOWN_SHARD}/{file_name}"
+
+
+def blob_hash(content: bytes) -> str:
+    """
+    The hash Git would give some content as a blob, i.e. `git hash-object`
+    :param content:
+    :return: The blob hex SHA
+    """
+
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def blob_hash_file(path: Union[str, pathlib.Path], chunk_size: int = 1 << 20) -> str:
+    """
+    The hash Git would give a file as a blob, read a chunk at a time rather than all at once
+    :param path:
+    :param chunk_size: How many bytes to read at a time
+    :return: The blob hex SHA
+    """
+
+    sha = hashlib.sha1(b"blob %d\0" % os.path.getsize(path))
+    with open(path, mode="rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_cache_path(stockpile_directory: pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(state_directory(stockpile_directory=stockpile_directory) / HASH_CACHE_FILE)
+
+
+def load_hash_cache(stockpile_directory: pathlib.Path) -> Dict[str, List]:
+    """
+    Load the cached size, mtime, and blob hash of each config in a stockpile.  As every host's task checks it, it's
+    only read from disk again when it has been rewritten.
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :return: A Dict of repository relative path to its [size, mtime (in ns), blob hash]
+    """
+
+    path = hash_cache_path(stockpile_directory=stockpile_directory)
+    try:
+        mtime = path.stat().st_mtime_ns
+    except OSError:
+        return {}
+
+    with _hash_cache_lock:
+        cached = _hash_cache.get(str(path))
+        if cached is None or cached[0] != mtime:
+            try:
+                hashes = json.loads(path.read_text())
+            except (OSError, ValueError) as e:
+                logger.warning("Unable to read config hash cache %s, ignoring it: %s", path, e)
+                hashes = {}
+            cached = (mtime, hashes)
+            _hash_cache[str(path)] = cached
+        return cached[1]
+
+
+def unchanged_on_disk(stockpile_directory: pathlib.Path, relative_path: str, content: bytes, blob: str) -> bool:
+    """
+    Is this content already what's in a config file?
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param relative_path: The repository relative path of the config
+    :param content: The config
+    :param blob: Its blob hash
+    :return:
+    """
+
+    path = pathlib.Path(stockpile_directory / relative_path)
+    try:
+        stat = path.stat()
+    except OSError:
+        return False
+    if stat.st_size != len(content):
+        return False
+    cached = load_hash_cache(stockpile_directory=stockpile_directory).get(relative_path)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2] == blob
+    return path.read_bytes() == content
+
+
+def write_config(
+    stockpile_directory: pathlib.Path, relative_path: str, content: Union[str, bytes]
+) -> Tuple[str, bool]:
+    """
+    Write a config into our stockpile atomically, unless it's unchanged
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param relative_path: The repository relative path of the config (see config_path())
+    :param content: The config
+    :return: Its blob hash, and whether it was written
+    """
+
+    if isinstance(content, str):
+        content = content.encode()
+    blob = blob_hash(content)
+    if unchanged_on_disk(
+        stockpile_directory=stockpile_directory, relative_path=relative_path, content=content, blob=blob
+    ):
+        return blob, False
+
+    path = pathlib.Path(stockpile_directory / relative_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        mode = path.stat().st_mode & 0o777
+    except OSError:
+        mode = 0o644
+    fd, temp_path = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.")
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, mode="wb") as f:
+            f.write(content)
+        os.replace(temp_path, str(path))
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return blob, True
+
+
+def config_temp_file(stockpile_directory: pathlib.Path, relative_path: str) -> str:
+    """
+    Create an empty temporary file beside where a config is kept, for a config to be streamed into and then installed
+    with install_config()
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param relative_path: The repository relative path of the config (see config_path())
+    :return: The temporary file's path
+    """
+
+    path = pathlib.Path(stockpile_directory / relative_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.")
+    os.close(fd)
+    return temp_path
+
+
+def install_config(stockpile_directory: pathlib.Path, relative_path: str, temp_path: str) -> Tuple[str, bool]:
+    """
+    Rename a config streamed into a temporary file (see config_temp_file()) over the config in our stockpile, unless
+    it's unchanged, in which case the temporary file is removed
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param relative_path: The repository relative path of the config (see config_path())
+    :param temp_path: The temporary file holding the config
+    :return: Its blob hash, and whether it was installed
+    """
+
+    path = pathlib.Path(stockpile_directory / relative_path)
+    blob = blob_hash_file(path=temp_path)
+    try:
+        stat = path.stat()
+    except OSError:
+        stat = None
+
+    if stat is not None and stat.st_size == os.path.getsize(temp_path):
+        cached = load_hash_cache(stockpile_directory=stockpile_directory).get(relative_path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            unchanged = cached[2] == blob
+        else:
+            unchanged = blob_hash_file(path=path) == blob
+        if unchanged:
+            os.unlink(temp_path)
+            return blob, False
+
+    os.chmod(temp_path, stat.st_mode & 0o777 if stat is not None else 0o644)
+    os.replace(temp_path, str(path))
+    return blob, True
+
+
+def write_config_file(task: Task, stockpile_directory: pathlib.Path, content: str) -> Result:
+    """
+    Write a host's config into our stockpile, where its layout keeps it (unless it's unchanged)
+    :param task:
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param content: The config
+    :return: A Nornir Result whose result is the config's blob hash, and changed if it was written
+    """
+
+    blob, written = write_config(
+        stockpile_directory=stockpile_directory, relative_path=config_path(host=task.host), content=content
+    )
+    return Result(host=task.host, result=blob, changed=written)
+
+
+def sync_configs(stockpile_directory: pathlib.Path, relative_paths: Iterable[str]) -> None:
+    """
+    Flush the configs written (or removed) this run to disk in one go, rather than as each is written: fsync each
+    config, then each directory holding one so the renames that installed them are durable too.  Only these are
+    flushed, not every filesystem on the machine.
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param relative_paths: The stockpile relative paths of the configs
+    :return:
+    """
+
+    directories = set()
+    for relative_path in relative_paths:
+        config_file = pathlib.Path(stockpile_directory / relative_path)
+        directories.add(config_file.parent)
+        fsync_path(path=config_file)
+    for directory in sorted(directories):
+        fsync_path(path=directory)
+
+
+def fsync_path(path: pathlib.Path) -> None:
+    """
+    fsync a file or directory, if it (still) exists and the platform allows it (i.e. Windows can't open directories)
+    :param path:
+    :return:
+    """
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        logger.debug("Unable to fsync %s: %s", path, e)
+    finally:
+        os.close(fd)
+
+
+class ConfigHashes:
+    """
+    The cached size, mtime, and blob hash of each config in a stockpile, so an unchanged config needn't be read (and
+    hashed) to tell that it's unchanged
+    """
+
+    def __init__(self, stockpile_directory: pathlib.Path) -> None:
+        """
+        Load a stockpile's config hash cache
+        :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+        """
+
+        self.stockpile_directory = stockpile_directory
+        self.hashes = dict(load_hash_cache(stockpile_directory=stockpile_directory))
+        self.updated = False
+
+    def blob(self, relative_path: str) -> Optional[str]:
+        """
+        The blob hash of a config, from our cache if it hasn't been written since we cached it
+        :param relative_path: The repository relative path of the config
+        :return: Its blob hash, or None if there's no such config
+        """
+
+        path = pathlib.Path(self.stockpile_directory / relative_path)
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        cached = self.hashes.get(relative_path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        blob = blob_hash_file(path=path)
+        self.hashes[relative_path] = [stat.st_size, stat.st_mtime_ns, blob]
+        self.updated = True
+        return blob
+
+    def save(self) -> None:
+        """
+        Write our cache, if it has changed, replacing the previous one at once
+        :return:
+        """
+
+        if not self.updated:
+            return
+        path = hash_cache_path(stockpile_directory=self.stockpile_directory)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, mode="w") as f:
+                json.dump(self.hashes, f, separators=(",", ":"), sort_keys=True)
+            os.replace(temp_path, str(path))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.updated = False
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+Keep-alive HTTPS sessions for devices managed over HTTP (i.e. the ASA's `/admin/exec/` interface).
+
+Nornir's `http_method` task makes each request through `requests.request()`, which builds a new Session every time,
+so every command costs a new TCP connection, SOCKS negotiation, and TLS handshake.  Here each host gets a Session
+that lives for the whole run (or for as long as `stockpiler serve` keeps it), and every Session is mounted on one
+shared adapter, so connections (including those through a SOCKS proxy, which share one proxy manager) are pooled
+and kept alive between a host's requests.  A device then costs one handshake however many commands we send it.
+
+When a connection does have to be re-opened (the device timed out our idle keep-alive, or a second request ran
+alongside the first), the adapter's SSLContext offers the device the TLS session it last negotiated with it, so the
+new connection is an abbreviated (resumed) handshake rather than a full one.
+"""
+
+import ssl
+import threading
+from typing import Any, Dict, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+
+from nornir.core.task import Result, Task
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ResumingSSLSocket(ssl.SSLSocket):
+    """
+    An SSLSocket that hands its TLS session back to its context when it's closed, by which point a TLS 1.3 server has
+    sent the session tickets it can be resumed with
+    """
+
+    def close(self) -> None:
+        if self.server_hostname is not None:
+            self.context.remember(server_hostname=self.server_hostname, session=self.session)
+        super().close()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    A client SSLContext that resumes the last TLS session it had with a server whenever it connects to it again
+    """
+
+    sslsocket_class = ResumingSSLSocket
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__()
+        self.sessions: Dict[str, ssl.SSLSession] = {}
+
+    def remember(self, server_hostname: str, session: Optional[ssl.SSLSession]) -> None:
+        """
+        Keep a server's TLS session to resume the next time we connect to it
+        :param server_hostname: The name (or address) we connected to the server by
+        :param session: Its TLS session, if the connection got far enough to negotiate one
+        :return:
+        """
+
+        if session is not None:
+            self.sessions[server_hostname] = session
+
+    def forget(self, server_hostname: str) -> None:
+        self.sessions.pop(server_hostname, None)
+
+    def wrap_socket(self, sock: Any, *args: Any, server_hostname: Optional[str] = None, **kwargs: Any) -> ssl.SSLSocket:
+        if kwargs.get("session") is None and server_hostname is not None:
+            kwargs["session"] = self.sessions.get(server_hostname)
+        ssl_sock = super().wrap_socket(sock, *args, server_hostname=server_hostname, **kwargs)
+        # A TLS 1.2 session can be resumed as soon as it's negotiated, a TLS 1.3 one is remembered when it's closed
+        if server_hostname is not None and not ssl_sock.session_reused and ssl_sock.version() != "TLSv1.3":
+            self.remember(server_hostname=server_hostname, session=ssl_sock.session)
+        return ssl_sock
+
+
+class ResumingHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter whose HTTPS connections (direct or through a proxy) resume their TLS sessions.  urllib3's own
+    SSLContexts are made per connection, and refuse session tickets, so none could be resumed.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        # One SSLContext for verified connections and one for unverified, as urllib3 sets its verify_mode on every use
+        self.ssl_contexts: Dict[str, ResumingSSLContext] = {}
+        super().__init__(*args, **kwargs)
+
+    def ssl_context(self, cert_reqs: str) -> ResumingSSLContext:
+        """
+        The SSLContext for connections that verify their server's certificate (or don't)
+        :param cert_reqs: "CERT_REQUIRED" or "CERT_NONE", as requests sets it from a request's `verify`
+        :return:
+        """
+
+        context = self.ssl_contexts.get(cert_reqs)
+        if context is None:
+            context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            if cert_reqs == "CERT_NONE":
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            context = self.ssl_contexts.setdefault(cert_reqs, context)
+        return context
+
+    def build_connection_pool_key_attributes(
+        self, request: requests.PreparedRequest, verify: Any, cert: Any = None
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        if host_params["scheme"] == "https":
+            pool_kwargs["ssl_context"] = self.ssl_context(cert_reqs=pool_kwargs["cert_reqs"])
+        return host_params, pool_kwargs
+
+    def forget(self, server_hostname: str) -> None:
+        """
+        Drop the TLS sessions we'd resume with a server
+        :param server_hostname: The name (or address) we connected to the server by
+        :return:
+        """
+
+        for context in list(self.ssl_contexts.values()):
+            context.forget(server_hostname=server_hostname)
+
+    def close(self) -> None:
+        super().close()
+        for context in list(self.ssl_contexts.values()):
+            context.sessions.clear()
+
+
+class HTTPSessionPool:
+    """
+    One keep-alive requests.Session per host, sharing one connection pooling (and TLS session resuming) adapter
+    """
+
+    def __init__(self, pool_connections: int = 1000, pool_maxsize: int = 2) -> None:
+        """
+        Initialize our pool
+        :param pool_connections: How many hosts (or proxies) to keep connection pools for
+        :param pool_maxsize: How many connections to keep open to each host, each host's task makes one at a time
+        """
+
+        self.lock = threading.Lock()
+        self.adapter = ResumingHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.sessions: Dict[str, requests.Session] = {}
+        # The (address, port) of every endpoint each host's session has connected to, to find its pooled connections
+        self.endpoints: Dict[str, Set[Tuple[str, int]]] = {}
+
+    def session(self, host_name: str, url: str) -> requests.Session:
+        """
+        The Session for a host, creating it if need be
+        :param host_name: The inventory name of the host
+        :param url: The URL we're about to request with it
+        :return:
+        """
+
+        split_url = urlsplit(url)
+        with self.lock:
+            session = self.sessions.get(host_name)
+            if session is None:
+                session = requests.Session()
+                session.mount("https://", self.adapter)
+                session.mount("http://", self.adapter)
+                self.sessions[host_name] = session
+                self.endpoints[host_name] = set()
+            default_port = 443 if split_url.scheme == "https" else 80
+            self.endpoints[host_name].add((split_url.hostname, split_url.port or default_port))
+            return session
+
+    def __contains__(self, host_name: object) -> bool:
+        return host_name in self.sessions
+
+    def close(self, host_name: str) -> None:
+        """
+        Forget a host's Session and TLS sessions, and close its pooled connections.  Sessions aren't closed themselves,
+        as that would close the adapter every Session shares.
+        :param host_name: The inventory name of the host
+        :return:
+        """
+
+        with self.lock:
+            if self.sessions.pop(host_name, None) is None:
+                return
+            endpoints = self.endpoints.pop(host_name)
+            for address, _ in endpoints:
+                self.adapter.forget(server_hostname=address)
+            managers = [self.adapter.poolmanager] + list(self.adapter.proxy_manager.values())
+            for manager in managers:
+                for key in list(manager.pools.keys()):
+                    if (getattr(key, "key_host", None), getattr(key, "key_port", None)) in endpoints:
+                        # Removing a pool from urllib3's container disposes of (closes) its connections
+                        del manager.pools[key]
+
+    def close_all(self) -> None:
+        with self.lock:
+            self.sessions.clear()
+            self.endpoints.clear()
+            self.adapter.close()
+
+
+# Sessions for the whole process, the same way `StockpileMap` holds our tasks
+HTTPSessions = HTTPSessionPool()
+
+
+def http_session_method(
+    task: Task, method: str = "get", url: str = "", raise_for_status: bool = True, **kwargs: Any
+) -> Result:
+    """
+    Nornir's `http_method` task, but made through this host's keep-alive Session
+    :param task:
+    :param method: HTTP method to call
+    :param url: URL to connect to
+    :param raise_for_status: Raise an exception (failing this task) for a 4xx or 5xx response
+    :param kwargs: Passed to `requests.Session.request()`
+    :return: A Nornir Result, with the body of the response (text, or a dict if it was JSON) as its result and the
+        requests.Response as its response
+    """
+
+    response = HTTPSessions.session(host_name=task.host.name, url=url).request(method, url, **kwargs)
+
+    if raise_for_status:
+        response.raise_for_status()
+
+    if response.headers.get("Content-type") == "application/json":
+        result = response.json()
+    else:
+        result = response.text
+
+    return Result(host=task.host, response=response, result=result)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+"""
+A pool of SOCKS5 proxies (i.e. jump hosts), shared by every host's stockpile task.
+
+Each host leases one proxy for the whole of its stockpile, chosen from the proxies currently healthy by the fewest
+active leases, or with `site` affinity preferring the proxies of the host's `site`.  HTTPS management goes through
+the leased proxy, and with `ssh` enabled so do Netmiko's SSH sessions (over a socket opened through the proxy with
+PySocks).
+
+Proxies are probed (a SOCKS5 greeting) when the pool is configured and every `probe_interval` seconds after that,
+and a proxy is taken out of rotation as soon as a host fails through it and it no longer answers a probe, so the run
+carries on through the others.  It's put back once it answers again.
+"""
+
+from contextlib import contextmanager
+from logging import getLogger
+import os
+import socket
+import threading
+from typing import Dict, Iterator, List, Optional
+
+
+from nornir.core.inventory import Host
+
+
+logger = getLogger("stockpiler")
+
+STRATEGIES = ("least_connections", "site")
+
+
+class ProxyUnavailable(OSError):
+    """
+    No proxy in the pool is healthy, or the one leased stopped answering
+    """
+
+
+class ProxyEndpoint:
+    """
+    A SOCKS5 proxy in our pool
+    """
+
+    def __init__(self, host: str, port: int, site: Optional[str] = None) -> None:
+        """
+        Initialize a proxy
+        :param host: Its hostname or IP address
+        :param port:
+        :param site: The site it serves, for site affinity
+        """
+
+        self.host = host
+        self.port = port
+        self.site = site
+        self.healthy = True
+        self.active = 0
+
+    @classmethod
+    def parse(cls, value: str) -> "ProxyEndpoint":
+        """
+        Parse a proxy as given on the command line
+        :param value: `host:port`, optionally with the site it serves, i.e. `jump1.example.com:1080@dc1`
+        :return:
+        """
+
+        address, _, site = value.partition("@")
+        host, _, port = address.rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(f"Unable to parse proxy {value}, expected `host:port` or `host:port@site`")
+        return cls(host=host.strip("[]"), port=int(port), site=site or None)
+
+    @property
+    def proxies(self) -> Dict[str, str]:
+        """
+        This proxy as Requests' proxies Dict
+        :return:
+        """
+
+        return {"https": f"socks5://{self}", "http": f"socks5://{self}"}
+
+    def __str__(self) -> str:
+        return f"{self.host}:{self.port}"
+
+
+class ProxyPool:
+    """
+    Our proxies, their health, and which hosts have leased which
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.endpoints: List[ProxyEndpoint] = []
+        self.strategy = "least_connections"
+        self.ssh = False
+        self.probe_interval = 30.0
+        self.probe_timeout = 2.0
+        self.leases: Dict[str, ProxyEndpoint] = {}
+        self.monitor_pid: Optional[int] = None
+        self.stopping = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.endpoints)
+
+    def configure(
+        self,
+        endpoints: List[ProxyEndpoint],
+        strategy: str = "least_connections",
+        ssh: bool = False,
+        probe_interval: float = 30.0,
+        probe_timeout: float = 2.0,
+    ) -> None:
+        """
+        Set up our pool, and probe every proxy in it
+        :param endpoints: Our proxies
+        :param strategy: `least_connections`, or `site` to prefer the proxies of a host's site
+        :param ssh: Send SSH sessions through our proxies too, not just HTTPS management
+        :param probe_interval: Seconds between probes of each proxy
+        :param probe_timeout: Seconds to wait for a proxy to answer a probe
+        :return:
+        """
+
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown proxy strategy {strategy}, expected one of {', '.join(STRATEGIES)}")
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.ssh = ssh
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.check_health()
+
+    def probe(self, endpoint: ProxyEndpoint) -> bool:
+        """
+        Check a proxy answers a SOCKS5 greeting
+        :param endpoint:
+        :return:
+        """
+
+        try:
+            with socket.create_connection((endpoint.host, endpoint.port), timeout=self.probe_timeout) as sock:
+                # Version 5, offering one method: no authentication
+                sock.sendall(b"\x05\x01\x00")
+                reply = sock.recv(2)
+        except OSError:
+            return False
+        return len(reply) == 2 and reply[0] == 5 and reply[1] != 0xFF
+
+    def check_health(self) -> None:
+        """
+        Probe every proxy, taking those that don't answer out of rotation (and putting back those that do)
+        :return:
+        """
+
+        for endpoint in self.endpoints:
+            healthy = self.probe(endpoint=endpoint)
+            if healthy != endpoint.healthy:
+                logger.warning("Proxy %s is %s", endpoint, "healthy again" if healthy else "not answering")
+            endpoint.healthy = healthy
+
+    def monitor(self) -> None:
+        while not self.stopping.wait(timeout=self.probe_interval):
+            self.check_health()
+
+    def ensure_monitor(self) -> None:
+        """
+        Start probing our proxies in the background, once in each process (i.e. in each `--processes` worker)
+        :return:
+        """
+
+        with self.lock:
+            if self.monitor_pid == os.getpid():
+                return
+            self.monitor_pid = os.getpid()
+        threading.Thread(target=self.monitor, name="stockpiler-proxy-monitor", daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def choose(self, host: Host) -> ProxyEndpoint:
+        """
+        Choose the proxy a host should use: the healthy proxy with the fewest active leases, among those of the
+        host's site first, if we have site affinity
+        :param host: A Nornir Host object
+        :return:
+        """
+
+        candidates = [e for e in self.endpoints if e.healthy]
+        if not candidates:
+            raise ProxyUnavailable(f"No healthy proxy to reach {host} through")
+        if self.strategy == "site":
+            site = host.get("site")
+            candidates = [e for e in candidates if e.site == site] or candidates
+        return min(candidates, key=lambda e: e.active)
+
+    @contextmanager
+    def lease(self, host: Host) -> Iterator[Optional[ProxyEndpoint]]:
+        """
+        Lease a proxy for a host's stockpile
+        :param host: A Nornir Host object
+        :return: The proxy, or None if we have no proxies
+        """
+
+        if not self.enabled:
+            yield None
+            return
+
+        self.ensure_monitor()
+        with self.lock:
+            endpoint = self.choose(host=host)
+            endpoint.active += 1
+            self.leases[host.name] = endpoint
+        try:
+            yield endpoint
+        finally:
+            with self.lock:
+                endpoint.active -= 1
+                self.leases.pop(host.name, None)
+
+    def failed_through(self, endpoint: ProxyEndpoint) -> bool:
+        """
+        A host failed through this proxy, check it's still answering and if not, take it out of rotation
+        :param endpoint:
+        :return: True if the proxy is down (so the host is worth trying again through another)
+        """
+
+        if self.probe(endpoint=endpoint):
+            return False
+        if endpoint.healthy:
+            logger.warning("Proxy %s stopped answering, taking it out of rotation", endpoint)
+        endpoint.healthy = False
+        return True
+
+    def open_socket(self, host: Host, port: int, timeout: float = 10.0) -> socket.socket:
+        """
+        Open a TCP connection to a host through the proxy it has leased, i.e. for its SSH session
+        :param host: A Nornir Host object
+        :param port: The port to connect to on the host
+        :param timeout: Seconds to wait for the connection
+        :return: A connected socket
+        """
+
+        import socks
+
+        endpoint = self.leases.get(host.name)
+        if endpoint is None:
+            raise ProxyUnavailable(f"{host} has no proxy leased")
+        sock = socks.socksocket()
+        sock.set_proxy(socks.SOCKS5, endpoint.host, endpoint.port, rdns=True)
+        sock.settimeout(timeout)
+        try:
+            sock.connect((host.hostname, port))
+        except socks.ProxyConnectionError as e:
+            sock.close()
+            raise ProxyUnavailable(f"Unable to reach proxy {endpoint} for {host}: {e}")
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+
+# Proxies for the whole process, the same way `HTTPSessions` holds our sessions
+Proxies = ProxyPool()
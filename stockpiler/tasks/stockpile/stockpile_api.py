@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+"""
+Backup tasks collecting configs through a device's native API, rather than screen scraping an SSH session.
+
+Hosts whose `stockpile_collection` is `api` (set for every host by `--collection api`) have their config fetched with
+NX-API (`cisco_nxos`), eAPI (`arista_eos`), or a NETCONF `<get-config>` (`cisco_xe`), skipping Netmiko's prompt
+detection, paging, and read timeouts.  NX-API and eAPI requests are made through the host's keep-alive session (see
+stockpiler.tasks.stockpile.http_sessions), and through its proxy if it leased one.  If a host's API is unreachable or
+doesn't answer, it's backed up over SSH instead, as are hosts of any other platform.
+"""
+
+from logging import getLogger
+import pathlib
+from typing import Any, Dict, List, Optional, Tuple
+
+
+from nornir.core.exceptions import NornirSubTaskError
+from nornir.core.inventory import Host
+from nornir.core.task import Result, Task
+
+
+from stockpiler.runners.save_config import save_config_mode
+from stockpiler.tasks.stockpile.config_files import write_config_file
+from stockpiler.tasks.stockpile.proxy_pool import Proxies
+from stockpiler.tasks.stockpile.stockpile_cisco import (
+    authorization_failed,
+    change_marker_command,
+    port_check,
+    stockpile_cisco_generic,
+    tls_verify,
+    unchanged_since_last_backup,
+)
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+logger = getLogger("stockpiler")
+
+COLLECTION_MODES = ("ssh", "api")
+
+# Netmiko platform to the native API its config can be collected through
+NativeAPIs: Dict[str, str] = {"cisco_nxos": "nxapi", "arista_eos": "eapi", "cisco_xe": "netconf"}
+
+# Each API's default port, unless a host sets `stockpile_api_port`
+DEFAULT_API_PORTS = {"nxapi": 443, "eapi": 443, "netconf": 830}
+
+# The commands NX-API and eAPI gather and save configs with
+API_BACKUP_COMMANDS = {"nxapi": "show running-config", "eapi": "show running-config"}
+API_SAVE_COMMANDS = {"nxapi": "copy running-config startup-config", "eapi": "write memory"}
+
+# IOS-XE's RPC for saving its running config, as `write mem` does
+NETCONF_SAVE_CONFIG_RPC = '<save-config xmlns="http://cisco.com/yang/cisco-ia"/>'
+
+
+def native_api(host: Host) -> Optional[str]:
+    """
+    The native API a host's config should be collected through, if any
+    :param host: A Nornir Host object
+    :return: `nxapi`, `eapi`, or `netconf`, or None if it should be backed up over SSH
+    """
+
+    collection = host.get("stockpile_collection", "ssh") or "ssh"
+    if collection not in COLLECTION_MODES:
+        logger.warning("Unknown stockpile_collection %s for %s, backing it up over SSH", collection, host)
+        return None
+    if collection == "ssh":
+        return None
+    return NativeAPIs.get(host.platform)
+
+
+def api_port(host: Host, api: str) -> int:
+    """
+    The port a host's native API listens on
+    :param host: A Nornir Host object
+    :param api: `nxapi`, `eapi`, or `netconf`
+    :return:
+    """
+
+    return host.get("stockpile_api_port", None) or DEFAULT_API_PORTS[api]
+
+
+def api_request(
+    task: Task, api: str, port: int, commands: List[str], proxies: dict = None
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    The URL and Requests options for running CLI commands through NX-API or eAPI, as JSON-RPC with text output
+    :param task:
+    :param api: `nxapi` or `eapi`
+    :param port: The API's HTTPS port
+    :param commands: The commands to run
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: The URL, and the options for requests.Session.request()
+    """
+
+    if api == "nxapi":
+        url = f"https://{task.host.hostname}:{port}/ins"
+        payload: Any = [
+            {"jsonrpc": "2.0", "method": "cli_ascii", "params": {"cmd": command, "version": 1}, "id": i}
+            for (i, command) in enumerate(commands, start=1)
+        ]
+        content_type = "application/json-rpc"
+    else:
+        # eAPI runs commands unprivileged unless they follow an `enable`
+        url = f"https://{task.host.hostname}:{port}/command-api"
+        payload = {
+            "jsonrpc": "2.0",
+            "method": "runCmds",
+            "params": {"version": 1, "cmds": ["enable", *commands], "format": "text"},
+            "id": "stockpiler",
+        }
+        content_type = "application/json"
+
+    api_http_kwargs = {
+        "method": "POST",
+        "json": payload,
+        "auth": (task.host.username, task.host.password),
+        "headers": {"Content-Type": content_type},
+        "verify": tls_verify(task=task),
+        "proxies": proxies,
+    }
+    return url, api_http_kwargs
+
+
+def api_outputs(api: str, body: Any) -> List[str]:
+    """
+    The text output of each command in an NX-API or eAPI JSON-RPC response
+    :param api: `nxapi` or `eapi`
+    :param body: The decoded response
+    :return:
+    """
+
+    if api == "nxapi":
+        # A single command's response isn't wrapped in a list
+        responses = body if isinstance(body, list) else [body]
+        outputs = []
+        for response in responses:
+            if "error" in response:
+                error = response["error"]
+                raise ValueError((error.get("data") or {}).get("msg") or error.get("message"))
+            outputs.append((response.get("result") or {}).get("msg", ""))
+        return outputs
+
+    if "error" in body:
+        raise ValueError(body["error"].get("message"))
+    # Skip the output of our `enable`
+    return [response.get("output", "") for response in body["result"][1:]]
+
+
+def api_commands(task: Task, api: str, port: int, commands: List[str], proxies: dict = None) -> Result:
+    """
+    Run CLI commands through NX-API or eAPI, over this host's keep-alive Session
+    :param task:
+    :param api: `nxapi` or `eapi`
+    :param port: The API's HTTPS port
+    :param commands: The commands to run
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: A Nornir Result, with a List of each command's output as its result and the requests.Response as its
+        response
+    """
+
+    from stockpiler.tasks.stockpile.http_sessions import HTTPSessions
+
+    url, api_http_kwargs = api_request(task=task, api=api, port=port, commands=commands, proxies=proxies)
+    method = api_http_kwargs.pop("method")
+    response = HTTPSessions.session(host_name=task.host.name, url=url).request(method, url, **api_http_kwargs)
+    response.raise_for_status()
+    return Result(host=task.host, response=response, result=api_outputs(api=api, body=response.json()))
+
+
+def netconf_backup(task: Task, port: int, save: bool = False) -> Result:
+    """
+    Fetch a host's running config with a NETCONF `<get-config>`, and optionally save it, in one NETCONF session.  If
+    SSH goes through our proxies, the session is opened over a connection through the proxy this host leased.
+    :param task:
+    :param port: The host's NETCONF port
+    :param save: Save the running config too?
+    :return: A Nornir Result, with the config (as XML) as its result and whether it was saved as its saved
+    """
+
+    from ncclient import manager
+    from ncclient.operations import RPCError
+    from ncclient.xml_ import to_ele
+
+    sock = Proxies.open_socket(host=task.host, port=port) if Proxies.ssh else None
+    try:
+        with manager.connect(
+            host=task.host.hostname,
+            port=port,
+            username=task.host.username,
+            password=task.host.password,
+            hostkey_verify=False,
+            device_params={"name": "iosxe"},
+            sock_fd=sock.fileno() if sock is not None else None,
+        ) as session:
+            config = session.get_config(source="running").data_xml
+            saved = False
+            if save:
+                try:
+                    saved = session.dispatch(to_ele(NETCONF_SAVE_CONFIG_RPC)).ok
+                except RPCError as e:
+                    logger.error("Unable to save the configuration of %s via NETCONF: %s", task.host, e)
+    finally:
+        if sock is not None:
+            sock.close()
+    return Result(host=task.host, result=config, saved=saved)
+
+
+def save_api_config(task: Task, api: str, proxies: dict = None) -> Result:
+    """
+    Save the running config of a host we've backed up through its native API, through that API.  Used by the deferred
+    save config phase, see stockpiler.runners.save_config.
+    :param task:
+    :param api: `nxapi`, `eapi`, or `netconf`
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: Return a Nornir Result object, whose result is True if the config was saved
+    """
+
+    port = api_port(host=task.host, api=api)
+    if api == "netconf":
+        # Fetching the config again is the price of NETCONF having no CLI, but it's cheap next to the save itself
+        saved = task.run(task=netconf_backup, name="save_config", port=port, save=True)[0].saved
+    else:
+        save_results = task.run(
+            task=api_commands,
+            name="save_config",
+            api=api,
+            port=port,
+            commands=[API_SAVE_COMMANDS[api]],
+            proxies=proxies,
+        )
+        saved = "command authorization failed" not in save_results[0].result[0].lower()
+
+    if saved:
+        logger.debug("Successfully saved configuration on %s", task.host)
+    return Result(host=task.host, result=saved, changed=False, failed=not saved)
+
+
+def fall_back_to_ssh(task: Task, api: str, reason: Any, **kwargs) -> Result:
+    """
+    Back up a host over SSH after its native API let us down, discarding the failed API subtasks so they don't fail it
+    :param task:
+    :param api: The API that let us down
+    :param reason: Why, for our logs
+    :param kwargs: The arguments of the stockpile task, passed on to stockpile_cisco_generic
+    :return:
+    """
+
+    logger.warning("Unable to backup %s via %s (%s), falling back to SSH", task.host, api, reason)
+    del task.results[:]
+    return stockpile_cisco_generic(task, **kwargs)
+
+
+def api_backup(
+    task: Task,
+    api: str,
+    port: int,
+    save: bool,
+    stockpile_info: StockpileResults,
+    stockpile_directory: pathlib.Path,
+    proxies: dict = None,
+) -> Optional[str]:
+    """
+    Pull a host's config through its native API, unless its change marker shows nothing has changed since our last
+    backup.  Over NETCONF the config is saved as it's pulled, if it's saved inline.
+    :param task:
+    :param api: `nxapi`, `eapi`, or `netconf`
+    :param port: The API's TCP port
+    :param save: Is the config saved inline, rather than by the deferred save config phase?
+    :param stockpile_info: The host's StockpileResults, updated with the outcome of any NETCONF save (or skip)
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: The config, or None if the host is unchanged since our last backup
+    """
+
+    if api == "netconf":
+        backup_results = task.run(task=netconf_backup, name="backup", port=port, save=save)
+        stockpile_info["save_config_successful"] = backup_results[0].saved
+        return backup_results[0].result
+
+    # Skip the full backup if the device's change marker shows nothing has changed since our last backup
+    marker_command = change_marker_command(task=task)
+    if marker_command is not None:
+        marker_results = task.run(
+            task=api_commands,
+            name="change_marker",
+            api=api,
+            port=port,
+            commands=[marker_command],
+            proxies=proxies,
+        )
+        if unchanged_since_last_backup(
+            task=task,
+            stockpile_info=stockpile_info,
+            stockpile_directory=stockpile_directory,
+            marker_output=marker_results[0].result[0],
+        ):
+            return None
+
+    backup_results = task.run(
+        task=api_commands,
+        name="backup",
+        api=api,
+        port=port,
+        commands=[API_BACKUP_COMMANDS[api]],
+        proxies=proxies,
+    )
+    return backup_results[0].result[0]
+
+
+def api_save_config(task: Task, api: str, port: int, stockpile_info: StockpileResults, proxies: dict = None) -> None:
+    """
+    Save the running config of a host we've just backed up through its native API (NX-API or eAPI), noting if it was
+    saved in its StockpileResults.  A failed save doesn't fail the host, the backup stands.
+    :param task:
+    :param api: `nxapi` or `eapi`
+    :param port: The API's TCP port
+    :param stockpile_info: The host's StockpileResults
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return:
+    """
+
+    try:
+        save_config_results = task.run(
+            task=api_commands,
+            name="save_config",
+            api=api,
+            port=port,
+            commands=[API_SAVE_COMMANDS[api]],
+            proxies=proxies,
+        )
+    except NornirSubTaskError as e:
+        logger.error("Unable to save the configuration of %s via %s: %s", task.host, api, e.result[0].exception)
+        # The backup stands, so don't let the failed save fail this host
+        task.results[:] = [r for r in task.results if not r.failed]
+        return
+    if not authorization_failed(stockpile_info, save_config_results[0].result[0]):
+        stockpile_info["save_config_successful"] = True
+        logger.debug("Successfully saved configuration on %s", task.host)
+
+
+def stockpile_native_api(
+    task: Task,
+    stockpile_directory: pathlib.Path,
+    backup_command: str = "more system:running-config",
+    proxies: dict = None,
+) -> Result:
+    """
+    Gather the configuration of an NX-OS, EOS, or IOS-XE device through its native API (see above), and write that to
+    a file (overwriting any existing file by that name).  Falls back to SSH, as stockpile_cisco_generic, if the host
+    isn't collected through its API or its API fails us.
+    :param task:
+    :param stockpile_directory: An instantiated pathlib.Path object for the directory where we're going to write this
+    :param backup_command: What command to execute for backup over SSH, defaults to `more system:running-config`
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: Return a Nornir Result object.  The Result.result attribute will contain a
+        stockpiler.tasks.device_backup.StockpileResults object which is a dict-like object containing information on if
+        backup was successful and what method was used, the config, etc.
+    """
+
+    ssh_kwargs = {"stockpile_directory": stockpile_directory, "backup_command": backup_command, "proxies": proxies}
+    api = native_api(host=task.host)
+    if api is None:
+        return stockpile_cisco_generic(task, **ssh_kwargs)
+
+    # Dict-like object of our eventual return info
+    stockpile_info = StockpileResults(
+        name=f"{task.host}_backup",
+        ip=task.host.hostname,
+        hostname=task.host.get("device_name", task.host),
+        ssh_mgmt_port=task.host.get("port", 22) or 22,  # Need `or` statement as we're getting None from inventory
+    )
+
+    # Validate the API's TCP port; skip if it goes through our proxies, the TCP check won't do us any good.
+    port = api_port(host=task.host, api=api)
+    proxied = Proxies.ssh if api == "netconf" else proxies is not None
+    if not proxied and not port_check(task=task, check_name="api_port_check_ok", port=port):
+        return fall_back_to_ssh(task, api=api, reason=f"port {port} unreachable", **ssh_kwargs)
+
+    logger.debug("Attempting to backup %s:%s via %s", task.host, port, api)
+    save = save_config_mode(host=task.host) == "inline"
+    try:
+        device_config = api_backup(
+            task=task,
+            api=api,
+            port=port,
+            save=save,
+            stockpile_info=stockpile_info,
+            stockpile_directory=stockpile_directory,
+            proxies=proxies,
+        )
+    except NornirSubTaskError as e:
+        return fall_back_to_ssh(task, api=api, reason=e.result[0].exception, **ssh_kwargs)
+
+    if device_config is None:
+        stockpile_info["api_used"] = api
+        return Result(host=task.host, result=stockpile_info, changed=False, failed=False)
+    if not device_config:
+        return fall_back_to_ssh(task, api=api, reason="empty configuration", **ssh_kwargs)
+    if not authorization_failed(stockpile_info, device_config):
+        stockpile_info["device_config"] = device_config
+        stockpile_info["backup_successful"] = True
+        stockpile_info["api_used"] = api
+        logger.debug("Successfully backed up %s", task.host)
+
+    # Save the config on the box (unless it's left to the deferred save config phase, or NETCONF has done so already):
+    if save and api != "netconf" and stockpile_info["backup_successful"]:
+        api_save_config(task=task, api=api, port=port, stockpile_info=stockpile_info, proxies=proxies)
+
+    # Attempt to save the backup if we have one
+    if stockpile_info["backup_successful"]:
+        task.run(
+            task=write_config_file,
+            name="write_file",
+            stockpile_directory=stockpile_directory,
+            content=stockpile_info["device_config"],
+        )
+    else:
+        logger.error("Failed to backup %s via %s", task.host, api)
+
+    return Result(host=task.host, result=stockpile_info, changed=False, failed=not stockpile_info["backup_successful"])
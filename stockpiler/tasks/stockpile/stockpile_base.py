@@ -4,27 +4,230 @@
 Base backup related objects and functions
 """
 
-from netmiko import platforms
+from collections.abc import Mapping
+import importlib
+from logging import getLogger
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Optional, Union
+
+
+from nornir.core.exceptions import NornirSubTaskError
 from nornir.core.task import Result, Task
 
 
-from stockpiler.tasks.stockpile.stockpile_cisco import stockpile_cisco_generic, stockpile_cisco_asa
+from stockpiler.runners.scheduling import past_deadline
+from stockpiler.tasks.stockpile.concurrency import DEFAULT_RETRIES, Limits, rate_limited, retry_backoff
+from stockpiler.tasks.stockpile.proxy_pool import Proxies
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+logger = getLogger("stockpiler")
+
+
+class StockpileRegistry(Mapping):
+    """
+    A Dict like registry of Netmiko platform to the Stockpiler task that backs it up.
+
+    Tasks are registered by their import path (`package.module:function`), and a platform's module is only imported
+    the first time a host of that platform needs it, so a run against one device doesn't pay to import every
+    platform's dependencies.
+    """
+
+    def __init__(self, default: str) -> None:
+        """
+        Initialize our registry
+        :param default: Import path of the task for any Netmiko platform without a specific task registered
+        """
+
+        self.default = default
+        self.tasks: Dict[str, Union[str, Callable[..., Result]]] = {}
+        self.lock = threading.Lock()
+
+    def register(self, platform: str, task: Union[str, Callable[..., Result]]) -> None:
+        """
+        Register the task (or its import path, `package.module:function`) that backs up a platform
+        :param platform: A Netmiko platform, i.e. `cisco_asa`
+        :param task:
+        :return:
+        """
+
+        with self.lock:
+            self.tasks[platform] = task
+
+    __setitem__ = register
+
+    @staticmethod
+    def load(import_path: str) -> Callable[..., Result]:
+        """
+        Import a task from its import path
+        :param import_path: i.e. `stockpiler.tasks.stockpile.stockpile_cisco:stockpile_cisco_asa`
+        :return:
+        """
+
+        module_name, _, task_name = import_path.partition(":")
+        return getattr(importlib.import_module(module_name), task_name)
+
+    def lookup(self, platform: str) -> Union[str, Callable[..., Result]]:
+        """
+        Find the task (or its import path) registered for a platform, without importing it
+        :param platform:
+        :return:
+        """
+
+        task = self.tasks.get(platform)
+        if task is None:
+            # Netmiko's platform list is only needed for platforms we haven't registered, and is about to be needed
+            # for the connection anyhow
+            from netmiko import platforms
+
+            if platform not in platforms:
+                raise KeyError(platform)
+            task = self.default
+        return task
+
+    def __getitem__(self, platform: str) -> Callable[..., Result]:
+        task = self.lookup(platform=platform)
+        if isinstance(task, str):
+            task = self.load(import_path=task)
+            self.register(platform=platform, task=task)
+        return task
+
+    def __contains__(self, platform: object) -> bool:
+        try:
+            self.lookup(platform=platform)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[str]:
+        from netmiko import platforms
+
+        return iter(dict.fromkeys([*platforms, *self.tasks]))
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+    def preload(self, platforms: Iterable[str]) -> None:
+        """
+        Import the tasks for these platforms now, i.e. those of a filtered inventory before starting worker threads
+        :param platforms:
+        :return:
+        """
+
+        for platform in set(platforms):
+            if platform in self:
+                _ = self[platform]
 
 
 # Maps Netmiko platform to our Stockpiler tasks, default is `stockpile_cisco_generic` unless otherwise specified.
-StockpileMap = {platform: stockpile_cisco_generic for platform in platforms}
-StockpileMap["cisco_asa"] = stockpile_cisco_asa
+StockpileMap = StockpileRegistry(default="stockpiler.tasks.stockpile.stockpile_cisco:stockpile_cisco_generic")
+StockpileMap.register("cisco_asa", "stockpiler.tasks.stockpile.stockpile_cisco:stockpile_cisco_asa")
+# Platforms with a native API their configs can be collected through (falling back to SSH), see `--collection`
+StockpileMap.register("cisco_nxos", "stockpiler.tasks.stockpile.stockpile_api:stockpile_native_api")
+StockpileMap.register("arista_eos", "stockpiler.tasks.stockpile.stockpile_api:stockpile_native_api")
+StockpileMap.register("cisco_xe", "stockpiler.tasks.stockpile.stockpile_api:stockpile_native_api")
+
+# Hosts with a `stockpile_transfer` (see `--transfer`) copy their config off as a file instead, whatever their platform.
+# To do so for every host of a platform, register this for it, i.e. `StockpileMap.register("cisco_ios", TRANSFER_TASK)`
+TRANSFER_TASK = "stockpiler.tasks.stockpile.stockpile_transfer:stockpile_cisco_transfer"
 # Todo: Add F5, Netscaler, and other platform support.
 
 
+def run_stockpile_task(
+    task: Task, stockpile_task: Callable[..., Result], limits: Dict[str, int], retry: bool, **kwargs
+) -> Optional[Result]:
+    """
+    Run a host's stockpile task, holding its concurrency limits and (if we have a proxy pool) a proxy.  If the host
+    fails because its proxy went down, it's run again straight away through another.
+    :param task: Nornir task execution object.
+    :param stockpile_task: The task that backs up this host's platform
+    :param limits: The concurrency limits that apply to this host
+    :param retry: Will the host be retried if it's turned away?
+    :param kwargs: Additional arguments to pass to the actual stockpile task.
+    :return: The task's Result, or None if the host was turned away (i.e. failed to authenticate) and will be retried
+    """
+
+    failovers = 0
+    while True:
+        with Limits.acquire(limits=limits), Proxies.lease(host=task.host) as proxy:
+            if proxy is not None:
+                kwargs["proxies"] = proxy.proxies
+            try:
+                return stockpile_task(task, **kwargs)
+            except NornirSubTaskError as e:
+                if proxy is not None and failovers < len(Proxies.endpoints) and Proxies.failed_through(proxy):
+                    logger.warning("Proxy %s failed while backing up %s, trying another", proxy, task.host)
+                    failovers += 1
+                    del task.results[:]
+                    continue
+                if not retry or not rate_limited(error=e):
+                    raise
+                return None
+
+
+def retry_authorization(result: Result, attempt: int, retries: int) -> bool:
+    """
+    Should a host that finished its stockpile task be retried, as it was refused command authorization?
+    :param result: The Result of the host's stockpile task
+    :param attempt: The attempt that finished, from 0
+    :param retries: The most retries this host is allowed
+    :return:
+    """
+
+    if attempt >= retries:
+        return False
+    if result.result.get("backup_successful"):
+        return False
+    return bool(result.result.get("authorization_failed"))
+
+
 def stockpile_device_config(task: Task, **kwargs) -> Result:
     """
     Trigger a "stockpile" or backup of a device configuration.  Will use the StockpileMapper dict to determine what
-    plugin/task to utilize.
+    plugin/task to utilize.  If the run has a deadline this host can't be expected to finish by, it is deferred
+    rather than started (see stockpiler.runners.scheduling).
+    The host holds the concurrency limits that apply to it while it runs, and if it was turned away (failing to
+    authenticate, or refused command authorization) it is retried after backing off, releasing them while it waits
+    (see stockpiler.tasks.stockpile.concurrency).  The backoff still holds this host's worker thread, so each wait is
+    capped at MAX_RETRY_BACKOFF.  With a proxy pool, it leases a proxy for each attempt (see
+    stockpiler.tasks.stockpile.proxy_pool).  Hosts with a `stockpile_transfer` copy their config off as a file (see
+    stockpiler.tasks.stockpile.stockpile_transfer), whatever their platform's task.
     :param task: Nornir task execution object.
     :param kwargs: Additional arguments to pass to the actual stockpile task.
     :return:
     """
 
-    stockpile_task = StockpileMap[task.host.platform]
-    return stockpile_task(task, **kwargs)
+    if past_deadline(task=task):
+        logger.warning("Deferring %s, it isn't expected to finish before the deadline", task.host)
+        stockpile_info = StockpileResults(
+            name=f"{task.host}_backup",
+            ip=task.host.hostname,
+            hostname=task.host.get("device_name", task.host),
+            ssh_mgmt_port=task.host.get("port", 22) or 22,
+            skip_reason="deferred",
+        )
+        return Result(host=task.host, result=stockpile_info, changed=False, failed=False)
+
+    if task.host.get("stockpile_transfer", None) not in (None, "off"):
+        stockpile_task = StockpileMap.load(import_path=TRANSFER_TASK)
+    else:
+        stockpile_task = StockpileMap[task.host.platform]
+    limits = Limits.host_limits(task=task)
+    retries = int(task.host.get("stockpile_retries", DEFAULT_RETRIES))
+    attempt = 0
+    while True:
+        result = run_stockpile_task(
+            task=task, stockpile_task=stockpile_task, limits=limits, retry=attempt < retries, **kwargs
+        )
+        if result is not None and not retry_authorization(result=result, attempt=attempt, retries=retries):
+            return result
+
+        backoff = retry_backoff(host=task.host, attempt=attempt)
+        logger.warning(
+            "%s turned us away, retrying in %.1fs (retry %s of %s)", task.host, backoff, attempt + 1, retries
+        )
+        time.sleep(backoff)
+        # Start the next attempt afresh, so the failed attempt's subtasks don't fail this host
+        del task.results[:]
+        attempt += 1
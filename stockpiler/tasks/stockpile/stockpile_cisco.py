@@ -8,23 +8,192 @@ Backup tasks for Cisco devices
 import ipaddress
 from logging import getLogger
 import pathlib
+from typing import Any, Dict, Optional, Tuple
 from urllib.parse import quote_plus
 
 
 from nornir.core.task import Result, Task
-from nornir.plugins.tasks import files
-from nornir.plugins.tasks.apis import http_method
 from nornir.plugins.tasks.networking import netmiko_save_config, netmiko_send_command, tcp_ping
 
 
+from stockpiler.runners.save_config import save_config_mode
+from stockpiler.tasks.stockpile.change_markers import ChangeMarkerCommands, load_manifest, parse_change_marker
+from stockpiler.tasks.stockpile.config_files import write_config_file
+from stockpiler.tasks.stockpile.proxy_pool import Proxies
 from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
 
 
 logger = getLogger("stockpiler")
 
 
+def port_check(task: Task, check_name: str, port: int) -> bool:
+    """
+    Check if a management port is reachable, using the result of a pre-flight reachability sweep if one was run
+    (see stockpiler.runners.reachability), otherwise with a tcp_ping subtask.  SSH sent through our proxies is
+    assumed reachable, as checking from here won't do us any good.
+    :param task:
+    :param check_name: The name of this check in StockpileResults, i.e. `ssh_port_check_ok`
+    :param port: The TCP port to check
+    :return:
+    """
+
+    if check_name in task.host.data:
+        return task.host.data[check_name]
+    if check_name == "ssh_port_check_ok" and Proxies.ssh:
+        return True
+    return task.run(task=tcp_ping, ports=[port], timeout=1).result[port]
+
+
+def netmiko_connect(task: Task) -> Result:
+    """
+    Open this host's Netmiko connection (or reuse an open one), as a subtask of its own so connecting and
+    authenticating are timed separately from the commands that follow.  If SSH goes through our proxies, the session
+    is opened over a connection through the proxy this host leased.
+    :param task:
+    :return:
+    """
+
+    if Proxies.ssh and "netmiko" not in task.host.connections:
+        parameters = task.host.get_connection_parameters("netmiko")
+        sock = Proxies.open_socket(host=task.host, port=parameters.port or 22)
+        task.host.open_connection("netmiko", task.nornir.config, extras={**(parameters.extras or {}), "sock": sock})
+    else:
+        task.host.get_connection("netmiko", task.nornir.config)
+    return Result(host=task.host)
+
+
+def change_marker_command(task: Task) -> Optional[str]:
+    """
+    If this host should skip unchanged configs (`stockpile_skip_unchanged` in its inventory data, or set for every
+    host by `--skip_unchanged`), the command that returns its change marker.
+    :param task:
+    :return: The command, or None if this host should be backed up in full regardless
+    """
+
+    if not task.host.get("stockpile_skip_unchanged", False) or task.host.platform not in ChangeMarkerCommands:
+        return None
+    return ChangeMarkerCommands[task.host.platform][0]
+
+
+def unchanged_since_last_backup(
+    task: Task, stockpile_info: StockpileResults, stockpile_directory: pathlib.Path, marker_output: str
+) -> bool:
+    """
+    Record this host's change marker in its results, and compare it with the marker at its last successful backup.
+    If they match, mark the backup as successful (but skipped) as our stockpiled config is still current.
+    :param task:
+    :param stockpile_info: This host's StockpileResults
+    :param stockpile_directory: An instantiated pathlib.Path object for the directory where we're writing configs
+    :param marker_output: The output of the host's change marker command
+    :return: True if the host's config hasn't changed, and the full backup can be skipped
+    """
+
+    marker = parse_change_marker(platform=task.host.platform, output=marker_output)
+    stockpile_info["change_marker"] = marker
+    if marker is None or load_manifest(stockpile_directory=stockpile_directory).get(task.host.name) != marker:
+        return False
+
+    logger.debug("Configuration of %s is unchanged since its last backup, skipping it", task.host)
+    stockpile_info["backup_successful"] = True
+    stockpile_info["skip_reason"] = "unchanged"
+    return True
+
+
+def authorization_failed(stockpile_info: StockpileResults, output: str) -> bool:
+    """
+    Check command output for the device refusing to authorize the command (i.e. when its TACACS server is
+    overloaded), noting it in this host's results so the attempt can be retried
+    :param stockpile_info: This host's StockpileResults
+    :param output: The command output
+    :return: True if the command was refused
+    """
+
+    if "command authorization failed" in output.lower():
+        stockpile_info["authorization_failed"] = True
+        return True
+    return False
+
+
+def tls_verify(task: Task) -> bool:
+    """
+    Should the TLS certificate of a host's HTTPS management be verified?  Not if we reach it by IP address, as its
+    certificate can't be issued for that (and TLS warnings are disabled, so they don't flood our logs).
+    :param task:
+    :return:
+    """
+
+    try:
+        _ = ipaddress.ip_address(task.host.hostname)
+    except ValueError:
+        return True
+
+    import urllib3
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return False
+
+
+def asa_http_request(task: Task, http_mgmt_port: int, proxies: dict = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    The URL and Requests options for running commands on an ASA over HTTPS, as ASDM does
+    :param task:
+    :param http_mgmt_port: The ASA's HTTPS management port
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: The URL to append the (quoted) command to, and the options for http_session_method
+    """
+
+    url = f"https://{task.host.hostname}:{http_mgmt_port}/admin/exec/"
+    asa_http_kwargs = {
+        "method": "GET",
+        "auth": (task.host.username, task.host.password),
+        "headers": {"User-Agent": "ASDM"},
+        "verify": tls_verify(task=task),
+        "proxies": proxies,
+    }
+    return url, asa_http_kwargs
+
+
+def save_cisco_config(
+    task: Task, http_used: bool = False, http_mgmt_port: int = 443, proxies: dict = None
+) -> Result:
+    """
+    Save the running config of a Cisco device we've already backed up, the same way we backed it up (`write mem` over
+    HTTPS for an ASA backed up that way, otherwise over SSH).  Used by the deferred save config phase, see
+    stockpiler.runners.save_config.
+    :param task:
+    :param http_used: Was the device backed up over HTTPS?
+    :param http_mgmt_port: Its HTTPS management port, if so
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: Return a Nornir Result object, whose result is True if the config was saved
+    """
+
+    if http_used:
+        from stockpiler.tasks.stockpile.http_sessions import http_session_method
+
+        url, asa_http_kwargs = asa_http_request(task=task, http_mgmt_port=http_mgmt_port, proxies=proxies)
+        wr_mem_results = task.run(
+            task=http_session_method, name="save_config", url=url + quote_plus("write mem"), **asa_http_kwargs
+        )
+        saved = wr_mem_results[0].response.ok and "command authorization failed" not in (
+            wr_mem_results[0].response.text.lower()
+        )
+    else:
+        task.run(task=netmiko_connect, name="connect")
+        wr_mem_results = task.run(task=netmiko_save_config, name="save_config")
+        saved = not wr_mem_results[0].failed and "command authorization failed" not in (
+            wr_mem_results[0].result.lower()
+        )
+
+    if saved:
+        logger.debug("Successfully saved configuration on %s", task.host)
+    return Result(host=task.host, result=saved, changed=False, failed=not saved)
+
+
 def stockpile_cisco_generic(
-    task: Task, stockpile_directory: pathlib.Path, backup_command: str = "more system:running-config"
+    task: Task,
+    stockpile_directory: pathlib.Path,
+    backup_command: str = "more system:running-config",
+    proxies: dict = None,
 ) -> Result:
     """
     Gather the text configuration from a Cisco IOS (or similar) device, and write that to a file
@@ -32,6 +201,7 @@ def stockpile_cisco_generic(
     :param task:
     :param stockpile_directory: An instantiated pathlib.Path object for the directory where we're going to write this
     :param backup_command: What command to execute for backup, defaults to `more system:running-config`
+    :param proxies: Optional Dict of SOCKS proxies for HTTP connectivity, unused as we only back up via SSH here
     :return: Return a Nornir Result object.  The Result.result attribute will contain a
         stockpiler.tasks.device_backup.StockpileResults object which is a dict-like object containing information on if
         backup was successful and what method was used, the config, etc.
@@ -46,9 +216,9 @@ def stockpile_cisco_generic(
     )
 
     # Validate SSH TCP port:
-    stockpile_info["ssh_port_check_ok"] = task.run(
-        task=tcp_ping, ports=[stockpile_info["ssh_mgmt_port"]], timeout=1
-    ).result[stockpile_info["ssh_mgmt_port"]]
+    stockpile_info["ssh_port_check_ok"] = port_check(
+        task=task, check_name="ssh_port_check_ok", port=stockpile_info["ssh_mgmt_port"]
+    )
 
     # If we can't SSH port, what are we doing here?  GET TO THE CHOPPA!
     if not stockpile_info["ssh_port_check_ok"]:
@@ -61,34 +231,165 @@ def stockpile_cisco_generic(
 
     # Attempt backup via SSH.
     logger.debug("Attempting to backup %s:%s via SSH", task.host, stockpile_info["ssh_mgmt_port"])
+    task.run(task=netmiko_connect, name="connect")
+
+    # Skip the full backup if the device's change marker shows nothing has changed since our last backup
+    marker_command = change_marker_command(task=task)
+    if marker_command is not None:
+        marker_results = task.run(task=netmiko_send_command, name="change_marker", command_string=marker_command)
+        if unchanged_since_last_backup(
+            task=task,
+            stockpile_info=stockpile_info,
+            stockpile_directory=stockpile_directory,
+            marker_output=marker_results[0].result,
+        ):
+            stockpile_info["ssh_used"] = True
+            return Result(host=task.host, result=stockpile_info, changed=False, failed=False)
 
     # Gather a backup:
-    backup_results = task.run(task=netmiko_send_command, command_string=backup_command)
-    if not backup_results[0].failed and "command authorization failed" not in backup_results[0].result.lower():
+    backup_results = task.run(task=netmiko_send_command, name="backup", command_string=backup_command)
+    if not backup_results[0].failed and not authorization_failed(stockpile_info, backup_results[0].result):
         stockpile_info["device_config"] = backup_results[0].result
         stockpile_info["backup_successful"] = True
         stockpile_info["ssh_used"] = True
         logger.debug("Successfully backed up %s", task.host)
 
-    # Save the config on the box:
-    save_config_results = task.run(task=netmiko_save_config)
-    if (
-        not save_config_results[0].failed
-        and "command authorization failed" not in save_config_results[0].result.lower()
-    ):
-        stockpile_info["save_config_successful"] = True
-        logger.debug("Successfully saved configuration on %s", task.host)
+    # Save the config on the box (unless it's left to the deferred save config phase):
+    if save_config_mode(host=task.host) == "inline":
+        save_config_results = task.run(task=netmiko_save_config, name="save_config")
+        if not save_config_results[0].failed and not authorization_failed(
+            stockpile_info, save_config_results[0].result
+        ):
+            stockpile_info["save_config_successful"] = True
+            logger.debug("Successfully saved configuration on %s", task.host)
 
     # Attempt to save the backup if we have one
     if stockpile_info["backup_successful"]:
-        file_name = pathlib.Path(stockpile_directory / f"{str(task.host)}.txt")
-        task.run(task=files.write_file, filename=str(file_name), content=stockpile_info["device_config"])
+        task.run(
+            task=write_config_file,
+            name="write_file",
+            stockpile_directory=stockpile_directory,
+            content=stockpile_info["device_config"],
+        )
     else:
         logger.error("Failed to backup %s", task.host)
 
     return Result(host=task.host, result=stockpile_info, changed=False, failed=not stockpile_info["backup_successful"])
 
 
+def asa_http_backup(
+    task: Task,
+    stockpile_info: StockpileResults,
+    stockpile_directory: pathlib.Path,
+    backup_command: str,
+    proxies: Optional[dict],
+) -> bool:
+    """
+    Backup an ASA via its `/admin/exec/` HTTPS interface, and save its config on the box (unless that's left to the
+    deferred save config phase), noting how it went in its StockpileResults
+    :param task:
+    :param stockpile_info: The host's StockpileResults
+    :param stockpile_directory: An instantiated pathlib.Path object for the directory where we're going to write this
+    :param backup_command: What command to execute for backup
+    :param proxies: Optional Dict of SOCKS proxies to use for HTTP connectivity
+    :return: True if its change marker shows nothing has changed since our last backup, so it wasn't backed up again
+    """
+
+    logger.debug("Attempting to backup %s:%s via HTTPS", task.host, stockpile_info["http_mgmt_port"])
+
+    # Only import the Requests stack when a device is actually managed over HTTPS.  Requests are made through a
+    # keep-alive session for this host, so the backup and `write mem` share one connection (and TLS handshake).
+    from stockpiler.tasks.stockpile.http_sessions import http_session_method
+
+    # Setup Requests options/payload
+    url, asa_http_kwargs = asa_http_request(task=task, http_mgmt_port=stockpile_info["http_mgmt_port"], proxies=proxies)
+
+    # Skip the full backup if the device's change marker shows nothing has changed since our last backup
+    marker_command = change_marker_command(task=task)
+    if marker_command is not None:
+        marker_results = task.run(
+            task=http_session_method, name="change_marker", url=url + quote_plus(marker_command), **asa_http_kwargs
+        )
+        if marker_results[0].response.ok and unchanged_since_last_backup(
+            task=task,
+            stockpile_info=stockpile_info,
+            stockpile_directory=stockpile_directory,
+            marker_output=marker_results[0].response.text,
+        ):
+            stockpile_info["http_used"] = True
+            return True
+
+    # Gather a backup:
+    backup_results = task.run(
+        task=http_session_method, name="backup", url=url + quote_plus(backup_command), **asa_http_kwargs
+    )
+    if backup_results[0].response.ok and not authorization_failed(stockpile_info, backup_results[0].response.text):
+        stockpile_info["device_config"] = backup_results[0].response.text
+        stockpile_info["backup_successful"] = True
+        stockpile_info["http_used"] = True
+        logger.debug("Successfully backed up %s", task.host)
+
+    # Save the config on the box (unless it's left to the deferred save config phase):
+    if save_config_mode(host=task.host) == "inline":
+        wr_mem_results = task.run(
+            task=http_session_method, name="save_config", url=url + quote_plus("write mem"), **asa_http_kwargs
+        )
+        if wr_mem_results[0].response.ok and not authorization_failed(
+            stockpile_info, wr_mem_results[0].response.text
+        ):
+            stockpile_info["save_config_successful"] = True
+            logger.debug("Successfully saved configuration on %s", task.host)
+
+    return False
+
+
+def asa_ssh_backup(
+    task: Task, stockpile_info: StockpileResults, stockpile_directory: pathlib.Path, backup_command: str
+) -> bool:
+    """
+    Backup an ASA via SSH, and save its config on the box (unless that's left to the deferred save config phase),
+    noting how it went in its StockpileResults
+    :param task:
+    :param stockpile_info: The host's StockpileResults
+    :param stockpile_directory: An instantiated pathlib.Path object for the directory where we're going to write this
+    :param backup_command: What command to execute for backup
+    :return: True if its change marker shows nothing has changed since our last backup, so it wasn't backed up again
+    """
+
+    logger.debug("Attempting to backup %s:%s via SSH", task.host, stockpile_info["ssh_mgmt_port"])
+    task.run(task=netmiko_connect, name="connect")
+
+    # Skip the full backup if the device's change marker shows nothing has changed since our last backup
+    marker_command = change_marker_command(task=task)
+    if marker_command is not None and stockpile_info.get("change_marker") is None:
+        marker_results = task.run(task=netmiko_send_command, name="change_marker", command_string=marker_command)
+        if unchanged_since_last_backup(
+            task=task,
+            stockpile_info=stockpile_info,
+            stockpile_directory=stockpile_directory,
+            marker_output=marker_results[0].result,
+        ):
+            stockpile_info["ssh_used"] = True
+            return True
+
+    # Gather a backup:
+    backup_results = task.run(task=netmiko_send_command, name="backup", command_string=backup_command)
+    if not backup_results[0].failed and not authorization_failed(stockpile_info, backup_results[0].result):
+        stockpile_info["device_config"] = backup_results[0].result
+        stockpile_info["backup_successful"] = True
+        stockpile_info["ssh_used"] = True
+        logger.debug("Successfully backed up %s", task.host)
+
+    # Save the config on the box (unless it's left to the deferred save config phase):
+    if save_config_mode(host=task.host) == "inline":
+        wr_mem_results = task.run(task=netmiko_save_config, name="save_config")
+        if not wr_mem_results[0].failed and not authorization_failed(stockpile_info, wr_mem_results[0].result):
+            stockpile_info["save_config_successful"] = True
+            logger.debug("Successfully saved configuration on %s", task.host)
+
+    return False
+
+
 def stockpile_cisco_asa(
     task: Task,
     stockpile_directory: pathlib.Path,
@@ -120,14 +421,14 @@ def stockpile_cisco_asa(
     if stockpile_info["http_management"] and proxies is not None:
         stockpile_info["http_port_check_ok"] = True
     elif stockpile_info["http_management"]:
-        stockpile_info["http_port_check_ok"] = task.run(
-            task=tcp_ping, ports=[stockpile_info["http_mgmt_port"]], timeout=1
-        ).result[stockpile_info["http_mgmt_port"]]
+        stockpile_info["http_port_check_ok"] = port_check(
+            task=task, check_name="http_port_check_ok", port=stockpile_info["http_mgmt_port"]
+        )
 
     # Validate SSH TCP port, in case we need it (as fallback) or if HTTP mgmt disabled:
-    stockpile_info["ssh_port_check_ok"] = task.run(
-        task=tcp_ping, ports=[stockpile_info["ssh_mgmt_port"]], timeout=1
-    ).result[stockpile_info["ssh_mgmt_port"]]
+    stockpile_info["ssh_port_check_ok"] = port_check(
+        task=task, check_name="ssh_port_check_ok", port=stockpile_info["ssh_mgmt_port"]
+    )
 
     # If we can't hit either port, what are we doing here?  GET TO THE CHOPPA!
     if not stockpile_info["http_port_check_ok"] and not stockpile_info["ssh_port_check_ok"]:
@@ -142,71 +443,33 @@ def stockpile_cisco_asa(
         )
 
     # Attempt backup via HTTPS if port check was OK (and it is configured for https management in inventory)
-    if stockpile_info["http_port_check_ok"]:
-        logger.debug("Attempting to backup %s:%s via HTTPS", task.host, stockpile_info["http_mgmt_port"])
-
-        # Disable TLS warnings if task.host.hostname is an IP address:
-        try:
-            _ = ipaddress.ip_address(task.host.hostname)
-            import urllib3
-
-            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-            verify = False
-        except ValueError:
-            verify = True
-
-        # Setup Requests options/payload
-        url = f"https://{task.host.hostname}:{stockpile_info['http_mgmt_port']}/admin/exec/"
-        asa_http_kwargs = {
-            "method": "GET",
-            "auth": (task.host.username, task.host.password),
-            "headers": {"User-Agent": "ASDM"},
-            "verify": verify,
-            "proxies": proxies,
-        }
-
-        # Gather a backup:
-        backup_results = task.run(task=http_method, url=url + quote_plus(backup_command), **asa_http_kwargs)
-        if (
-            backup_results[0].response.ok
-            and "command authorization failed" not in backup_results[0].response.text.lower()
-        ):
-            stockpile_info["device_config"] = backup_results[0].response.text
-            stockpile_info["backup_successful"] = True
-            stockpile_info["http_used"] = True
-            logger.debug("Successfully backed up %s", task.host)
-
-        # Save the config on the box:
-        wr_mem_results = task.run(task=http_method, url=url + quote_plus("write mem"), **asa_http_kwargs)
-        if (
-            wr_mem_results[0].response.ok
-            and "command authorization failed" not in backup_results[0].response.text.lower()
-        ):
-            stockpile_info["save_config_successful"] = True
-            logger.debug("Successfully saved configuration on %s", task.host)
+    if stockpile_info["http_port_check_ok"] and asa_http_backup(
+        task=task,
+        stockpile_info=stockpile_info,
+        stockpile_directory=stockpile_directory,
+        backup_command=backup_command,
+        proxies=proxies,
+    ):
+        return Result(host=task.host, result=stockpile_info, changed=False, failed=False)
 
     # Attempt backup via SSH, if HTTPS fails or HTTPS management was not enabled.
     if not stockpile_info["backup_successful"] and stockpile_info["ssh_port_check_ok"]:
-        logger.debug("Attempting to backup %s:%s via SSH", task.host, stockpile_info["ssh_mgmt_port"])
-
-        # Gather a backup:
-        backup_results = task.run(task=netmiko_send_command, command_string=backup_command)
-        if not backup_results[0].failed and "command authorization failed" not in backup_results[0].result.lower():
-            stockpile_info["device_config"] = backup_results[0].result
-            stockpile_info["backup_successful"] = True
-            stockpile_info["ssh_used"] = True
-            logger.debug("Successfully backed up %s", task.host)
-
-        # Save the config on the box:
-        wr_mem_results = task.run(task=netmiko_save_config)
-        if not wr_mem_results[0].failed and "command authorization failed" not in wr_mem_results[0].result.lower():
-            stockpile_info["save_config_successful"] = True
-            logger.debug("Successfully saved configuration on %s", task.host)
+        if asa_ssh_backup(
+            task=task,
+            stockpile_info=stockpile_info,
+            stockpile_directory=stockpile_directory,
+            backup_command=backup_command,
+        ):
+            return Result(host=task.host, result=stockpile_info, changed=False, failed=False)
 
     # Attempt to save the backup if we have one
     if stockpile_info["backup_successful"]:
-        file_name = pathlib.Path(stockpile_directory / f"{str(task.host)}.txt")
-        task.run(task=files.write_file, filename=str(file_name), content=stockpile_info["device_config"])
+        task.run(
+            task=write_config_file,
+            name="write_file",
+            stockpile_directory=stockpile_directory,
+            content=stockpile_info["device_config"],
+        )
     else:
         # If we've failed both backup attempts, log that.
         logger.error("Failed to backup %s via HTTPS or SSH", task.host)
@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 
 """
-Base stockpile results object
+Base stockpile results object, and the compact table we report a run's results from
 """
 
+from collections.abc import MutableMapping
+import csv
 from datetime import datetime
-from typing import Dict, Optional, Union
+import pathlib
+from typing import Any, Dict, IO, Iterator, List, Optional, Union
 
 
-class StockpileResults(Dict[str, Union[bool, int, str]]):
+class StockpileResults(MutableMapping):
 
     """
-    A Dict like object to hold the results of a backup attempt
+    A Dict like object to hold the results of a backup attempt.  Its known keys are kept in slots rather than a dict
+    of its own, so the results of a large run don't take a dict (and its hash table) per host.
 
     Example:
     {
@@ -25,12 +29,38 @@ class StockpileResults(Dict[str, Union[bool, int, str]]):
         "save_config_successful": True,
         "http_used": True,
         "ssh_used": False,
+        "api_used": None,
         "last_backup_attempt": 2020-01-25T13:25:53.540015,
         "last_successful_backup": None,
+        "skip_reason": None,
+        "change_marker": None,
         "device_config": None,
     }
     """
 
+    # The keys reported on for each backup attempt, i.e. in the results CSV (everything but the config itself)
+    report_fields = [
+        "ip",
+        "hostname",
+        "http_management",
+        "http_mgmt_port",
+        "http_port_check_ok",
+        "ssh_mgmt_port",
+        "ssh_port_check_ok",
+        "backup_successful",
+        "save_config_successful",
+        "http_used",
+        "ssh_used",
+        "api_used",
+        "last_backup_attempt",
+        "last_successful_backup",
+        "skip_reason",
+    ]
+
+    # Every key we keep a slot for, any others (i.e. `authorization_failed`) are kept in `extras`
+    fields = report_fields + ["change_marker", "device_config"]
+    __slots__ = tuple(["name", "extras"] + fields)
+
     def __init__(
         self,
         name: str,
@@ -45,8 +75,11 @@ class StockpileResults(Dict[str, Union[bool, int, str]]):
         save_config_successful: bool = False,
         http_used: bool = False,
         ssh_used: bool = False,
-        last_backup_attempt: str = datetime.utcnow().isoformat(),
+        api_used: Optional[str] = None,
+        last_backup_attempt: Optional[str] = None,
         last_successful_backup: Optional[datetime] = None,
+        skip_reason: Optional[str] = None,
+        change_marker: Optional[str] = None,
         device_config: Optional[str] = None,
         **kwargs: Union[bool, int, str],
     ) -> None:
@@ -64,17 +97,229 @@ class StockpileResults(Dict[str, Union[bool, int, str]]):
         :param save_config_successful: Was saving the config successful?
         :param http_used: Did we use HTTP in this backup attempt?
         :param ssh_used: Did we use SSH in this backup attempt?
-        :param last_backup_attempt: When did we attempt this backup?
+        :param api_used: The native API we used in this backup attempt, if any (`nxapi`, `eapi`, or `netconf`)
+        :param last_backup_attempt: When did we attempt this backup? (Default now, in UTC)
         :param last_successful_backup: When was the last successful backup?
+        :param skip_reason: Why the full backup was skipped, if it was (i.e. `unchanged`, the config hasn't changed
+            since our last backup, which still counts as a successful backup)
+        :param change_marker: The device's change marker (i.e. its config checksum) if we checked it
         :param device_config: The device configuration we gathered (if any)
         :param **kwargs: Any other outstanding items you need in this results Dict
         """
         self.name = name
+        self.extras: Optional[Dict[str, Union[bool, int, str]]] = dict(kwargs) if kwargs else None
+
+        self.ip = ip
+        self.hostname = hostname
+        self.http_management = http_management
+        self.http_mgmt_port = http_mgmt_port
+        self.http_port_check_ok = http_port_check_ok
+        self.ssh_mgmt_port = ssh_mgmt_port
+        self.ssh_port_check_ok = ssh_port_check_ok
+        self.backup_successful = backup_successful
+        self.save_config_successful = save_config_successful
+        self.http_used = http_used
+        self.ssh_used = ssh_used
+        self.api_used = api_used
+        self.last_backup_attempt = last_backup_attempt or datetime.utcnow().isoformat()
+        self.last_successful_backup = last_successful_backup
+        self.skip_reason = skip_reason
+        self.change_marker = change_marker
+        self.device_config = device_config
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _SLOTTED:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extras is not None and key in self.extras:
+            return self.extras[key]
+        raise KeyError(key)
 
-        # Pass on all of our arguments to the underlying dict creation
-        arguments = {k: v for (k, v) in locals().items() if k not in ["self", "__class__", "kwargs", "name"]}
-        arguments.update(**kwargs)
-        super().__init__(**arguments)
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in _SLOTTED:
+            setattr(self, key, value)
+        else:
+            if self.extras is None:
+                self.extras = {}
+            self.extras[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key in _SLOTTED:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extras is not None and key in self.extras:
+            del self.extras[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self.fields:
+            if hasattr(self, key):
+                yield key
+        if self.extras is not None:
+            yield from self.extras
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
 
     def __repr__(self) -> str:
-        return "{} ({}): {}".format(self.__class__.__name__, self.name, super().__repr__())
+        return "{} ({}): {}".format(self.__class__.__name__, self.name, dict(self))
+
+
+_SLOTTED = frozenset(StockpileResults.fields)
+
+
+class StockpileResultsTable:
+    """
+    The results of a run, one row per host, kept as a column per reported field (flags packed a byte each) rather
+    than an object per host, and exported in bulk to a CSV report.
+
+    Rows can be read (and changed) by host name, i.e. `table["rtr1"]["save_config_successful"] = True`.  With
+    `stream_csv()` each row is also written to a CSV report as it's appended, rows changed after that aren't rewritten.
+    """
+
+    # Fields kept as a bytearray of flags, rather than a list of values
+    flag_fields = frozenset(
+        [
+            "http_management",
+            "http_port_check_ok",
+            "ssh_port_check_ok",
+            "backup_successful",
+            "save_config_successful",
+            "http_used",
+            "ssh_used",
+        ]
+    )
+
+    def __init__(self, fields: Optional[List[str]] = None) -> None:
+        """
+        Initialize an empty table
+        :param fields: The fields to keep of each host's StockpileResults, defaults to the reported fields
+        """
+
+        self.fields = list(fields or StockpileResults.report_fields)
+        self.names: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self.columns: Dict[str, Union[bytearray, List[Any]]] = {
+            field: bytearray() if field in self.flag_fields else [] for field in self.fields
+        }
+        self.csv_file: Optional[IO[str]] = None
+        self.csv_writer: Any = None
+
+    def append(self, host_name: str, stockpile_info: StockpileResults) -> None:
+        """
+        Add a host's results to the table
+        :param host_name:
+        :param stockpile_info: The host's StockpileResults
+        :return:
+        """
+
+        self.positions[host_name] = len(self.names)
+        self.names.append(host_name)
+        for field, column in self.columns.items():
+            value = stockpile_info.get(field)
+            if field in self.flag_fields:
+                value = 1 if value else 0
+            column.append(value)
+        if self.csv_writer is not None:
+            row = self[host_name]
+            self.csv_writer.writerow([row[field] for field in self.fields])
+            self.csv_file.flush()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, host_name: str) -> bool:
+        return host_name in self.positions
+
+    def __getitem__(self, host_name: str) -> "StockpileResultsRow":
+        return StockpileResultsRow(table=self, position=self.positions[host_name])
+
+    def column(self, field: str) -> Iterator[Any]:
+        """
+        The values of a field, for every row in order
+        :param field:
+        :return:
+        """
+
+        if field in self.flag_fields:
+            return map(bool, self.columns[field])
+        return iter(self.columns[field])
+
+    def rows(self) -> Iterator[tuple]:
+        """
+        Every row, in order, as a tuple of our fields' values
+        :return:
+        """
+
+        return zip(*(self.column(field) for field in self.fields))
+
+    def to_csv(self, path: pathlib.Path) -> None:
+        """
+        Write the table out as a CSV report, with a header row of our fields
+        :param path: The file to write
+        :return:
+        """
+
+        with path.open(mode="w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.fields)
+            writer.writerows(self.rows())
+
+    def stream_csv(self, path: pathlib.Path) -> None:
+        """
+        Write the table out as a CSV report (see to_csv), and keep it open to write each row appended from now on as
+        it's appended, so an interrupted run still leaves a report of every host it completed
+        :param path: The file to write
+        :return:
+        """
+
+        self.close_csv()
+        self.csv_file = path.open(mode="w", newline="")
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(self.fields)
+        self.csv_writer.writerows(self.rows())
+        self.csv_file.flush()
+
+    def close_csv(self) -> None:
+        """
+        Stop streaming rows to our CSV report, if we are
+        :return:
+        """
+
+        if self.csv_file is not None:
+            self.csv_file.close()
+        self.csv_file = None
+        self.csv_writer = None
+
+
+class StockpileResultsRow(MutableMapping):
+    """
+    A Dict like view of one row of a StockpileResultsTable
+    """
+
+    __slots__ = ("table", "position")
+
+    def __init__(self, table: StockpileResultsTable, position: int) -> None:
+        self.table = table
+        self.position = position
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.table.columns[key][self.position]
+        return bool(value) if key in self.table.flag_fields else value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.table.columns[key][self.position] = (1 if value else 0) if key in self.table.flag_fields else value
+
+    def __delitem__(self, key: str) -> None:
+        raise TypeError("Fields can't be removed from a row of a StockpileResultsTable")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.table.fields)
+
+    def __len__(self) -> int:
+        return len(self.table.fields)
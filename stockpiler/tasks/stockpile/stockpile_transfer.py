@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+"""
+Backup tasks copying a device's config off it as a file, rather than reading it through an interactive shell.
+
+Streaming a multi-megabyte `show run` through a shell is slow, and prone to being truncated.  Hosts whose
+`stockpile_transfer` is `running-config` or `startup-config` (set for every host by `--transfer`, or for a platform by
+registering `stockpile_cisco_transfer` in StockpileMap) instead have that config copied to a temporary file on their
+file system, which is then fetched over SCP (or SFTP, with `stockpile_transfer_protocol`) straight into a temporary
+file in our stockpile, and installed as their config without ever being held in memory.  If the copy or transfer
+fails, the host is backed up through its shell instead.
+"""
+
+from logging import getLogger
+import os
+import pathlib
+from typing import Any, Optional, Tuple
+
+
+from nornir.core.exceptions import NornirSubTaskError
+from nornir.core.task import Result, Task
+from nornir.plugins.tasks.networking import netmiko_save_config, netmiko_send_command
+
+
+from stockpiler.runners.save_config import save_config_mode
+from stockpiler.tasks.stockpile.config_files import config_path, config_temp_file, install_config
+from stockpiler.tasks.stockpile.proxy_pool import Proxies
+from stockpiler.tasks.stockpile.stockpile_cisco import (
+    authorization_failed,
+    change_marker_command,
+    netmiko_connect,
+    port_check,
+    stockpile_cisco_generic,
+    unchanged_since_last_backup,
+)
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+logger = getLogger("stockpiler")
+
+TRANSFER_SOURCES = ("running-config", "startup-config")
+TRANSFER_PROTOCOLS = ("scp", "sftp")
+
+# The name of the temporary file a config is copied to on the device
+TRANSFER_FILE_NAME = "stockpiler-backup.cfg"
+
+# Netmiko platform to the file system the temporary file is copied to, unless a host sets `stockpile_file_system`
+DEFAULT_FILE_SYSTEMS = {"cisco_asa": "disk0:", "cisco_nxos": "bootflash:"}
+DEFAULT_FILE_SYSTEM = "flash:"
+
+# Netmiko platform to the commands copying a config to, and deleting, the temporary file without prompting (where the
+# platform allows it, otherwise its prompts are answered)
+COPY_COMMANDS = {"cisco_asa": "copy /noconfirm {source} {path}"}
+DELETE_COMMANDS = {"cisco_asa": "delete /noconfirm {path}", "cisco_nxos": "delete {path} no-prompt"}
+DEFAULT_COPY_COMMAND = "copy {source} {path}"
+DEFAULT_DELETE_COMMAND = "delete /force {path}"
+
+# Seconds to wait on connecting to a host, and on its SCP channel, unless its Netmiko `conn_timeout` and `timeout`
+# extras say otherwise (these are Netmiko's defaults)
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_TRANSFER_TIMEOUT = 100.0
+
+# Failed copies and deletes, in the output of each of our platforms
+COPY_ERRORS = ("%error", "% invalid", "error:", "permission denied", "not enough space")
+
+
+def transfer_source(task: Task) -> Optional[str]:
+    """
+    Which config a host should be backed up by copying off it as a file, if any
+    :param task:
+    :return: `running-config` or `startup-config`, or None if it should be backed up through its shell
+    """
+
+    source = task.host.get("stockpile_transfer", None) or "running-config"
+    if source == "off":
+        return None
+    if source not in TRANSFER_SOURCES:
+        logger.warning("Unknown stockpile_transfer %s for %s, backing it up through its shell", source, task.host)
+        return None
+    return source
+
+
+def transfer_protocol(task: Task) -> str:
+    """
+    Which protocol a host's config file is fetched over
+    :param task:
+    :return: `scp` or `sftp`
+    """
+
+    protocol = task.host.get("stockpile_transfer_protocol", None) or "scp"
+    if protocol not in TRANSFER_PROTOCOLS:
+        logger.warning("Unknown stockpile_transfer_protocol %s for %s, using SCP", protocol, task.host)
+        protocol = "scp"
+    return protocol
+
+
+def remote_path(task: Task) -> str:
+    """
+    Where a host's config is copied to on its file system
+    :param task:
+    :return: i.e. `flash:stockpiler-backup.cfg`
+    """
+
+    file_system = task.host.get("stockpile_file_system", None) or DEFAULT_FILE_SYSTEMS.get(
+        task.host.platform, DEFAULT_FILE_SYSTEM
+    )
+    return f"{file_system}{TRANSFER_FILE_NAME}"
+
+
+def send_answering_prompts(task: Task, command: str) -> Result:
+    """
+    Send a command that may prompt us (i.e. `Destination filename [stockpiler-backup.cfg]?`), accepting the default
+    answer to each of its prompts
+    :param task:
+    :param command:
+    :return: A Nornir Result, with the command's output (and that of each answer) as its result
+    """
+
+    connection = task.host.get_connection("netmiko", task.nornir.config)
+    output = connection.send_command_timing(command)
+    answers = 0
+    while answers < 3 and output.rstrip().endswith(("?", "]")):
+        output += connection.send_command_timing("y" if "(y/n)" in output.lower() else "\n")
+        answers += 1
+    return Result(host=task.host, result=output, failed=any(e in output.lower() for e in COPY_ERRORS))
+
+
+def transfer_file(task: Task, path: str, stockpile_directory: pathlib.Path, protocol: str = "scp") -> Result:
+    """
+    Fetch a file from a host, streaming it straight into a temporary file in our stockpile and installing that as the
+    host's config.  It's fetched over a new SSH connection (see ssh_client), as not every device allows a second
+    channel on the first.
+    :param task:
+    :param path: The file on the host, i.e. `flash:stockpiler-backup.cfg`
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param protocol: `scp` or `sftp`
+    :return: A Nornir Result whose result is the config's blob hash, and changed if it was written
+    """
+
+    client, timeout = ssh_client(task=task)
+    try:
+        blob, written = fetch_config(
+            task=task,
+            client=client,
+            path=path,
+            stockpile_directory=stockpile_directory,
+            protocol=protocol,
+            timeout=timeout,
+        )
+    finally:
+        client.close()
+    return Result(host=task.host, result=blob, changed=written)
+
+
+def ssh_client(task: Task) -> Tuple[Any, float]:
+    """
+    Open a paramiko SSH connection to a host with its Netmiko connection options (through the proxy it leased, if SSH
+    goes through our proxies), authenticating the way Netmiko does by default: with its password, and only with keys
+    if its `use_keys` (and `key_file`, `allow_agent`) extras ask for them.
+    :param task:
+    :return: A Tuple of the connected paramiko SSHClient, and the timeout (in seconds) to use on its channels
+    """
+
+    import paramiko
+
+    parameters = task.host.get_connection_parameters("netmiko")
+    extras = parameters.extras or {}
+    port = parameters.port or 22
+    timeout = float(extras.get("timeout", DEFAULT_TRANSFER_TIMEOUT))
+    sock = Proxies.open_socket(host=task.host, port=port) if Proxies.ssh else None
+
+    client = paramiko.SSHClient()
+    # Devices' host keys aren't checked, as with Netmiko's default of `ssh_strict=False`
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        hostname=parameters.hostname,
+        port=port,
+        username=parameters.username,
+        password=parameters.password,
+        key_filename=extras.get("key_file"),
+        look_for_keys=bool(extras.get("use_keys", False)),
+        allow_agent=bool(extras.get("allow_agent", False)),
+        timeout=float(extras.get("conn_timeout", DEFAULT_CONNECT_TIMEOUT)),
+        sock=sock,
+    )
+    return client, timeout
+
+
+def fetch_file(client: Any, path: str, temp_path: str, protocol: str = "scp", timeout: float = 10) -> None:
+    """
+    Fetch a file from a host over SCP or SFTP
+    :param client: A connected paramiko SSHClient
+    :param path: The file on the host, i.e. `flash:stockpiler-backup.cfg`
+    :param temp_path: Where to write it locally
+    :param protocol: `scp` or `sftp`
+    :param timeout: Seconds to wait on the SCP channel
+    :return:
+    """
+
+    if protocol == "sftp":
+        with client.open_sftp() as sftp:
+            sftp.get(path, temp_path)
+        return
+
+    from scp import SCPClient
+
+    with SCPClient(client.get_transport(), socket_timeout=timeout) as scp:
+        scp.get(path, temp_path)
+
+
+def fetch_config(
+    task: Task,
+    client: Any,
+    path: str,
+    stockpile_directory: pathlib.Path,
+    protocol: str = "scp",
+    timeout: float = 10,
+) -> Tuple[str, bool]:
+    """
+    Fetch a host's config file into a temporary file beside its config in our stockpile and install that as its
+    config, removing the temporary file if either fails
+    :param task:
+    :param client: A connected paramiko SSHClient
+    :param path: The file on the host, i.e. `flash:stockpiler-backup.cfg`
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param protocol: `scp` or `sftp`
+    :param timeout: Seconds to wait on the SCP channel
+    :return: The config's blob hash, and whether it was written
+    """
+
+    relative_path = config_path(host=task.host)
+    temp_path = config_temp_file(stockpile_directory=stockpile_directory, relative_path=relative_path)
+    try:
+        fetch_file(client=client, path=path, temp_path=temp_path, protocol=protocol, timeout=timeout)
+        return install_config(stockpile_directory=stockpile_directory, relative_path=relative_path, temp_path=temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def copy_and_transfer(
+    task: Task,
+    source: str,
+    stockpile_info: StockpileResults,
+    stockpile_directory: pathlib.Path,
+    protocol: str = "scp",
+) -> Any:
+    """
+    Copy a host's config to a file on it, fetch that into our stockpile, and delete the file again whether or not we
+    fetched it
+    :param task:
+    :param source: `running-config` or `startup-config`
+    :param stockpile_info: The host's StockpileResults, noting if the copy wasn't authorized
+    :param stockpile_directory: An instantiated pathlib.Path object for our stockpile directory
+    :param protocol: `scp` or `sftp`
+    :return: Why the copy or transfer failed, or None
+    """
+
+    path = remote_path(task=task)
+    copy_command = COPY_COMMANDS.get(task.host.platform, DEFAULT_COPY_COMMAND).format(source=source, path=path)
+    transfer_error = None
+    try:
+        copy_results = task.run(task=send_answering_prompts, name="copy_config", command=copy_command)
+        if not authorization_failed(stockpile_info, copy_results[0].result):
+            task.run(
+                task=transfer_file, name="backup", path=path, stockpile_directory=stockpile_directory, protocol=protocol
+            )
+    except NornirSubTaskError as e:
+        transfer_error = e.result[0].exception or e.result[0].result
+
+    # Don't leave our copy behind, whether or not we fetched it
+    delete_command = DELETE_COMMANDS.get(task.host.platform, DEFAULT_DELETE_COMMAND).format(path=path)
+    try:
+        task.run(task=send_answering_prompts, name="delete_file", command=delete_command)
+    except NornirSubTaskError:
+        logger.warning("Unable to delete %s from %s", path, task.host)
+        task.results[:] = [r for r in task.results if not r.failed]
+    return transfer_error
+
+
+def stockpile_cisco_transfer(
+    task: Task,
+    stockpile_directory: pathlib.Path,
+    backup_command: str = "more system:running-config",
+    proxies: dict = None,
+) -> Result:
+    """
+    Copy the running (or startup) config of a Cisco device to a file on it, and fetch that file into our stockpile
+    over SCP or SFTP (overwriting any existing file by that name).  Falls back to its shell, as
+    stockpile_cisco_generic, if the host isn't backed up by transfer or its copy or transfer fails.
+    :param task:
+    :param stockpile_directory: An instantiated pathlib.Path object for the directory where we're going to write this
+    :param backup_command: What command to execute for backup through its shell, defaults to
+        `more system:running-config`
+    :param proxies: Optional Dict of SOCKS proxies for HTTP connectivity, unused as we only back up via SSH here
+    :return: Return a Nornir Result object.  The Result.result attribute will contain a
+        stockpiler.tasks.device_backup.StockpileResults object which is a dict-like object containing information on if
+        backup was successful and what method was used, etc.  Its device_config is left empty, as the config was
+        written straight to our stockpile.
+    """
+
+    shell_kwargs = {"stockpile_directory": stockpile_directory, "backup_command": backup_command, "proxies": proxies}
+    source = transfer_source(task=task)
+    if source is None:
+        return stockpile_cisco_generic(task, **shell_kwargs)
+    protocol = transfer_protocol(task=task)
+
+    # Dict-like object of our eventual return info
+    stockpile_info = StockpileResults(
+        name=f"{task.host}_backup",
+        ip=task.host.hostname,
+        hostname=task.host.get("device_name", task.host),
+        ssh_mgmt_port=task.host.get("port", 22) or 22,  # Need `or` statement as we're getting None from inventory
+    )
+
+    # Validate SSH TCP port:
+    stockpile_info["ssh_port_check_ok"] = port_check(
+        task=task, check_name="ssh_port_check_ok", port=stockpile_info["ssh_mgmt_port"]
+    )
+
+    # If we can't SSH port, what are we doing here?  GET TO THE CHOPPA!
+    if not stockpile_info["ssh_port_check_ok"]:
+        logger.error(
+            "Unable to reach SSH (%s) management port on %s", stockpile_info["ssh_mgmt_port"], task.host,
+        )
+        return Result(
+            host=task.host, result=stockpile_info, changed=False, failed=not stockpile_info["backup_successful"]
+        )
+
+    logger.debug("Attempting to backup %s:%s via %s", task.host, stockpile_info["ssh_mgmt_port"], protocol.upper())
+    task.run(task=netmiko_connect, name="connect")
+
+    # Skip the full backup if the device's change marker shows nothing has changed since our last backup
+    marker_command = change_marker_command(task=task)
+    if marker_command is not None:
+        marker_results = task.run(task=netmiko_send_command, name="change_marker", command_string=marker_command)
+        if unchanged_since_last_backup(
+            task=task,
+            stockpile_info=stockpile_info,
+            stockpile_directory=stockpile_directory,
+            marker_output=marker_results[0].result,
+        ):
+            stockpile_info["ssh_used"] = True
+            return Result(host=task.host, result=stockpile_info, changed=False, failed=False)
+
+    transfer_error = copy_and_transfer(
+        task=task,
+        source=source,
+        stockpile_info=stockpile_info,
+        stockpile_directory=stockpile_directory,
+        protocol=protocol,
+    )
+    if stockpile_info.get("authorization_failed"):
+        logger.error("Failed to backup %s, copying its %s wasn't authorized", task.host, source)
+        return Result(host=task.host, result=stockpile_info, changed=False, failed=True)
+    if transfer_error is not None:
+        logger.warning(
+            "Unable to transfer the %s of %s via %s (%s), falling back to its shell",
+            source,
+            task.host,
+            protocol.upper(),
+            transfer_error,
+        )
+        del task.results[:]
+        return stockpile_cisco_generic(task, **shell_kwargs)
+
+    stockpile_info["backup_successful"] = True
+    stockpile_info["ssh_used"] = True
+    logger.debug("Successfully backed up %s", task.host)
+
+    # Save the config on the box (unless it's left to the deferred save config phase):
+    if save_config_mode(host=task.host) == "inline":
+        save_config_results = task.run(task=netmiko_save_config, name="save_config")
+        if not save_config_results[0].failed and not authorization_failed(
+            stockpile_info, save_config_results[0].result
+        ):
+            stockpile_info["save_config_successful"] = True
+            logger.debug("Successfully saved configuration on %s", task.host)
+
+    return Result(host=task.host, result=stockpile_info, changed=False, failed=not stockpile_info["backup_successful"])
@@ -0,0 +1,62 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+
+from stockpiler.__main__ import arg_parsing
+
+
+class TestArgParsing(unittest.TestCase):
+    def test_repeated_proxies(self):
+        """
+        Tests that each `--proxy` adds a proxy to our pool, without swallowing the action after it
+        :return:
+        """
+
+        argv = ["stockpiler", "-p", "jump1:1080@dc1", "--proxy", "jump2:1080", "serve"]
+        with mock.patch("sys.argv", argv):
+            args = arg_parsing()
+
+        self.assertEqual(args.proxy, ["jump1:1080@dc1", "jump2:1080"])
+        self.assertEqual(args.action, "serve")
+
+    def test_repeated_filters(self):
+        """
+        Tests that each device filter is repeated for several values, without swallowing the action after it
+        :return:
+        """
+
+        argv = ["stockpiler", "-a", "10.0.0.0/24", "-a", "rtr1", "--group", "core", "--site", "dc1", "--site", "dc2"]
+        with mock.patch("sys.argv", argv + ["--platform", "cisco_ios", "serve"]):
+            args = arg_parsing()
+
+        self.assertEqual(args.addresses, ["10.0.0.0/24", "rtr1"])
+        self.assertEqual(args.group, ["core"])
+        self.assertEqual(args.platform, ["cisco_ios"])
+        self.assertEqual(args.site, ["dc1", "dc2"])
+        self.assertEqual(args.action, "serve")
+
+    def test_repeated_devices(self):
+        """
+        Tests that `--device` is repeated for each device whose history to show, without swallowing the action after it
+        :return:
+        """
+
+        with mock.patch("sys.argv", ["stockpiler", "--device", "rtr1", "--device", "rtr2", "history"]):
+            args = arg_parsing()
+
+        self.assertEqual(args.device, ["rtr1", "rtr2"])
+        self.assertEqual(args.action, "history")
+
+    def test_bad_network(self):
+        """
+        Tests that a CIDR network we can't parse is reported as a usage error, not a traceback
+        :return:
+        """
+
+        stderr = io.StringIO()
+        with mock.patch("sys.argv", ["stockpiler", "-a", "10.0.0.300/24"]), contextlib.redirect_stderr(stderr):
+            with self.assertRaises(SystemExit):
+                arg_parsing()
+        self.assertIn("10.0.0.300/24", stderr.getvalue())
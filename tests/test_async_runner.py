@@ -0,0 +1,173 @@
+import asyncio
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+
+from nornir import InitNornir
+import yaml
+
+
+from stockpiler.runners.async_runner import AsyncStockpileRunner
+from stockpiler.tasks.stockpile.config_files import config_path
+
+
+CONFIG = "hostname rtr1\ninterface Loopback0\n"
+
+
+class FakeProcess:
+    """
+    Stand in for an interactive asyncssh process on a Cisco-like device, answering each command written to its stdin
+    """
+
+    def __init__(self, backup_command: str) -> None:
+        self.backup_command = backup_command
+        self.pending = []
+        self.stdin = self
+        self.stdout = self
+        self.commands = []
+
+    def write(self, data: str) -> None:
+        command = data.strip()
+        self.commands.append(command)
+        output = CONFIG.replace("\n", "\r\n") if command == self.backup_command else ""
+        self.pending.append(f"{command}\r\n{output}rtr1#")
+
+    async def read(self, size: int) -> str:
+        return self.pending.pop(0) if self.pending else ""
+
+    def close(self) -> None:
+        pass
+
+
+class FakeResponse:
+    """
+    Stand in for an aiohttp response, usable as an async context manager
+    """
+
+    def __init__(self, status: int, text: str) -> None:
+        self.status = status
+        self._text = text
+
+    async def text(self) -> str:
+        return self._text
+
+    async def __aenter__(self) -> "FakeResponse":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+
+class TestAsyncRunner(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Create a temporary inventory and stockpile directory for each test
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.stockpile_directory = pathlib.Path(self.temp_dir.name)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def runner(self, platform: str = "cisco_ios", data: dict = None) -> AsyncStockpileRunner:
+        """
+        An AsyncStockpileRunner over a single host, whose port checks were already answered by a reachability sweep
+        :param platform:
+        :param data: Inventory data for the host
+        :return:
+        """
+
+        hosts = {
+            "rtr1": {
+                "hostname": "192.0.2.1",
+                "platform": platform,
+                "username": "stockpiler",
+                "password": "stockpiler",
+                "data": {"ssh_port_check_ok": True, **(data or {})},
+            }
+        }
+        (self.stockpile_directory / "hosts.yml").write_text(yaml.safe_dump(hosts))
+        norns = InitNornir(
+            inventory={
+                "plugin": "nornir.plugins.inventory.simple.SimpleInventory",
+                "options": {"host_file": f"{self.stockpile_directory}/hosts.yml", "group_file": ""},
+            },
+            logging={"enabled": False},
+        )
+        return AsyncStockpileRunner(norns=norns, connect_timeout=1, command_timeout=1)
+
+    def test_cli_backup(self):
+        """
+        Tests that a config backed up over SSH is written to our stockpile, and saved on the device
+        :return:
+        """
+
+        runner = self.runner()
+        process = FakeProcess(backup_command="show running-config")
+        connection = mock.Mock()
+        connection.create_process = mock.AsyncMock(return_value=process)
+
+        with mock.patch("asyncssh.connect", mock.AsyncMock(return_value=connection)):
+            results = runner.run(stockpile_directory=self.stockpile_directory, backup_command="show running-config")
+
+        stockpile_info = results["rtr1"][0].result
+        self.assertFalse(results["rtr1"].failed)
+        self.assertTrue(stockpile_info["backup_successful"])
+        self.assertTrue(stockpile_info["save_config_successful"])
+        self.assertTrue(stockpile_info["ssh_used"])
+        self.assertEqual(stockpile_info["device_config"], CONFIG.rstrip("\n"))
+        self.assertEqual(process.commands, ["", "terminal length 0", "show running-config", "write mem"])
+        host = runner.norns.inventory.hosts["rtr1"]
+        self.assertEqual((self.stockpile_directory / config_path(host=host)).read_text(), CONFIG.rstrip("\n"))
+        connection.close.assert_called_once()
+
+    def test_cli_backup_connect_failed(self):
+        """
+        Tests that a host we can't connect to over SSH is reported as a failed StockpileResults, not an exception
+        :return:
+        """
+
+        runner = self.runner()
+        for error in (OSError("Connection refused"), asyncio.TimeoutError()):
+            with self.subTest(error=type(error).__name__):
+                with mock.patch("asyncssh.connect", mock.AsyncMock(side_effect=error)):
+                    results = runner.run(stockpile_directory=self.stockpile_directory)
+
+                self.assertTrue(results["rtr1"].failed)
+                stockpile_info = results["rtr1"][0].result
+                self.assertIsNone(results["rtr1"][0].exception)
+                self.assertTrue(stockpile_info["ssh_port_check_ok"])
+                self.assertFalse(stockpile_info["backup_successful"])
+                self.assertFalse(stockpile_info["ssh_used"])
+
+    def test_asa_http_backup(self):
+        """
+        Tests that an ASA is backed up over HTTPS, and that one whose command isn't authorized falls back to SSH
+        :return:
+        """
+
+        for backup_text, http_used in ((CONFIG, True), ("Command authorization failed", False)):
+            with self.subTest(http_used=http_used):
+                runner = self.runner(
+                    platform="cisco_asa",
+                    data={"http_management": True, "http_port_check_ok": True, "ssh_port_check_ok": False},
+                )
+                host = runner.norns.inventory.hosts["rtr1"]
+                http_session = mock.Mock()
+                http_session.get = mock.Mock(side_effect=[FakeResponse(200, backup_text), FakeResponse(200, "")])
+
+                stockpile_info = asyncio.run(
+                    runner.stockpile_cisco_asa(
+                        host=host, stockpile_directory=self.stockpile_directory, http_session=http_session
+                    )
+                )
+
+                self.assertIs(bool(stockpile_info["http_used"]), http_used)
+                self.assertIs(stockpile_info["backup_successful"], http_used)
+                self.assertTrue(stockpile_info["save_config_successful"])
+                backup_url = http_session.get.call_args_list[0][0][0]
+                self.assertEqual(backup_url, "https://192.0.2.1:8443/admin/exec/more+system%3Arunning-config")
@@ -0,0 +1,40 @@
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+
+from stockpiler.tasks.stockpile.config_files import sync_configs
+
+
+class TestConfigFiles(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.stockpile_directory = pathlib.Path(self.temp_dir.name)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "Requires /proc to tell which file was fsync'd")
+    def test_sync_configs(self):
+        """
+        Tests that only the configs given, and the directories holding them, are fsync'd
+        :return:
+        """
+
+        (self.stockpile_directory / "dc1").mkdir()
+        (self.stockpile_directory / "dc1" / "rtr1.txt").write_text("hostname rtr1\n")
+        (self.stockpile_directory / "rtr2.txt").write_text("hostname rtr2\n")
+        synced = []
+        real_fsync = os.fsync
+
+        def fsync(fd: int) -> None:
+            synced.append(os.readlink(f"/proc/self/fd/{fd}"))
+            real_fsync(fd)
+
+        with mock.patch("os.fsync", fsync):
+            sync_configs(stockpile_directory=self.stockpile_directory, relative_paths=["dc1/rtr1.txt", "dc1/gone.txt"])
+
+        directory = self.stockpile_directory.resolve()
+        self.assertEqual(synced, [str(directory / "dc1" / "rtr1.txt"), str(directory / "dc1")])
@@ -0,0 +1,85 @@
+import unittest
+
+
+from nornir.core.inventory import Host
+
+
+from stockpiler.runners.daemon import ConnectionPool
+from stockpiler.tasks.stockpile.http_sessions import HTTPSessions
+
+
+class FakeConnection:
+    """
+    Stand in for a Nornir Netmiko connection plugin
+    """
+
+    def __init__(self, alive: bool = True) -> None:
+        self.connection = self
+        self.alive = alive
+        self.closed = False
+
+    def is_alive(self) -> bool:
+        return self.alive
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self) -> None:
+        self.hosts = {}
+        for i in range(4):
+            self.hosts[f"rtr{i}"] = Host(name=f"rtr{i}")
+            self.hosts[f"rtr{i}"].connections["netmiko"] = FakeConnection()
+
+    def test_checkin_evicts_least_recently_used(self):
+        """
+        Tests that only warm hosts keep their connections, and the least recently used are evicted beyond our size
+        :return:
+        """
+
+        pool = ConnectionPool(size=2)
+        connections = {name: host.connections["netmiko"] for (name, host) in self.hosts.items()}
+        pool.checkin(hosts=[self.hosts["rtr0"], self.hosts["rtr1"]], warm=["rtr0", "rtr1", "rtr2"])
+        pool.checkin(hosts=[self.hosts["rtr0"]], warm=["rtr0", "rtr1", "rtr2"])
+        pool.checkin(hosts=[self.hosts["rtr2"], self.hosts["rtr3"]], warm=["rtr0", "rtr1", "rtr2"])
+
+        self.assertEqual(list(pool.hosts), ["rtr0", "rtr2"])
+        for name, closed in {"rtr0": False, "rtr1": True, "rtr2": False, "rtr3": True}.items():
+            with self.subTest(host=name):
+                self.assertEqual(connections[name].closed, closed)
+                self.assertEqual("netmiko" in self.hosts[name].connections, not closed)
+
+    def test_prune_dead_connections(self):
+        """
+        Tests that connections which have dropped are removed from the pool
+        :return:
+        """
+
+        pool = ConnectionPool(size=10)
+        pool.checkin(hosts=self.hosts.values(), warm=self.hosts.keys())
+        self.hosts["rtr1"].connections["netmiko"].alive = False
+        pool.prune()
+
+        self.assertEqual(list(pool.hosts), ["rtr0", "rtr2", "rtr3"])
+        self.assertNotIn("netmiko", self.hosts["rtr1"].connections)
+
+    def test_https_sessions(self):
+        """
+        Tests that hosts managed over HTTPS keep their session while warm, and it is dropped once evicted
+        :return:
+        """
+
+        asa = Host(name="asa0")
+        HTTPSessions.session(host_name="asa0", url="https://192.0.2.1:8443/admin/exec/show+version")
+        self.addCleanup(HTTPSessions.close_all)
+
+        pool = ConnectionPool(size=1)
+        pool.checkin(hosts=[asa], warm=["asa0"])
+        pool.prune()
+        self.assertEqual(list(pool.hosts), ["asa0"])
+        self.assertIn("asa0", HTTPSessions)
+
+        pool.checkin(hosts=[self.hosts["rtr0"]], warm=["asa0", "rtr0"])
+        self.assertEqual(list(pool.hosts), ["rtr0"])
+        self.assertNotIn("asa0", HTTPSessions)
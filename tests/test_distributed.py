@@ -0,0 +1,197 @@
+import multiprocessing
+import pathlib
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+
+from git import Repo
+from nornir import InitNornir
+from nornir.core.task import Result, Task
+import yaml
+
+
+from stockpiler.processors.process_stockpiles import ProcessStockpiles
+from stockpiler.runners import distributed
+from stockpiler.runners.distributed import DistributedCoordinator, DistributedWorker
+from stockpiler.runners.sharding import shard_hosts
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+AUTHKEY = b"stockpiler-test"
+
+
+def fake_stockpile(task: Task, stockpile_directory: pathlib.Path, proxies: dict = None) -> Result:
+    """
+    Stand in for a device backup, writing a config named after the host
+    """
+
+    config = f"hostname {task.host.name}\n"
+    pathlib.Path(stockpile_directory / f"{task.host.name}.txt").write_text(config)
+    stockpile_info = StockpileResults(
+        name=f"{task.host}_backup",
+        ip=task.host.hostname,
+        hostname=task.host.name,
+        backup_successful=True,
+        device_config=config,
+    )
+    return Result(host=task.host, result=stockpile_info)
+
+
+def run_worker(inventory_directory: str, address: tuple) -> None:
+    norns = initialize_nornir(inventory_directory=inventory_directory)
+    DistributedWorker(norns=norns, address=address, authkey=AUTHKEY, stockpile_task=fake_stockpile).run()
+
+
+def initialize_nornir(inventory_directory: str):
+    return InitNornir(
+        inventory={
+            "plugin": "nornir.plugins.inventory.simple.SimpleInventory",
+            "options": {"host_file": f"{inventory_directory}/hosts.yml", "group_file": ""},
+        },
+        logging={"enabled": False},
+    )
+
+
+class TestDistributed(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Create a temporary inventory and stockpile directory for each test
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.inventory_directory = pathlib.Path(self.temp_dir.name) / "inventory"
+        self.inventory_directory.mkdir()
+        self.stockpile_directory = pathlib.Path(self.temp_dir.name) / "stockpile"
+        hosts = {
+            f"rtr{i}": {"hostname": f"192.0.2.{i}", "platform": "cisco_ios", "data": {"site": f"site{i % 3}"}}
+            for i in range(10)
+        }
+        (self.inventory_directory / "hosts.yml").write_text(yaml.safe_dump(hosts))
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_shard_hosts(self):
+        """
+        Tests that sharding is deterministic and covers every host exactly once
+        :return:
+        """
+
+        norns = initialize_nornir(inventory_directory=str(self.inventory_directory))
+        for shard_by in ["hash", "group", "site"]:
+            with self.subTest(msg=f"Checking sharding by {shard_by}..."):
+                sharded = shard_hosts(norns=norns, shards=3, shard_by=shard_by)
+                self.assertEqual(sorted(h for s in sharded for h in s), sorted(norns.inventory.hosts))
+                self.assertEqual(sharded, shard_hosts(norns=norns, shards=3, shard_by=shard_by))
+
+        with self.subTest(msg="Checking hosts of a site are kept together..."):
+            site_shards = {}
+            for i, shard in enumerate(shard_hosts(norns=norns, shards=3, shard_by="site")):
+                for host_name in shard:
+                    site_shards.setdefault(norns.inventory.hosts[host_name]["site"], set()).add(i)
+            self.assertTrue(all(len(shards) == 1 for shards in site_shards.values()))
+
+    @unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "Requires forked worker processes")
+    def test_coordinator_merges_workers(self):
+        """
+        Tests a coordinator and several worker processes on this machine producing a single commit
+        :return:
+        """
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            address = s.getsockname()
+
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(target=run_worker, args=(str(self.inventory_directory), address)) for _ in range(3)
+        ]
+        for worker in workers:
+            worker.start()
+
+        norns = initialize_nornir(inventory_directory=str(self.inventory_directory))
+        coordinator = DistributedCoordinator(
+            norns=norns, address=address, authkey=AUTHKEY, processors=[ProcessStockpiles()], shards=3, timeout=60
+        )
+        result = coordinator.run(stockpile_directory=self.stockpile_directory)
+        for worker in workers:
+            worker.join(timeout=30)
+
+        self.assertFalse(result.failed)
+        repo = Repo(str(self.stockpile_directory))
+        self.assertEqual(len(list(repo.iter_commits())), 1)
+        committed = sorted(repo.head.commit.stats.files.keys())
+        self.assertEqual(committed, sorted([f"rtr{i}.txt" for i in range(10)] + ["results.csv"]))
+        self.assertEqual((self.stockpile_directory / "rtr3.txt").read_text(), "hostname rtr3\n")
+
+    def test_workers_sweep_their_shards(self):
+        """
+        Tests that with pre-flight, each worker sweeps only the hosts of its own shard, reporting those it found
+        unreachable to the coordinator once, and that each host's phase timings are taken on the worker
+        :return:
+        """
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            address = s.getsockname()
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(128)
+        self.addCleanup(listener.close)
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            closed_port = s.getsockname()[1]
+        hosts = {
+            f"rtr{i}": {
+                "hostname": "127.0.0.1",
+                "platform": "cisco_ios",
+                "port": closed_port if i in (3, 6) else listener.getsockname()[1],
+            }
+            for i in range(10)
+        }
+        (self.inventory_directory / "hosts.yml").write_text(yaml.safe_dump(hosts))
+
+        swept = []
+        real_sweep = distributed.reachability_sweep
+
+        def sweep(norns, **kwargs):
+            swept.append(sorted(norns.inventory.hosts))
+            return real_sweep(norns=norns, **kwargs)
+
+        workers = [
+            DistributedWorker(
+                norns=initialize_nornir(inventory_directory=str(self.inventory_directory)),
+                address=address,
+                authkey=AUTHKEY,
+                stockpile_task=fake_stockpile,
+                preflight=True,
+            )
+            for _ in range(2)
+        ]
+        norns = initialize_nornir(inventory_directory=str(self.inventory_directory))
+        processor = ProcessStockpiles()
+        coordinator = DistributedCoordinator(
+            norns=norns, address=address, authkey=AUTHKEY, processors=[processor], shards=2, timeout=60
+        )
+        with mock.patch("stockpiler.runners.distributed.reachability_sweep", sweep):
+            threads = [threading.Thread(target=worker.run) for worker in workers]
+            for thread in threads:
+                thread.start()
+            result = coordinator.run(stockpile_directory=self.stockpile_directory)
+            for thread in threads:
+                thread.join(timeout=30)
+
+        shards = shard_hosts(norns=norns, shards=2, shard_by="hash")
+        self.assertEqual(sorted(swept), sorted(sorted(shard) for shard in shards))
+        self.assertEqual(sorted(result.failed_hosts), ["rtr3", "rtr6"])
+        stockpile_info = result["rtr3"][0].result
+        self.assertIsInstance(stockpile_info, StockpileResults)
+        self.assertEqual(stockpile_info["ip"], "127.0.0.1")
+        self.assertFalse(stockpile_info["backup_successful"])
+        self.assertEqual(sorted(processor.metrics.host_phases), sorted(f"rtr{i}" for i in range(10) if i not in (3, 6)))
+        self.assertEqual(len(processor.metrics.samples["host"]), 8)
+        self.assertEqual(processor.metrics.outcomes["failed"], 2)
@@ -0,0 +1,73 @@
+import ssl
+import unittest
+from unittest import mock
+
+
+import requests
+
+
+from stockpiler.tasks.stockpile.http_sessions import HTTPSessionPool
+
+
+class FakeSSLSocket:
+    """
+    Stand in for the SSLSocket of a completed TLS 1.2 handshake
+    """
+
+    def __init__(self, session: object, session_reused: bool) -> None:
+        self.session = session
+        self.session_reused = session_reused
+
+    def version(self) -> str:
+        return "TLSv1.2"
+
+
+class TestHTTPSessions(unittest.TestCase):
+    def setUp(self) -> None:
+        self.pool = HTTPSessionPool()
+        self.addCleanup(self.pool.close_all)
+
+    def test_ssl_contexts(self):
+        """
+        Tests that HTTPS connections are pooled with one of our session resuming SSLContexts, which verifies
+        certificates only if the request does
+        :return:
+        """
+
+        url = "https://192.0.2.1:8443/admin/exec/show+version"
+        request = requests.Request("GET", url).prepare()
+        for verify, verify_mode in ((False, ssl.CERT_NONE), (True, ssl.CERT_REQUIRED)):
+            with self.subTest(verify=verify):
+                _, pool_kwargs = self.pool.adapter.build_connection_pool_key_attributes(request, verify)
+                self.assertIs(pool_kwargs["ssl_context"], self.pool.adapter.ssl_context(pool_kwargs["cert_reqs"]))
+                self.assertEqual(pool_kwargs["ssl_context"].verify_mode, verify_mode)
+
+        request = requests.Request("GET", "http://192.0.2.1/admin/exec/show+version").prepare()
+        _, pool_kwargs = self.pool.adapter.build_connection_pool_key_attributes(request, False)
+        self.assertNotIn("ssl_context", pool_kwargs)
+
+    def test_session_resumption(self):
+        """
+        Tests that a re-opened connection is offered the TLS session last negotiated with its server, and that a host's
+        sessions are forgotten along with it
+        :return:
+        """
+
+        url = "https://192.0.2.1:8443/admin/exec/show+version"
+        self.pool.session(host_name="asa0", url=url)
+        context = self.pool.adapter.ssl_context(cert_reqs="CERT_NONE")
+        session = object()
+        wrapped = [
+            FakeSSLSocket(session=session, session_reused=False),
+            FakeSSLSocket(session=session, session_reused=True),
+        ]
+        with mock.patch("ssl.SSLContext.wrap_socket", side_effect=wrapped) as wrap_socket:
+            context.wrap_socket(mock.sentinel.sock, server_hostname="192.0.2.1")
+            context.wrap_socket(mock.sentinel.sock, server_hostname="192.0.2.1")
+
+        self.assertIsNone(wrap_socket.call_args_list[0].kwargs["session"])
+        self.assertIs(wrap_socket.call_args_list[1].kwargs["session"], session)
+        self.assertEqual(context.sessions, {"192.0.2.1": session})
+
+        self.pool.close(host_name="asa0")
+        self.assertEqual(context.sessions, {})
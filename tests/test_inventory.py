@@ -0,0 +1,100 @@
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+
+from nornir import InitNornir
+import yaml
+
+
+from stockpiler.inventory.cached_inventory import CachedSimpleInventory
+from stockpiler.inventory.index import host_index
+
+
+class TestCachedInventory(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Create a temporary inventory for each test
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = pathlib.Path(self.temp_dir.name)
+        hosts = {
+            f"rtr{i}": {
+                "hostname": f"10.0.{i // 4}.{i}",
+                "platform": "cisco_asa" if i % 2 else "cisco_ios",
+                "groups": [f"region{i % 3}"],
+                "data": {"site": f"site{i % 4}"},
+            }
+            for i in range(12)
+        }
+        hosts["named"] = {"hostname": "router.example.com", "platform": "cisco_nxos", "groups": ["region0"]}
+        (self.directory / "hosts.yml").write_text(yaml.safe_dump(hosts))
+        groups = {"region0": {"groups": ["global"]}, "region1": {"groups": ["global"]}, "region2": {}, "global": {}}
+        (self.directory / "groups.yml").write_text(yaml.safe_dump(groups))
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def initialize_nornir(self):
+        return InitNornir(
+            inventory={
+                "plugin": "stockpiler.inventory.cached_inventory.CachedSimpleInventory",
+                "options": {
+                    "host_file": str(self.directory / "hosts.yml"),
+                    "group_file": str(self.directory / "groups.yml"),
+                    "cache_file": str(self.directory / "cache" / "inventory.pickle"),
+                },
+            },
+            logging={"enabled": False},
+        )
+
+    def test_cache(self):
+        """
+        Tests that the inventory is only parsed again when its content changes
+        :return:
+        """
+
+        with mock.patch.object(CachedSimpleInventory, "write_cache", wraps=CachedSimpleInventory.write_cache) as w:
+            norns = self.initialize_nornir()
+            self.assertEqual(w.call_count, 1)
+            self.assertEqual(len(norns.inventory.hosts), 13)
+
+            # A cache hit, with hosts and their groups restored
+            norns = self.initialize_nornir()
+            self.assertEqual(w.call_count, 1)
+            self.assertEqual(norns.inventory.hosts["rtr1"].platform, "cisco_asa")
+            self.assertTrue(norns.inventory.hosts["rtr0"].has_parent_group("global"))
+
+            # Touching the file only updates the cache's record of it
+            (self.directory / "hosts.yml").touch()
+            with mock.patch("nornir.plugins.inventory.simple.SimpleInventory.deserialize") as parse:
+                self.initialize_nornir()
+                parse.assert_not_called()
+
+            # Changing it parses it again
+            with (self.directory / "hosts.yml").open(mode="a") as f:
+                f.write("new:\n  hostname: 10.9.9.9\n")
+            norns = self.initialize_nornir()
+            self.assertIn("new", norns.inventory.hosts)
+
+    def test_index(self):
+        """
+        Tests that hosts are selected by address, network, group, platform, and site, matching every filter given
+        :return:
+        """
+
+        index = host_index(inventory=self.initialize_nornir().inventory)
+        selections = {
+            "address": ({"addresses": ["10.0.0.1", "router.example.com"]}, ["named", "rtr1"]),
+            "network": ({"addresses": ["10.0.2.0/24"]}, ["rtr10", "rtr11", "rtr8", "rtr9"]),
+            "inherited group": ({"groups": ["global"], "platforms": ["cisco_asa"]}, ["rtr1", "rtr3", "rtr7", "rtr9"]),
+            "site": ({"sites": ["site3"], "groups": ["region0"]}, ["rtr3"]),
+            "no match": ({"platforms": ["juniper_junos"]}, []),
+        }
+        for name, (filters, expected) in selections.items():
+            with self.subTest(selection=name):
+                self.assertEqual(sorted(index.select(**filters)), expected)
+        self.assertIsNone(index.select())
@@ -0,0 +1,206 @@
+import multiprocessing
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+
+from nornir import InitNornir
+from nornir.core.inventory import Host
+from nornir.core.task import AggregatedResult, MultiResult, Result, Task
+import yaml
+
+
+from stockpiler.history import HistoryIndex
+from stockpiler.processors.process_stockpiles import ProcessStockpiles
+from stockpiler.runners.multiprocess import MultiProcessStockpileRunner
+from stockpiler.tasks.stockpile.concurrency import Limits
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+def fake_backup(task: Task) -> Result:
+    """
+    Stand in for pulling a config off a device, taking long enough to be timed
+    """
+
+    time.sleep(0.05)
+    return Result(host=task.host, result=f"hostname {task.host.name}\n")
+
+
+def fake_stockpile(task: Task, stockpile_directory: pathlib.Path, proxies: dict = None) -> Result:
+    """
+    Stand in for a device backup, writing a config named after the host, unless the host is set up to fail
+    """
+
+    if task.host.get("fail") == "raise":
+        raise ValueError(f"Unable to backup {task.host.name}")
+    if task.host.get("fail") == "exit":
+        os._exit(1)
+
+    config = task.run(task=fake_backup, name="backup")[0].result
+    pathlib.Path(stockpile_directory / f"{task.host.name}.txt").write_text(config)
+    stockpile_info = StockpileResults(
+        name=f"{task.host}_backup",
+        ip=task.host.hostname,
+        hostname=task.host.name,
+        backup_successful=True,
+        device_config=config,
+    )
+    return Result(host=task.host, result=stockpile_info)
+
+
+def limited_stockpile(task: Task, stockpile_directory: pathlib.Path, proxies: dict = None) -> Result:
+    """
+    Stand in for a device backup holding the host's concurrency limits, noting when it held them
+    """
+
+    with Limits.acquire(limits=Limits.host_limits(task=task)):
+        started = time.monotonic()
+        result = fake_stockpile(task=task, stockpile_directory=stockpile_directory)
+        held = f"{started} {time.monotonic()}"
+    pathlib.Path(stockpile_directory / f"{task.host.name}.held").write_text(held)
+    return result
+
+
+class RecordResults:
+    """
+    Note what each host was reported with, before ProcessStockpiles releases it
+    """
+
+    def __init__(self) -> None:
+        self.started = set()
+        self.completed = {}
+
+    def task_started(self, task: Task) -> None:
+        pass
+
+    def task_completed(self, task: Task, result: AggregatedResult) -> None:
+        pass
+
+    def task_instance_started(self, task: Task, host: Host) -> None:
+        self.started.add(host.name)
+
+    def task_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
+        self.completed[host.name] = (str(result[0].result), result.failed)
+
+    def subtask_instance_started(self, task: Task, host: Host) -> None:
+        pass
+
+    def subtask_instance_completed(self, task: Task, host: Host, result: MultiResult) -> None:
+        pass
+
+
+@unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "Requires forked worker processes")
+class TestMultiProcess(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Create a temporary stockpile directory for each test
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.stockpile_directory = pathlib.Path(self.temp_dir.name) / "stockpile"
+        self.inventory_directory = pathlib.Path(self.temp_dir.name) / "inventory"
+        self.inventory_directory.mkdir()
+
+    def tearDown(self) -> None:
+        Limits.semaphores.pop("aaa-test", None)
+        self.temp_dir.cleanup()
+
+    def run_stockpile(self, failures: dict, processes: int = 2, defaults: dict = None, task=fake_stockpile) -> tuple:
+        """
+        Stockpile four hosts across our worker processes
+        :param failures: A Dict of host name to how it fails, `raise` or `exit` (taking its worker process with it)
+        :param processes:
+        :param defaults: Optional inventory defaults
+        :param task: The stand in for stockpile_device_config
+        :return: A Tuple of the AggregatedResult, our ProcessStockpiles, and what each host was reported with
+        """
+
+        hosts = {
+            f"rtr{i}": {"hostname": f"192.0.2.{i}", "platform": "cisco_ios", "data": {"fail": failures.get(f"rtr{i}")}}
+            for i in range(4)
+        }
+        (self.inventory_directory / "hosts.yml").write_text(yaml.safe_dump(hosts))
+        (self.inventory_directory / "defaults.yml").write_text(yaml.safe_dump(defaults or {}))
+        norns = InitNornir(
+            core={"num_workers": 2},
+            inventory={
+                "plugin": "nornir.plugins.inventory.simple.SimpleInventory",
+                "options": {
+                    "host_file": f"{self.inventory_directory}/hosts.yml",
+                    "group_file": "",
+                    "defaults_file": f"{self.inventory_directory}/defaults.yml",
+                },
+            },
+            logging={"enabled": False},
+        )
+        recorder = RecordResults()
+        processor = ProcessStockpiles()
+        runner = MultiProcessStockpileRunner(norns=norns, processors=[recorder, processor], processes=processes)
+        with mock.patch("stockpiler.runners.multiprocess.stockpile_device_config", task):
+            result = runner.run(stockpile_directory=self.stockpile_directory)
+        return result, processor, recorder
+
+    def test_results_handed_back(self):
+        """
+        Tests that each host's results, and the timings of its phases taken in its worker, are handed back to our
+        processors
+        :return:
+        """
+
+        result, processor, recorder = self.run_stockpile(failures={})
+
+        self.assertFalse(result.failed)
+        self.assertEqual(sorted(result), [f"rtr{i}" for i in range(4)])
+        for host_name, host_result in result.items():
+            with self.subTest(host=host_name):
+                self.assertTrue(host_result[0].result["backup_successful"])
+                self.assertIsNone(host_result[0].result["device_config"])
+                phases = processor.metrics.host_phases[host_name]
+                self.assertGreaterEqual(phases["backup"], 0.05)
+                self.assertGreaterEqual(phases["host"], phases["backup"])
+        self.assertEqual(len(processor.metrics.samples["host"]), 4)
+        self.assertEqual((self.stockpile_directory / "rtr2.txt").read_text(), "hostname rtr2\n")
+
+        self.assertEqual(recorder.started, set(result))
+
+        durations = HistoryIndex(stockpile_directory=self.stockpile_directory).expected_durations()
+        self.assertEqual(sorted(durations), sorted(result))
+        self.assertGreaterEqual(min(durations.values()), 0.05)
+
+    def test_failures_propagated(self):
+        """
+        Tests that a host whose task raised, and hosts lost with their worker process, are reported as failed
+        :return:
+        """
+
+        result, processor, recorder = self.run_stockpile(failures={"rtr0": "raise", "rtr3": "exit"})
+
+        self.assertTrue(result.failed)
+        self.assertTrue(result["rtr0"].failed)
+        self.assertIn("ValueError: Unable to backup rtr0", recorder.completed["rtr0"][0])
+        self.assertTrue(result["rtr3"].failed)
+        self.assertEqual(recorder.completed["rtr3"], ("Worker process exited unexpectedly", True))
+        self.assertFalse(result["rtr2"].failed)
+        self.assertEqual(sorted(result), [f"rtr{i}" for i in range(4)])
+        self.assertEqual(processor.metrics.outcomes["failed"], len([r for r in result.values() if r.failed]))
+
+    def test_limits_shared(self):
+        """
+        Tests that a concurrency limit caps the hosts holding it across every worker process, not in each
+        :return:
+        """
+
+        defaults = {"data": {"stockpile_concurrency_limits": {"aaa-test": 1}, "stockpile_limits": ["aaa-test"]}}
+        result, processor, recorder = self.run_stockpile(failures={}, defaults=defaults, task=limited_stockpile)
+
+        self.assertFalse(result.failed)
+        held = sorted(
+            tuple(float(t) for t in (self.stockpile_directory / f"{host_name}.held").read_text().split())
+            for host_name in result
+        )
+        for (_, released), (taken, _) in zip(held, held[1:]):
+            self.assertLessEqual(released, taken)
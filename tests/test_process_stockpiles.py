@@ -0,0 +1,406 @@
+import csv
+import contextlib
+import datetime
+import io
+import json
+import pathlib
+import sqlite3
+import tempfile
+from typing import Optional
+import unittest
+from unittest import mock
+
+
+from git import Repo
+from nornir.core.inventory import Host
+from nornir.core.task import AggregatedResult, MultiResult, Result, Task
+
+
+from stockpiler.__main__ import print_device_history
+from stockpiler.checkpoint import journal_path, load_journal, resumable_entries
+from stockpiler.history import history_path, HistoryIndex, parse_since, SCHEMA
+from stockpiler.processors.process_stockpiles import ProcessStockpiles
+from stockpiler.tasks.stockpile.config_files import config_path, write_config
+from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+class TestProcessStockpiles(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Create a temporary stockpile directory for each test
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.stockpile_directory = pathlib.Path(self.temp_dir.name)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def run_stockpile(
+        self,
+        configs: dict,
+        change_markers: Optional[dict] = None,
+        interrupted: bool = False,
+        host_data: Optional[dict] = None,
+        **kwargs,
+    ) -> AggregatedResult:
+        """
+        Drive a ProcessStockpiles through a run as Nornir would, with each host "writing" the given config
+        :param configs: A Dict of host name to config text, or None for a host skipped as unchanged
+        :param change_markers: A Dict of host name to the change marker it reported
+        :param interrupted: Stop once the hosts complete, as though the run was killed before it could commit
+        :param host_data: Inventory data given to every host
+        :param kwargs: Passed to ProcessStockpiles
+        :return:
+        """
+
+        change_markers = change_markers or {}
+        processor = ProcessStockpiles(**kwargs)
+        task = Task(task=stockpile_device_config, stockpile_directory=self.stockpile_directory, proxies=None)
+        processor.task_started(task)
+
+        agg_result = AggregatedResult(task.name)
+        for name, config in configs.items():
+            host = Host(name=name, hostname=name, data=dict(host_data or {}))
+            processor.task_instance_started(task, host)
+            subtask = Task(task=stockpile_device_config, name="backup")
+            processor.subtask_instance_started(subtask, host)
+            processor.subtask_instance_completed(subtask, host, MultiResult(subtask.name))
+            if config is not None:
+                write_config(
+                    stockpile_directory=self.stockpile_directory, relative_path=config_path(host=host), content=config
+                )
+            stockpile_info = StockpileResults(
+                name=f"{name}_backup",
+                ip=name,
+                hostname=name,
+                backup_successful=True,
+                device_config=config,
+                change_marker=change_markers.get(name),
+                skip_reason="unchanged" if config is None else None,
+            )
+            results = MultiResult(task.name)
+            results.append(Result(host=host, result=stockpile_info))
+            processor.task_instance_completed(task, host, results)
+            agg_result[name] = results
+
+        if interrupted:
+            processor.journal.close()
+            processor.results.close_csv()
+            return agg_result
+        processor.task_completed(task, agg_result)
+        return agg_result
+
+    def test_commit_only_changed(self):
+        """
+        Tests that only changed configs get committed, and unchanged runs make no commit
+        :return:
+        """
+
+        with self.subTest(msg="Checking the first run commits every config..."):
+            self.run_stockpile(configs={"r1": "hostname r1\n", "r2": "hostname r2\n"})
+            repo = Repo(str(self.stockpile_directory))
+            self.assertEqual(len(list(repo.iter_commits())), 1)
+            self.assertEqual(
+                sorted(repo.head.commit.stats.files.keys()), ["r1.txt", "r2.txt", "results.csv"],
+            )
+
+        with self.subTest(msg="Checking an unchanged run makes no commit..."):
+            self.run_stockpile(configs={"r1": "hostname r1\n", "r2": "hostname r2\n"})
+            self.assertEqual(len(list(repo.iter_commits())), 1)
+
+        with self.subTest(msg="Checking only the changed config is committed..."):
+            self.run_stockpile(configs={"r1": "hostname r1\n", "r2": "hostname r2-new\n"})
+            self.assertEqual(len(list(repo.iter_commits())), 2)
+            self.assertIn("r2.txt", repo.head.commit.stats.files)
+            self.assertNotIn("r1.txt", repo.head.commit.stats.files)
+
+    def test_fast_import_backend(self):
+        """
+        Tests that the fast-import backend commits the same changes without touching the index, and that the index
+        backend catches the index up before committing after it
+        :return:
+        """
+
+        self.run_stockpile(configs={"r1": "hostname r1\n", "r2 b": "hostname r2\n"}, commit_backend="fast-import")
+        repo = Repo(str(self.stockpile_directory))
+        self.assertEqual(sorted(repo.head.commit.stats.files.keys()), ["r1.txt", "r2 b.txt", "results.csv"])
+        self.assertFalse((self.stockpile_directory / ".git" / "index").exists())
+
+        self.run_stockpile(configs={"r1": "hostname r1\n", "r2 b": "hostname r2-new\n"}, commit_backend="fast-import")
+        self.assertEqual(len(list(repo.iter_commits())), 2)
+        self.assertNotIn("r1.txt", repo.head.commit.stats.files)
+        self.assertEqual(repo.head.commit.tree["r2 b.txt"].data_stream.read(), b"hostname r2-new\n")
+
+        with self.subTest(msg="Checking the index backend keeps every config after fast-import commits..."):
+            self.run_stockpile(configs={"r1": "hostname r1-new\n", "r2 b": "hostname r2-new\n"})
+            self.assertEqual(len(list(repo.iter_commits())), 3)
+            self.assertNotIn("r2 b.txt", repo.head.commit.stats.files)
+            self.assertEqual(sorted(b.path for b in repo.head.commit.tree.blobs), ["r1.txt", "r2 b.txt", "results.csv"])
+            self.assertFalse(repo.is_dirty())
+
+    def test_results_streamed(self):
+        """
+        Tests that each host's row reaches the CSV and its config text is released once it completes
+        :return:
+        """
+
+        agg_result = self.run_stockpile(configs={"r1": "hostname r1\n", "r2": "hostname r2\n"})
+        rows = (self.stockpile_directory / "results.csv").read_text().splitlines()
+        self.assertEqual(len(rows), 3)
+        self.assertNotIn("device_config", rows[0])
+        for host_result in agg_result.values():
+            self.assertIsNone(host_result[0].result["device_config"])
+
+    def test_change_markers(self):
+        """
+        Tests that change markers are recorded outside the repository, and skipped hosts still report as successful
+        :return:
+        """
+
+        manifest = self.stockpile_directory / ".stockpiler" / "change_markers.json"
+        self.run_stockpile(configs={"r1": "hostname r1\n", "r2": "hostname r2\n"}, change_markers={"r1": "abc123"})
+        self.assertEqual(json.loads(manifest.read_text()), {"r1": "abc123"})
+        repo = Repo(str(self.stockpile_directory))
+        self.assertNotIn(".stockpiler", repo.git.status("--porcelain", "--untracked-files=all"))
+
+        self.run_stockpile(configs={"r1": None, "r2": "hostname r2-new\n"}, change_markers={"r1": "abc123"})
+        self.assertEqual(len(list(repo.iter_commits())), 2)
+        self.assertNotIn("r1.txt", repo.head.commit.stats.files)
+        with (self.stockpile_directory / "results.csv").open() as f:
+            rows = {row["hostname"]: row for row in csv.DictReader(f)}
+        self.assertEqual((rows["r1"]["backup_successful"], rows["r1"]["skip_reason"]), ("True", "unchanged"))
+        self.assertEqual(rows["r2"]["skip_reason"], "")
+
+        with self.subTest(msg="Checking markers are dropped when their config is no longer stockpiled..."):
+            (self.stockpile_directory / "r1.txt").unlink()
+            self.run_stockpile(configs={"r2": "hostname r2-new\n"})
+            self.assertEqual(json.loads(manifest.read_text()), {})
+
+    def test_metrics(self):
+        """
+        Tests that phase timings are written as a Prometheus textfile and a JSON summary
+        :return:
+        """
+
+        metrics_directory = self.stockpile_directory / "metrics"
+        self.run_stockpile(configs={"r1": "hostname r1\n", "r2": None}, metrics_directory=metrics_directory)
+
+        summary = json.loads((metrics_directory / "stockpiler_summary.json").read_text())
+        self.assertEqual(list(summary["phases"]), ["backup", "csv", "host", "commit"])
+        self.assertEqual(summary["phases"]["host"]["count"], 2)
+        self.assertEqual(summary["hosts"], {"successful": 1, "skipped": 1})
+
+        prometheus = (metrics_directory / "stockpiler.prom").read_text().splitlines()
+        self.assertIn('stockpiler_phase_duration_seconds_bucket{phase="backup",le="+Inf"} 2', prometheus)
+        self.assertIn('stockpiler_phase_duration_seconds_count{phase="commit"} 1', prometheus)
+        self.assertIn('stockpiler_run_hosts{outcome="skipped"} 1', prometheus)
+
+    def test_history(self):
+        """
+        Tests that each run is recorded in the history index, which fills in each host's last successful backup
+        :return:
+        """
+
+        self.run_stockpile(configs={"r1": "hostname r1\n", "r2": "hostname r2\n"})
+        unreachable = [StockpileResults(name="r2_backup", ip="r2", hostname="r2")]
+        self.run_stockpile(configs={"r1": "hostname r1-new\n"}, unreachable=unreachable)
+        self.run_stockpile(configs={"r1": None})
+        index = HistoryIndex(stockpile_directory=self.stockpile_directory, create=False)
+        self.addCleanup(index.close)
+
+        with self.subTest(msg="Checking each run of a host is recorded, newest first..."):
+            backups = index.device_history(host="r1")
+            self.assertEqual([b["changed"] for b in backups], [0, 1, 1])
+            self.assertEqual(backups[0]["skip_reason"], "unchanged")
+            # Skipped hosts keep the blob of their committed config
+            self.assertEqual(backups[0]["blob"], backups[1]["blob"])
+            self.assertEqual(backups[1]["size"], len("hostname r1-new\n"))
+            self.assertEqual(backups[1]["commit_sha"], Repo(str(self.stockpile_directory)).head.commit.hexsha)
+            self.assertIsNone(backups[0]["commit_sha"])
+
+        with self.subTest(msg="Checking last successful backups carry over failed attempts..."):
+            r2_backups = index.device_history(host="r2")
+            self.assertEqual([b["backup_successful"] for b in r2_backups], [0, 1])
+            self.assertEqual(index.device(host="r2")["last_successful_backup"], r2_backups[1]["completed"])
+            self.assertEqual(index.device(host="r1")["last_changed"], backups[1]["completed"])
+            # Unreachable hosts weren't timed, so keep the duration expected of them
+            self.assertEqual(set(index.expected_durations()), {"r1", "r2"})
+
+        with self.subTest(msg="Checking the report has each host's last successful backup..."):
+            with (self.stockpile_directory / "results.csv").open() as f:
+                rows = {row["hostname"]: row for row in csv.DictReader(f)}
+            self.assertEqual(rows["r1"]["last_successful_backup"], backups[0]["completed"])
+
+        with self.subTest(msg="Checking changed devices are found by time..."):
+            self.assertEqual([h for (h, _) in index.changed_since(since=parse_since("1h"))], ["r1", "r2"])
+            self.assertEqual(index.changed_since(since=parse_since("2999-01-01")), [])
+
+    def test_history_without_upsert(self):
+        """
+        Tests that SQLite versions without UPSERT keep the same latest state of each device
+        :return:
+        """
+
+        runs = [
+            [("r1", "2020-01-01T00:00:00", None, True, True, False, True, None, "a", 10, True, 4.0, None)],
+            [
+                ("r1", "2020-01-02T00:00:00", None, False, False, False, True, None, None, None, False, 2.0, None),
+                ("r2", "2020-01-02T00:00:00", None, True, True, False, True, None, "b", 20, True, None, None),
+            ],
+        ]
+        devices = {}
+        for version in ((3, 31, 1), (3, 22, 0)):
+            with self.subTest(version=version), tempfile.TemporaryDirectory() as temp_dir:
+                index = HistoryIndex(stockpile_directory=pathlib.Path(temp_dir))
+                self.addCleanup(index.close)
+                with mock.patch("sqlite3.sqlite_version_info", version):
+                    for backups in runs:
+                        completed = backups[0][1]
+                        index.record_run(started=completed, finished=completed, commit_sha=None, backups=backups)
+                devices[version] = {
+                    host: (index.device(host=host), index.expected_durations().get(host)) for host in ("r1", "r2")
+                }
+                self.assertEqual(
+                    devices[version]["r1"][0],
+                    {
+                        "last_attempt": "2020-01-02T00:00:00",
+                        "last_successful_backup": "2020-01-01T00:00:00",
+                        "last_changed": "2020-01-01T00:00:00",
+                        "blob": "a",
+                    },
+                )
+                self.assertEqual(devices[version]["r1"][1], 3.0)
+                self.assertIsNone(devices[version]["r2"][1])
+        self.assertEqual(devices[(3, 31, 1)], devices[(3, 22, 0)])
+
+    def test_history_api_used(self):
+        """
+        Tests that an index from before `api_used` was recorded gains it, and backups through a native API are printed
+        as such
+        :return:
+        """
+
+        path = history_path(stockpile_directory=self.stockpile_directory)
+        path.parent.mkdir(parents=True)
+        connection = sqlite3.connect(str(path))
+        connection.executescript(SCHEMA.replace("    api_used TEXT,\n", ""))
+        connection.close()
+
+        index = HistoryIndex(stockpile_directory=self.stockpile_directory)
+        self.addCleanup(index.close)
+        index.record_run(
+            started="2020-01-01T00:00:00",
+            finished="2020-01-01T00:00:00",
+            commit_sha=None,
+            backups=[
+                ("r1", "2020-01-01T00:00:00", None, True, True, False, False, None, "a", 10, True, 1.0, "nxapi"),
+                ("r2", "2020-01-01T00:00:00", None, True, True, False, True, None, "b", 10, True, 1.0, None),
+            ],
+        )
+        self.assertEqual(index.device_history(host="r1")[0]["api_used"], "nxapi")
+
+        for host_name, connected in (("r1", ", NX-API,"), ("r2", ", SSH,")):
+            with self.subTest(host=host_name):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    print_device_history(index=index, host_name=host_name, limit=1, changed_only=False)
+                self.assertIn(connected, output.getvalue())
+
+    def test_checkpoint(self):
+        """
+        Tests that an interrupted run leaves a journal of the hosts it completed, and that resuming it carries those
+        over and commits them along with the rest
+        :return:
+        """
+
+        self.run_stockpile(configs={"r1": "hostname r1\n", "r2": "hostname r2\n"}, interrupted=True)
+        self.assertEqual(sorted(load_journal(stockpile_directory=self.stockpile_directory)), ["r1", "r2"])
+        # Each host's row was written to the report as it completed
+        rows = list(csv.DictReader((self.stockpile_directory / "results.csv").open()))
+        self.assertEqual(sorted(row["hostname"] for row in rows), ["r1", "r2"])
+        self.assertFalse(Repo(str(self.stockpile_directory)).head.is_valid())
+
+        with self.subTest(msg="Checking hosts whose config changed since, or older than the window, aren't resumed..."):
+            (self.stockpile_directory / "r2.txt").write_text("hostname r2-edited\n")
+            since = parse_since("1h")
+            self.assertEqual(list(resumable_entries(stockpile_directory=self.stockpile_directory, since=since)), ["r1"])
+            later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+            self.assertEqual(resumable_entries(stockpile_directory=self.stockpile_directory, since=later), {})
+
+        with self.subTest(msg="Checking the resumed run commits every host, and removes the journal..."):
+            resumed = resumable_entries(stockpile_directory=self.stockpile_directory, since=parse_since("1h"))
+            self.run_stockpile(configs={"r2": "hostname r2\n"}, resumed=resumed)
+            repo = Repo(str(self.stockpile_directory))
+            self.assertEqual(len(list(repo.iter_commits())), 1)
+            self.assertEqual(sorted(repo.head.commit.stats.files.keys()), ["r1.txt", "r2.txt", "results.csv"])
+            rows = list(csv.DictReader((self.stockpile_directory / "results.csv").open()))
+            self.assertEqual(sorted(row["hostname"] for row in rows), ["r1", "r2"])
+            self.assertFalse(journal_path(stockpile_directory=self.stockpile_directory).exists())
+
+    def test_deferred_save_config(self):
+        """
+        Tests that hosts left to the deferred save config phase are saved after the backups (only if their config
+        changed, with `changed`), and their rows report whether they were
+        :return:
+        """
+
+        class DeferredSave:
+            def __init__(self):
+                self.saves = {}
+
+            def run(self, saves):
+                self.saves.update(saves)
+                return {name: name != "r3" for name in saves}
+
+        self.run_stockpile(configs={"r1": "hostname r1\n", "r2": "hostname r2\n"})
+        deferred_save = DeferredSave()
+        self.run_stockpile(
+            configs={"r1": "hostname r1\n", "r2": "hostname r2-new\n", "r3": "hostname r3\n"},
+            host_data={"stockpile_save_config": "changed"},
+            deferred_save=deferred_save,
+        )
+        self.assertEqual(sorted(deferred_save.saves), ["r2", "r3"])
+        self.assertEqual(deferred_save.saves["r2"], {"http_used": False, "http_mgmt_port": 443, "api_used": None})
+
+        rows = list(csv.DictReader((self.stockpile_directory / "results.csv").open()))
+        saved = {row["hostname"]: row["save_config_successful"] for row in rows}
+        self.assertEqual(saved, {"r1": "False", "r2": "True", "r3": "False"})
+
+    def test_config_layout(self):
+        """
+        Tests that identical configs aren't rewritten, and that configs move (in one commit) when their layout changes
+        :return:
+        """
+
+        self.run_stockpile(configs={"r1": "hostname r1\n", "r2": "hostname r2\n"})
+        config_file = self.stockpile_directory / "r1.txt"
+        mtime = config_file.stat().st_mtime_ns
+        self.assertEqual(write_config(self.stockpile_directory, "r1.txt", "hostname r1\n")[1], False)
+        self.assertEqual(config_file.stat().st_mtime_ns, mtime)
+        self.assertEqual(write_config(self.stockpile_directory, "r1.txt", "hostname r1-new\n")[1], True)
+        self.assertEqual(config_file.read_text(), "hostname r1-new\n")
+        config_file.write_text("hostname r1\n")
+
+        repo = Repo(str(self.stockpile_directory))
+        for commit_backend, layout in (("index", "site"), ("fast-import", "hash")):
+            with self.subTest(msg=f"Checking configs move to the {layout} layout with the {commit_backend} backend..."):
+                self.run_stockpile(
+                    configs={"r1": "hostname r1\n", "r2": "hostname r2\n"},
+                    host_data={"stockpile_layout": layout},
+                    commit_backend=commit_backend,
+                )
+                paths = [config_path(host=Host(name=n, data={"stockpile_layout": layout})) for n in ("r1", "r2")]
+                self.assertEqual(
+                    sorted(b.path for b in repo.head.commit.tree.traverse() if b.type == "blob"),
+                    sorted(paths + ["results.csv"]),
+                )
+                self.assertFalse((self.stockpile_directory / "r1.txt").exists())
+
+        with self.subTest(msg="Checking unchanged configs in their new layout make no commit..."):
+            self.run_stockpile(
+                configs={"r1": "hostname r1\n", "r2": "hostname r2\n"}, host_data={"stockpile_layout": "hash"}
+            )
+            self.assertEqual(len(list(repo.iter_commits())), 3)
@@ -0,0 +1,97 @@
+import socket
+import socketserver
+import threading
+import unittest
+
+
+from nornir.core.inventory import Host
+
+
+from stockpiler.tasks.stockpile.proxy_pool import ProxyEndpoint, ProxyPool, ProxyUnavailable
+
+
+class SOCKSGreeting(socketserver.BaseRequestHandler):
+    """
+    Answer a SOCKS5 greeting, accepting no authentication
+    """
+
+    def handle(self) -> None:
+        self.request.recv(3)
+        self.request.sendall(b"\x05\x00")
+
+
+def closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestProxyPool(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Start two fake proxies, and note a port nothing listens on for a dead one
+        :return:
+        """
+
+        self.servers = []
+        for _ in range(2):
+            server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SOCKSGreeting)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        self.endpoints = [
+            ProxyEndpoint.parse(f"127.0.0.1:{self.servers[0].server_address[1]}@dc1"),
+            ProxyEndpoint.parse(f"127.0.0.1:{self.servers[1].server_address[1]}@dc2"),
+            ProxyEndpoint.parse(f"127.0.0.1:{closed_port()}@dc1"),
+        ]
+
+    def tearDown(self) -> None:
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_lease(self):
+        """
+        Tests that dead proxies are skipped, and leases go to the least used (or site's) healthy proxy
+        :return:
+        """
+
+        pool = ProxyPool()
+        pool.configure(endpoints=self.endpoints)
+        self.assertEqual([e.healthy for e in self.endpoints], [True, True, False])
+
+        hosts = [Host(name=f"rtr{i}", data={"site": "dc1"}) for i in range(3)]
+        with pool.lease(host=hosts[0]) as first, pool.lease(host=hosts[1]) as second:
+            self.assertEqual({first, second}, set(self.endpoints[:2]))
+            with pool.lease(host=hosts[2]):
+                self.assertEqual(sorted(e.active for e in self.endpoints[:2]), [1, 2])
+        self.assertEqual([e.active for e in self.endpoints], [0, 0, 0])
+        self.assertEqual(pool.leases, {})
+
+        pool.strategy = "site"
+        with pool.lease(host=hosts[0]) as first, pool.lease(host=hosts[1]) as second:
+            self.assertIs(first, self.endpoints[0])
+            self.assertIs(second, self.endpoints[0])
+        pool.stop()
+
+    def test_failover(self):
+        """
+        Tests that a proxy which stops answering is taken out of rotation, until none are left
+        :return:
+        """
+
+        pool = ProxyPool()
+        pool.configure(endpoints=self.endpoints[:2])
+        host = Host(name="rtr0")
+
+        self.assertFalse(pool.failed_through(endpoint=self.endpoints[0]))
+        self.servers[0].shutdown()
+        self.servers[0].server_close()
+        self.assertTrue(pool.failed_through(endpoint=self.endpoints[0]))
+        with pool.lease(host=host) as endpoint:
+            self.assertIs(endpoint, self.endpoints[1])
+
+        self.endpoints[1].healthy = False
+        with self.assertRaises(ProxyUnavailable):
+            with pool.lease(host=host):
+                pass
+        pool.stop()
@@ -0,0 +1,172 @@
+import asyncio
+import pathlib
+import socket
+import tempfile
+import unittest
+
+
+from nornir import InitNornir
+from nornir.core.inventory import Host
+import yaml
+
+
+from stockpiler.runners.reachability import _sweep, management_ports, reachability_sweep, tcp_port_open
+
+
+def closed_port() -> int:
+    """
+    A local port nothing is listening on
+    :return:
+    """
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestReachability(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Listen on a local port for each test, and find one that's closed
+        :return:
+        """
+
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(128)
+        self.open_port = self.listener.getsockname()[1]
+        self.closed_port = closed_port()
+
+    def tearDown(self) -> None:
+        self.listener.close()
+
+    def test_management_ports(self):
+        """
+        Tests which management ports are checked for each kind of host, with and without proxies
+        :return:
+        """
+
+        proxies = {"https": "socks5://127.0.0.1:1080"}
+        for name, platform, data, port, with_proxies, expected in (
+            ("ios", "cisco_ios", {}, None, None, {"ssh_port_check_ok": 22}),
+            ("ios_port", "cisco_ios", {}, 2222, None, {"ssh_port_check_ok": 2222}),
+            (
+                "asa_http",
+                "cisco_asa",
+                {"http_management": True},
+                None,
+                None,
+                {"ssh_port_check_ok": 22, "http_port_check_ok": 8443},
+            ),
+            ("asa_http_proxied", "cisco_asa", {"http_management": True}, None, proxies, {"ssh_port_check_ok": 22}),
+            ("asa_ssh", "cisco_asa", {"http_management": False}, None, None, {"ssh_port_check_ok": 22}),
+            (
+                "nxos_api",
+                "cisco_nxos",
+                {"stockpile_collection": "api"},
+                None,
+                None,
+                {"ssh_port_check_ok": 22, "api_port_check_ok": 443},
+            ),
+            (
+                "nxos_api_proxied",
+                "cisco_nxos",
+                {"stockpile_collection": "api"},
+                None,
+                proxies,
+                {"ssh_port_check_ok": 22},
+            ),
+            (
+                "xe_netconf_proxied",
+                "cisco_xe",
+                {"stockpile_collection": "api"},
+                None,
+                proxies,
+                {"ssh_port_check_ok": 22, "api_port_check_ok": 830},
+            ),
+            ("ios_api", "cisco_ios", {"stockpile_collection": "api"}, None, None, {"ssh_port_check_ok": 22}),
+        ):
+            with self.subTest(name=name):
+                host = Host(name=name, platform=platform, port=port, data=data)
+                self.assertEqual(management_ports(host=host, proxies=with_proxies), expected)
+
+    def test_tcp_port_open(self):
+        """
+        Tests that a listening port is open, and a closed one isn't
+        :return:
+        """
+
+        self.assertTrue(asyncio.run(tcp_port_open(hostname="127.0.0.1", port=self.open_port, timeout=1)))
+        self.assertFalse(asyncio.run(tcp_port_open(hostname="127.0.0.1", port=self.closed_port, timeout=1)))
+
+    def test_sweep(self):
+        """
+        Tests that the sweep stores each host's port checks on it
+        :return:
+        """
+
+        hosts = [
+            Host(name="up", hostname="127.0.0.1", platform="cisco_ios", port=self.open_port),
+            Host(name="down", hostname="127.0.0.1", platform="cisco_ios", port=self.closed_port),
+            Host(
+                name="asa",
+                hostname="127.0.0.1",
+                platform="cisco_asa",
+                port=self.closed_port,
+                data={"http_management": True, "http_mgmt_port": self.open_port},
+            ),
+        ]
+        asyncio.run(_sweep(hosts=hosts, proxies=None, timeout=1, max_in_flight=2))
+
+        self.assertEqual(hosts[0].data, {"ssh_port_check_ok": True})
+        self.assertEqual(hosts[1].data, {"ssh_port_check_ok": False})
+        self.assertFalse(hosts[2].data["ssh_port_check_ok"])
+        self.assertTrue(hosts[2].data["http_port_check_ok"])
+
+    def test_reachability_sweep(self):
+        """
+        Tests that only reachable hosts are left in our inventory, and the rest are reported as failed StockpileResults
+        :return:
+        """
+
+        hosts = {
+            "up": {"hostname": "127.0.0.1", "platform": "cisco_ios", "port": self.open_port},
+            "down": {"hostname": "127.0.0.1", "platform": "cisco_ios", "port": self.closed_port},
+            "asa_down": {
+                "hostname": "127.0.0.1",
+                "platform": "cisco_asa",
+                "port": self.closed_port,
+                "data": {"http_management": True, "http_mgmt_port": self.closed_port},
+            },
+            "asa_proxied": {
+                "hostname": "127.0.0.1",
+                "platform": "cisco_asa",
+                "port": self.closed_port,
+                "data": {"http_management": True, "http_mgmt_port": self.closed_port},
+            },
+        }
+        for proxies, reachable in ((None, ["up"]), ({"https": "socks5://127.0.0.1:1080"}, ["up", "asa_proxied"])):
+            with self.subTest(proxies=proxies), tempfile.TemporaryDirectory() as temp_dir:
+                inventory_directory = pathlib.Path(temp_dir)
+                (inventory_directory / "hosts.yml").write_text(yaml.safe_dump(hosts))
+                norns = InitNornir(
+                    inventory={
+                        "plugin": "nornir.plugins.inventory.simple.SimpleInventory",
+                        "options": {"host_file": f"{inventory_directory}/hosts.yml", "group_file": ""},
+                    },
+                    logging={"enabled": False},
+                )
+                if proxies is not None:
+                    # Only hosts with HTTP management are assumed reachable behind a proxy
+                    norns.inventory.hosts["asa_down"].data["http_management"] = False
+
+                filtered, unreachable = reachability_sweep(norns=norns, proxies=proxies, timeout=1)
+
+                self.assertEqual(sorted(filtered.inventory.hosts), sorted(reachable))
+                failed = {stockpile_info.name: stockpile_info for stockpile_info in unreachable}
+                self.assertEqual(sorted(failed), sorted(f"{h}_backup" for h in hosts if h not in reachable))
+                for stockpile_info in failed.values():
+                    self.assertFalse(stockpile_info["backup_successful"])
+                    self.assertEqual(stockpile_info["ip"], "127.0.0.1")
+                    self.assertEqual(stockpile_info["ssh_mgmt_port"], self.closed_port)
+                self.assertEqual(failed["asa_down_backup"]["http_mgmt_port"], self.closed_port)
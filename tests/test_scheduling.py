@@ -0,0 +1,108 @@
+import datetime
+import pathlib
+import tempfile
+import unittest
+
+
+from nornir import InitNornir
+import yaml
+
+
+from stockpiler.runners.cadence import due_hosts
+from stockpiler.runners.scheduling import longest_first, set_deadline
+from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+
+
+class TestScheduling(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Create a temporary inventory for each test
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        inventory_directory = pathlib.Path(self.temp_dir.name)
+        hosts = {f"rtr{i}": {"hostname": f"192.0.2.{i}", "platform": "cisco_ios"} for i in range(5)}
+        (inventory_directory / "hosts.yml").write_text(yaml.safe_dump(hosts))
+        self.norns = InitNornir(
+            inventory={
+                "plugin": "nornir.plugins.inventory.simple.SimpleInventory",
+                "options": {"host_file": f"{inventory_directory}/hosts.yml", "group_file": ""},
+            },
+            logging={"enabled": False},
+        )
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_longest_first(self):
+        """
+        Tests that hosts are ordered by expected duration, with hosts lacking history expected to take the median
+        :return:
+        """
+
+        ordered = longest_first(norns=self.norns, durations={"rtr1": 5.0, "rtr3": 30.0, "gone": 60.0})
+        self.assertEqual(list(ordered.inventory.hosts), ["rtr3", "rtr0", "rtr2", "rtr4", "rtr1"])
+        self.assertEqual(ordered.inventory.hosts["rtr0"].data["stockpile_expected_duration"], 17.5)
+
+    def test_deadline(self):
+        """
+        Tests that hosts which can't be expected to finish before the deadline are deferred rather than started
+        :return:
+        """
+
+        ordered = longest_first(norns=self.norns, durations={"rtr1": 5.0, "rtr3": 30.0})
+        set_deadline(norns=ordered, budget=1.0)
+        results = ordered.run(task=stockpile_device_config, stockpile_directory=pathlib.Path(self.temp_dir.name))
+
+        for name, result in results.items():
+            with self.subTest(host=name):
+                self.assertFalse(result.failed)
+                self.assertEqual(result[0].result["skip_reason"], "deferred")
+                self.assertFalse(result[0].result["backup_successful"])
+
+    def test_cadence(self):
+        """
+        Tests that devices are due by how often they've changed, within their cadence's bounds
+        :return:
+        """
+
+        now = datetime.datetime(2020, 1, 25, 12, 0, 0)
+        self.norns.inventory.hosts["rtr3"].data["stockpile_cadence"] = 600
+        for name in ("rtr0", "rtr1", "rtr2"):
+            self.norns.inventory.hosts[name].data["stockpile_cadence"] = "adaptive"
+        hours_ago = {"rtr0": 2, "rtr1": 2, "rtr2": 23, "rtr3": 1}
+        last_successful_backups = {
+            name: (now - datetime.timedelta(hours=hours)).isoformat() for (name, hours) in hours_ago.items()
+        }
+
+        class FakeHistory:
+            @staticmethod
+            def change_counts(since: datetime.datetime) -> dict:
+                # rtr0 changes daily, so is due a backup every 6 hours; rtr1 and rtr2 haven't changed, so daily
+                return {"rtr0": 30} if since == now - datetime.timedelta(days=30) else {}
+
+        due = due_hosts(
+            norns=self.norns, last_successful_backups=last_successful_backups, history=FakeHistory(), now=now
+        )
+        # rtr2 is within the slack of its daily backup, rtr3 is past its fixed interval, and rtr4 has no cadence
+        self.assertEqual(list(due.inventory.hosts), ["rtr2", "rtr3", "rtr4"])
+
+        last_successful_backups["rtr0"] = (now - datetime.timedelta(hours=6)).isoformat()
+        due = due_hosts(
+            norns=self.norns, last_successful_backups=last_successful_backups, history=FakeHistory(), now=now
+        )
+        self.assertIn("rtr0", due.inventory.hosts)
+
+        # A host with an invalid cadence is logged and backed up every run, without stopping the rest
+        self.norns.inventory.hosts["rtr4"].data["stockpile_cadence"] = {"min_interval": 10, "max_interval": 5}
+        self.norns.inventory.hosts["rtr3"].data["stockpile_cadence"] = {"min_interval": "hourly"}
+        with self.assertLogs("stockpiler", level="ERROR") as logs:
+            due = due_hosts(
+                norns=self.norns,
+                last_successful_backups={name: now.isoformat() for name in ("rtr2", "rtr3", "rtr4")},
+                history=None,
+                now=now,
+            )
+        self.assertEqual(list(due.inventory.hosts), ["rtr0", "rtr1", "rtr3", "rtr4"])
+        self.assertEqual(len(logs.records), 2)
@@ -0,0 +1,116 @@
+import pathlib
+import socket
+import tempfile
+from types import SimpleNamespace
+import unittest
+
+
+from nornir import InitNornir
+from nornir.core.inventory import Host
+import yaml
+
+
+from stockpiler.tasks.stockpile.stockpile_api import api_outputs, api_request, native_api, stockpile_native_api
+from stockpiler.tasks.stockpile.stockpile_base import StockpileMap, stockpile_device_config
+
+
+def closed_port() -> int:
+    """
+    A local port nothing is listening on
+    :return:
+    """
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestNativeAPI(unittest.TestCase):
+    def test_native_api(self):
+        """
+        Tests that only hosts collected through their API, on a platform that has one, use it
+        :return:
+        """
+
+        for platform, collection, api in (
+            ("cisco_nxos", "api", "nxapi"),
+            ("arista_eos", "api", "eapi"),
+            ("cisco_xe", "api", "netconf"),
+            ("cisco_ios", "api", None),
+            ("cisco_nxos", "ssh", None),
+            ("cisco_nxos", None, None),
+        ):
+            with self.subTest(platform=platform, collection=collection):
+                host = Host(name="sw1", platform=platform, data={"stockpile_collection": collection})
+                self.assertEqual(native_api(host=host), api)
+                self.assertIs(StockpileMap[platform] is stockpile_native_api, platform != "cisco_ios")
+
+    def test_api_outputs(self):
+        """
+        Tests that the text output of each command is found in NX-API and eAPI responses, and errors raised
+        :return:
+        """
+
+        self.assertEqual(
+            api_outputs(api="nxapi", body={"result": {"msg": "hostname sw1\n"}, "id": 1}), ["hostname sw1\n"]
+        )
+        self.assertEqual(
+            api_outputs(api="nxapi", body=[{"result": {"msg": "a"}, "id": 1}, {"result": None, "id": 2}]), ["a", ""]
+        )
+        self.assertEqual(
+            api_outputs(api="eapi", body={"result": [{}, {"output": "hostname sw1\n"}], "id": "stockpiler"}),
+            ["hostname sw1\n"],
+        )
+        for api, body in (
+            ("nxapi", {"error": {"code": -32602, "message": "Invalid params", "data": {"msg": "% Invalid command"}}}),
+            ("eapi", {"error": {"code": 1002, "message": "CLI command 2 of 2 'show running-config' failed"}}),
+        ):
+            with self.subTest(api=api), self.assertRaises(ValueError):
+                api_outputs(api=api, body=body)
+
+    def test_fall_back_to_ssh(self):
+        """
+        Tests that a host whose API doesn't answer is backed up over SSH instead, without its API attempt failing it
+        :return:
+        """
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            inventory_directory = pathlib.Path(temp_dir)
+            hosts = {
+                "sw1": {
+                    "hostname": "127.0.0.1",
+                    "platform": "cisco_nxos",
+                    "username": "stockpiler",
+                    "password": "stockpiler",
+                    "data": {
+                        "stockpile_collection": "api",
+                        "stockpile_api_port": closed_port(),
+                        # As though a reachability sweep found the API up, but SSH down
+                        "api_port_check_ok": True,
+                        "ssh_port_check_ok": False,
+                    },
+                }
+            }
+            (inventory_directory / "hosts.yml").write_text(yaml.safe_dump(hosts))
+            norns = InitNornir(
+                inventory={
+                    "plugin": "nornir.plugins.inventory.simple.SimpleInventory",
+                    "options": {"host_file": f"{inventory_directory}/hosts.yml", "group_file": "", "defaults_file": ""},
+                },
+                logging={"enabled": False},
+            )
+
+            url, api_http_kwargs = api_request(
+                task=SimpleNamespace(host=norns.inventory.hosts["sw1"]),
+                api="nxapi",
+                port=443,
+                commands=["show running-config"],
+            )
+            self.assertEqual(url, "https://127.0.0.1:443/ins")
+            self.assertEqual(api_http_kwargs["json"][0]["method"], "cli_ascii")
+
+            results = norns.run(task=stockpile_device_config, stockpile_directory=inventory_directory)
+            stockpile_info = results["sw1"][0].result
+            self.assertIsNone(stockpile_info["api_used"])
+            self.assertFalse(stockpile_info["ssh_port_check_ok"])
+            self.assertEqual([r.name for r in results["sw1"]], ["stockpile_device_config"])
@@ -0,0 +1,120 @@
+from collections import Counter
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+
+
+from netmiko.ssh_exception import NetmikoAuthenticationException
+from nornir import InitNornir
+from nornir.core.task import Result, Task
+import yaml
+
+
+from stockpiler.tasks.stockpile.stockpile_base import StockpileMap, StockpileRegistry, stockpile_device_config
+from stockpiler.tasks.stockpile.stockpile_cisco import stockpile_cisco_asa, stockpile_cisco_generic
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
+
+
+# How many of our stand in backups are running, the most that ran at once, and each host's attempts
+TRACKER = {}
+
+
+class TestStockpileRegistry(unittest.TestCase):
+    def test_lookup(self):
+        """
+        Tests that registered platforms resolve to their own task, other Netmiko platforms to the default,
+        and unknown platforms are rejected
+        :return:
+        """
+
+        registry = StockpileRegistry(default="stockpiler.tasks.stockpile.stockpile_cisco:stockpile_cisco_generic")
+        registry.register("cisco_asa", "stockpiler.tasks.stockpile.stockpile_cisco:stockpile_cisco_asa")
+
+        for platform, task in {"cisco_asa": stockpile_cisco_asa, "cisco_ios": stockpile_cisco_generic}.items():
+            with self.subTest(platform=platform):
+                self.assertIn(platform, registry)
+                self.assertIs(registry[platform], task)
+                # Once imported, the task itself is kept rather than its import path
+                self.assertIs(registry.tasks[platform], task)
+
+        self.assertNotIn("not_a_platform", registry)
+        with self.assertRaises(KeyError):
+            _ = registry["not_a_platform"]
+
+
+def limited_stockpile(task: Task, stockpile_directory: pathlib.Path, proxies: dict = None) -> Result:
+    """
+    Stand in for a device backup, tracking how many run at once, and turning each host away on its first attempt
+    """
+
+    with TRACKER["lock"]:
+        TRACKER["running"] += 1
+        TRACKER["peak"] = max(TRACKER["peak"], TRACKER["running"])
+        TRACKER["attempts"][task.host.name] += 1
+        first_attempt = TRACKER["attempts"][task.host.name] == 1
+    time.sleep(0.05)
+    with TRACKER["lock"]:
+        TRACKER["running"] -= 1
+
+    stockpile_info = StockpileResults(name=f"{task.host}_backup", ip=task.host.hostname, hostname=task.host.name)
+    if first_attempt:
+        task.run(task=raise_authentication_failure, name="connect")
+    stockpile_info["backup_successful"] = True
+    return Result(host=task.host, result=stockpile_info)
+
+
+def raise_authentication_failure(task: Task) -> Result:
+    raise NetmikoAuthenticationException(f"Authentication to device failed: {task.host}")
+
+
+class TestStockpileDeviceConfig(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Create a temporary inventory of hosts on a test platform, sharing an AAA group's concurrency limit
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        inventory_directory = pathlib.Path(self.temp_dir.name)
+        hosts = {
+            f"rtr{i}": {"hostname": f"192.0.2.{i}", "platform": "stockpiler_test", "groups": ["aaa"]} for i in range(6)
+        }
+        groups = {"aaa": {"data": {"stockpile_limits": ["aaa-east"], "stockpile_retry_backoff": 0.01}}}
+        defaults = {"data": {"stockpile_concurrency_limits": {"aaa-east": 2}}}
+        for file_name, content in (("hosts.yml", hosts), ("groups.yml", groups), ("defaults.yml", defaults)):
+            (inventory_directory / file_name).write_text(yaml.safe_dump(content))
+        self.norns = InitNornir(
+            core={"num_workers": 6},
+            inventory={
+                "plugin": "nornir.plugins.inventory.simple.SimpleInventory",
+                "options": {
+                    "host_file": f"{inventory_directory}/hosts.yml",
+                    "group_file": f"{inventory_directory}/groups.yml",
+                    "defaults_file": f"{inventory_directory}/defaults.yml",
+                },
+            },
+            logging={"enabled": False},
+        )
+        StockpileMap.register("stockpiler_test", limited_stockpile)
+        TRACKER.update(lock=threading.Lock(), running=0, peak=0, attempts=Counter())
+
+    def tearDown(self) -> None:
+        del StockpileMap.tasks["stockpiler_test"]
+        self.temp_dir.cleanup()
+
+    def test_limits_and_retries(self):
+        """
+        Tests that no more hosts run at once than their limit allows, and hosts turned away are retried
+        :return:
+        """
+
+        results = self.norns.run(task=stockpile_device_config, stockpile_directory=pathlib.Path(self.temp_dir.name))
+
+        self.assertEqual(TRACKER["peak"], 2)
+        for name, result in results.items():
+            with self.subTest(host=name):
+                self.assertFalse(result.failed)
+                self.assertTrue(result[0].result["backup_successful"])
+                self.assertEqual(TRACKER["attempts"][name], 2)
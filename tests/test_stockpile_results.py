@@ -0,0 +1,100 @@
+import csv
+import pathlib
+import pickle
+import tempfile
+import time
+import unittest
+
+
+from stockpiler.tasks.stockpile.stockpile_results import StockpileResults, StockpileResultsTable
+
+
+class TestStockpileResults(unittest.TestCase):
+    def test_dict_access(self):
+        """
+        Tests that StockpileResults behave like the dict they replaced, for known keys and any others
+        :return:
+        """
+
+        stockpile_info = StockpileResults(name="r1_backup", ip="192.0.2.1", hostname="r1", backup_successful=True)
+        stockpile_info["authorization_failed"] = True
+        self.assertEqual(stockpile_info["hostname"], "r1")
+        self.assertTrue(stockpile_info.get("authorization_failed"))
+        self.assertIsNone(stockpile_info.get("missing"))
+        self.assertIn("device_config", stockpile_info)
+        self.assertEqual(len(stockpile_info), len(StockpileResults.fields) + 1)
+        self.assertEqual(pickle.loads(pickle.dumps(stockpile_info)), stockpile_info)
+        self.assertFalse(hasattr(stockpile_info, "__dict__"))
+
+    def test_last_backup_attempt(self):
+        """
+        Tests that each attempt is stamped when it's made, rather than when this module was imported
+        :return:
+        """
+
+        first = StockpileResults(name="r1_backup", ip="192.0.2.1", hostname="r1")
+        time.sleep(0.01)
+        second = StockpileResults(name="r2_backup", ip="192.0.2.2", hostname="r2")
+        self.assertLess(first["last_backup_attempt"], second["last_backup_attempt"])
+
+
+class TestStockpileResultsTable(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Create a temporary directory, and a table of a few hosts' results, for each test
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = pathlib.Path(self.temp_dir.name)
+        self.table = StockpileResultsTable()
+        for i in range(3):
+            self.table.append(
+                host_name=f"r{i}",
+                stockpile_info=StockpileResults(
+                    name=f"r{i}_backup", ip=f"192.0.2.{i}", hostname=f"r{i}", backup_successful=i != 1
+                ),
+            )
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_rows(self):
+        """
+        Tests that rows can be read and changed by host name
+        :return:
+        """
+
+        self.assertEqual(len(self.table), 3)
+        self.assertFalse(self.table["r1"]["backup_successful"])
+        self.table["r1"]["save_config_successful"] = True
+        self.assertIs(self.table["r1"]["save_config_successful"], True)
+        self.assertEqual(dict(self.table["r2"])["ip"], "192.0.2.2")
+
+    def test_stream_csv(self):
+        """
+        Tests that once streaming, each row appended is in the CSV report straight away
+        :return:
+        """
+
+        path = self.directory / "results.csv"
+        self.table.stream_csv(path=path)
+        self.addCleanup(self.table.close_csv)
+        stockpile_info = StockpileResults(name="r3_backup", ip="192.0.2.3", hostname="r3")
+        self.table.append(host_name="r3", stockpile_info=stockpile_info)
+        with path.open() as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([row["hostname"] for row in rows], ["r0", "r1", "r2", "r3"])
+
+    def test_to_csv(self):
+        """
+        Tests the CSV export holds every row
+        :return:
+        """
+
+        self.table.to_csv(path=self.directory / "results.csv")
+        with (self.directory / "results.csv").open() as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(list(rows[0]), StockpileResults.report_fields)
+        self.assertEqual([row["backup_successful"] for row in rows], ["True", "False", "True"])
+        self.assertEqual(rows[0]["last_successful_backup"], "")
@@ -0,0 +1,103 @@
+import os
+import pathlib
+import tempfile
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+
+
+from nornir.core.inventory import ConnectionOptions, Host
+
+
+from stockpiler.tasks.stockpile.config_files import (
+    blob_hash,
+    blob_hash_file,
+    config_temp_file,
+    install_config,
+    write_config,
+)
+from stockpiler.tasks.stockpile.stockpile_transfer import remote_path, ssh_client, transfer_source
+
+
+class TestStockpileTransfer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.stockpile_directory = pathlib.Path(self.temp_dir.name)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_transfer_settings(self):
+        """
+        Tests which config each host transfers, and where it's copied to on the device
+        :return:
+        """
+
+        for platform, data, source, path in (
+            ("cisco_ios", {}, "running-config", "flash:stockpiler-backup.cfg"),
+            ("cisco_asa", {"stockpile_transfer": "startup-config"}, "startup-config", "disk0:stockpiler-backup.cfg"),
+            ("cisco_nxos", {"stockpile_file_system": "volatile:"}, "running-config", "volatile:stockpiler-backup.cfg"),
+            ("cisco_ios", {"stockpile_transfer": "off"}, None, "flash:stockpiler-backup.cfg"),
+            ("cisco_ios", {"stockpile_transfer": "tftp"}, None, "flash:stockpiler-backup.cfg"),
+        ):
+            with self.subTest(platform=platform, data=data):
+                task = SimpleNamespace(host=Host(name="rtr1", platform=platform, data=data))
+                self.assertEqual(transfer_source(task=task), source)
+                self.assertEqual(remote_path(task=task), path)
+
+    def test_ssh_client(self):
+        """
+        Tests that the SSH connection a config is transferred over is opened with the host's Netmiko connection options
+        :return:
+        """
+
+        host = Host(
+            name="rtr1",
+            hostname="192.0.2.1",
+            username="stockpiler",
+            password="secret",
+            platform="cisco_ios",
+            connection_options={"netmiko": ConnectionOptions(port=2222, extras={"secret": "enable", "timeout": 30})},
+        )
+        with mock.patch("paramiko.SSHClient") as client_class:
+            client, timeout = ssh_client(task=SimpleNamespace(host=host))
+
+        self.assertIs(client, client_class.return_value)
+        self.assertEqual(timeout, 30)
+        client.connect.assert_called_once_with(
+            hostname="192.0.2.1",
+            port=2222,
+            username="stockpiler",
+            password="secret",
+            key_filename=None,
+            look_for_keys=False,
+            allow_agent=False,
+            timeout=5.0,
+            sock=None,
+        )
+
+    def test_install_config(self):
+        """
+        Tests that a config streamed into a temporary file replaces the stockpiled config only if it has changed, and
+        no temporary files are left behind
+        :return:
+        """
+
+        config = b"hostname rtr1\n" + b"interface Loopback0\n" * 100000
+        blob, written = write_config(
+            stockpile_directory=self.stockpile_directory, relative_path="rtr1.txt", content=config
+        )
+        self.assertTrue(written)
+        self.assertEqual(blob_hash_file(path=self.stockpile_directory / "rtr1.txt"), blob_hash(content=config))
+
+        for content, expected_written in ((config, False), (config.replace(b"rtr1", b"rtr2"), True)):
+            with self.subTest(written=expected_written):
+                temp_path = config_temp_file(stockpile_directory=self.stockpile_directory, relative_path="rtr1.txt")
+                pathlib.Path(temp_path).write_bytes(content)
+                blob, written = install_config(
+                    stockpile_directory=self.stockpile_directory, relative_path="rtr1.txt", temp_path=temp_path
+                )
+                self.assertEqual(written, expected_written)
+                self.assertEqual(blob, blob_hash(content=content))
+                self.assertEqual((self.stockpile_directory / "rtr1.txt").read_bytes(), content)
+                self.assertEqual(os.listdir(self.stockpile_directory), ["rtr1.txt"])